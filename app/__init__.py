@@ -2,16 +2,24 @@ from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_pagedown import PageDown
 from config import config
+from .database import SQLAlchemy
+from .profiler import QueryProfiler
+from .compress import Compress
+from .assets import Assets
+from .mailqueue import MailQueue
 
 bootstrap = Bootstrap()
 mail = Mail()
 moment = Moment()
 db = SQLAlchemy()
 pagedown = PageDown()
+profiler = QueryProfiler()
+compress = Compress()
+assets = Assets()
+mail_queue = MailQueue()
 
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -25,10 +33,25 @@ def create_app(config_name):
 
     bootstrap.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
     moment.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
+    profiler.init_app(app)
+    compress.init_app(app)
+    assets.init_app(app)
+
+    # 页面缓存写入的响应头要包含 add_validators 设置的验证器，
+    # after_request 按注册的相反顺序执行，所以先注册页面缓存
+    from .page_cache import page_cache
+    page_cache.init_app(app)
+
+    from .conditional import add_validators
+    app.after_request(add_validators)
+
+    # 注册全文索引的表和增量更新的事件
+    from . import search
 
     if not app.debug and not app.testing and not app.config['SSL_DISABLE']:
         from flask_sslify import SSLify
@@ -43,4 +66,8 @@ def create_app(config_name):
     from .api_1_0 import api as api_1_0_blueprint
     app.register_blueprint(api_1_0_blueprint, url_prefix='/api/v1.0')
 
+    # 邮件模板在所有蓝本注册之后编译
+    from .email import email_templates
+    email_templates.init_app(app)
+
     return app
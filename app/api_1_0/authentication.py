@@ -1,27 +1,107 @@
-from flask import g, jsonify
+import hashlib
+import hmac
+import time
+from flask import g, jsonify, current_app
 from flask_httpauth import HTTPBasicAuth
+from sqlalchemy.orm import Session, object_session
+from .. import db
+from ..cache import TTLCache
 from ..models import User, AnonymousUser
 from . import api
 from .errors import unauthorized, forbidden
 
 auth = HTTPBasicAuth()
 
+# 验证通过的凭据摘要 -> 用户快照，省去每次请求的密码哈希和用户查询
+credential_cache = TTLCache(maxsize=1024)
+
+
+def credential_key(email_or_token, password):
+    message = (email_or_token + '\0' + password).encode('utf-8')
+    secret = current_app.config['SECRET_KEY'].encode('utf-8')
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+
+def _verify(email_or_token, password):
+    if password == '':
+        user = User.verify_auth_token(email_or_token)
+        if user is None:
+            return None, 0
+        # 令牌的缓存时间不超过它的有效期
+        ttl = (User.auth_token_expiration(email_or_token) or 0) - time.time()
+        return user, ttl
+    user = User.query.filter_by(email=email_or_token).first()
+    if user is None or not user.verify_password(password):
+        return None, 0
+    return user, float('inf')
+
 
 @auth.verify_password
 def verify_password(email_or_token, password):
     if email_or_token == '':
         g.current_user = AnonymousUser()
         return True
-    if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
-        g.token_used = True
-        return g.current_user is not None
-    user = User.query.filter_by(email=email_or_token).first()
-    if not user:
+    g.token_used = password == ''
+    key = credential_key(email_or_token, password)
+    snapshot = credential_cache.get(key)
+    if snapshot is not None:
+        g.current_user = User.from_snapshot(snapshot)
+        return True
+    # 验证结果会被缓存，从主库读取用户
+    with db.primary():
+        user, ttl = _verify(email_or_token, password)
+    if user is None:
         return False
+    credential_cache.set(key, user.snapshot(), min(
+        ttl, current_app.config['FLASKY_API_AUTH_CACHE_TTL']))
     g.current_user = user
-    g.token_used = False
-    return user.verify_password(password)
+    return True
+
+
+def invalidate_credentials(target, value=None, oldvalue=None, initiator=None):
+    """用户的密码、邮箱、角色或验证状态变化后，丢弃缓存中与之相关的凭据。
+
+    修改先记在会话上，提交成功后才丢弃，以免其他请求在提交前又用旧数据
+    验证并写回缓存。缓存在进程内，只能失效当前进程中的凭据，其他工作进程
+    中的条目要等 ``FLASKY_API_AUTH_CACHE_TTL`` 过期。
+    """
+    # id 是整数，邮箱是字符串，放在同一个集合里
+    stale = set(email for email in (target.email, value, oldvalue)
+                if isinstance(email, str))
+    if target.id is not None:
+        stale.add(target.id)
+    session = object_session(target)
+    if session is None:
+        _discard_credentials(stale)
+    else:
+        session.info.setdefault('stale_credentials', set()).update(stale)
+
+
+def _discard_credentials(stale):
+    if stale:
+        credential_cache.discard_if(
+            lambda snapshot: snapshot['id'] in stale or
+            snapshot['email'] in stale)
+
+
+def _after_commit(session):
+    _discard_credentials(session.info.pop('stale_credentials', None))
+
+
+def _after_rollback(session):
+    session.info.pop('stale_credentials', None)
+
+
+# User.role 是 Role.users 的反向引用，配置完映射后才存在
+db.configure_mappers()
+for attribute in (User.password_hash, User.email, User.role_id, User.role,
+                  User.confirmed):
+    db.event.listen(attribute, 'set', invalidate_credentials)
+db.event.listen(User, 'after_delete',
+                lambda mapper, connection, target:
+                invalidate_credentials(target))
+db.event.listen(Session, 'after_commit', _after_commit)
+db.event.listen(Session, 'after_rollback', _after_rollback)
 
 
 @auth.error_handler
@@ -0,0 +1,63 @@
+from flask import current_app, request
+from .. import db
+from ..exceptions import ValidationError
+
+
+def _check_limit(count):
+    limit = current_app.config['FLASKY_API_BATCH_LIMIT']
+    if count > limit:
+        raise ValidationError('batch size exceeds limit of %d' % limit)
+
+
+def requested_ids():
+    """解析 ``?ids=1,2,3``，去掉重复并保持顺序"""
+    ids = []
+    for part in request.args.get('ids', '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            id = int(part)
+        except ValueError:
+            raise ValidationError('invalid id: %s' % part)
+        if id not in ids:
+            ids.append(id)
+    _check_limit(len(ids))
+    return ids
+
+
+def batch_items(key):
+    """请求体 ``{key: [...]}`` 中的条目列表"""
+    data = request.get_json(silent=True)
+    items = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        raise ValidationError('request body must contain a list of %s' % key)
+    _check_limit(len(items))
+    return items
+
+
+def create_many(items, create, key):
+    """逐条调用 ``create(item)`` 构造对象，校验失败的条目记下错误，其余对象
+    一次提交。返回与 ``items`` 一一对应的结果列表。
+
+    在 flush 之后、提交之前序列化，避免提交后对象过期被逐个重新加载。
+    """
+    objects = []
+    for item in items:
+        if not isinstance(item, dict):
+            objects.append('item must be an object')
+            continue
+        try:
+            obj = create(item)
+        except ValidationError as e:
+            objects.append(e.args[0])
+            continue
+        db.session.add(obj)
+        objects.append(obj)
+    db.session.flush()
+    results = [
+        {'status': 400, 'error': 'bad request', 'message': obj}
+        if isinstance(obj, str) else {'status': 201, key: obj.to_json()}
+        for obj in objects]
+    db.session.commit()
+    return results
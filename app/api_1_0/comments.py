@@ -3,23 +3,37 @@ from .. import db
 from ..models import Post, Permission, Comment
 from . import api
 from .decorators import permission_required
+from .pagination import is_keyset_request, paginate_keyset
+from .batch import batch_items, create_many
+from ..conditional import conditional
+from ..serializers import CommentSerializer
 
 
 @api.route('/comments/')
 def get_comments():
+    serializer = CommentSerializer.from_request()
+    if is_keyset_request():
+        return jsonify(paginate_keyset(
+            Comment.query, Comment, 'comments', 'api.get_comments',
+            current_app.config['FLASKY_COMMENTS_PER_PAGE'], serializer))
     page = request.args.get('page', 1, type=int)
     pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
         error_out=False)
     comments = pagination.items
+    serializer.prefetch(comments)
+    conditional(pagination.total, [(c.id, c.updated_at) for c in comments],
+                serializer.versions(), personal=False)
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_comments', page=page-1, _external=True)
+        prev = url_for('api.get_comments', page=page-1, _external=True,
+                       **serializer.args)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1, _external=True)
+        next = url_for('api.get_comments', page=page+1, _external=True,
+                       **serializer.args)
     return jsonify({
-        'comments': [comment.to_json() for comment in comments],
+        'comments': [serializer.dump(comment) for comment in comments],
         'prev': prev,
         'next': next,
         'count': pagination.total
@@ -28,26 +42,41 @@ def get_comments():
 
 @api.route('/comments/<int:id>')
 def get_comment(id):
+    serializer = CommentSerializer.from_request()
     comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    serializer.prefetch([comment])
+    conditional(comment.updated_at, serializer.versions(), personal=False)
+    return jsonify(serializer.dump(comment))
 
 
 @api.route('/posts/<int:id>/comments/')
 def get_post_comments(id):
+    serializer = CommentSerializer.from_request()
     post = Post.query.get_or_404(id)
+    if is_keyset_request():
+        return jsonify(paginate_keyset(
+            post.comments, Comment, 'comments', 'api.get_post_comments',
+            current_app.config['FLASKY_COMMENTS_PER_PAGE'], serializer,
+            descending=False, id=id))
     page = request.args.get('page', 1, type=int)
     pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
         page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
         error_out=False)
     comments = pagination.items
+    serializer.prefetch(comments)
+    conditional(post.updated_at, pagination.total,
+                [(c.id, c.updated_at) for c in comments],
+                serializer.versions(), personal=False)
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_post_comments', page=page-1, _external=True)
+        prev = url_for('api.get_post_comments', id=id, page=page-1,
+                       _external=True, **serializer.args)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_post_comments', page=page+1, _external=True)
+        next = url_for('api.get_post_comments', id=id, page=page+1,
+                       _external=True, **serializer.args)
     return jsonify({
-        'comments': [comment.to_json() for comment in comments],
+        'comments': [serializer.dump(comment) for comment in comments],
         'prev': prev,
         'next': next,
         'count': pagination.total
@@ -66,3 +95,17 @@ def new_post_comment(id):
     return jsonify(comment.to_json()), 201, \
         {'Location': url_for('api.get_comment', id=comment.id,
                              _external=True)}
+
+
+@api.route('/posts/<int:id>/comments/batch', methods=['POST'])
+@permission_required(Permission.COMMENT)
+def new_post_comments(id):
+    post = Post.query.get_or_404(id)
+
+    def create(item):
+        comment = Comment.from_json(item)
+        comment.author = g.current_user
+        comment.post = post
+        return comment
+    return jsonify({'results': create_many(batch_items('comments'), create,
+                                           'comment')})
@@ -0,0 +1,22 @@
+from flask import Response, abort, current_app, request
+from .. import db
+from ..export import EXPORTS, export_rows, gzip_stream, parse_since
+from ..models import Permission
+from . import api
+from .decorators import permission_required
+
+
+@api.route('/export/<kind>')
+@permission_required(Permission.ADMINISTER)
+def export(kind):
+    if kind not in EXPORTS:
+        abort(404)
+    since = parse_since(request.args.get('since'))
+    # 生成器在响应发出时才执行，使用自己的连接，不依赖请求上下文
+    chunks = export_rows(db.engine, kind, since,
+                         current_app.config['FLASKY_EXPORT_CHUNK_SIZE'])
+    if request.args.get('gzip', 0, type=int):
+        return Response(gzip_stream(chunks), mimetype='application/gzip',
+                        headers={'Content-Disposition':
+                                 'attachment; filename=%s.ndjson.gz' % kind})
+    return Response(chunks, mimetype='application/x-ndjson')
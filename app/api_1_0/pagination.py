@@ -0,0 +1,89 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import request, url_for
+from sqlalchemy import and_, or_
+from app.exceptions import ValidationError
+from app.conditional import conditional
+
+CURSOR_ARGS = ('cursor', 'after', 'before')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(item):
+    key = [item.timestamp.strftime(TIMESTAMP_FORMAT), item.id]
+    return urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, id = json.loads(
+            urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)
+    except (ValueError, TypeError, UnicodeError):
+        raise ValidationError('invalid cursor')
+
+
+def is_keyset_request():
+    return any(arg in request.args for arg in CURSOR_ARGS)
+
+
+def paginate_keyset(query, model, key, endpoint, per_page, serializer,
+                    descending=True, **values):
+    """按 (timestamp, id) 做游标分页，避免 OFFSET 和每次请求的 COUNT(*)。
+
+    ``cursor``/``after`` 取游标之后的一页，``before`` 取游标之前的一页，
+    ``cursor`` 为空时从第一页开始。只有带上 ``count=1`` 时才返回总数。
+    条目由 ``serializer`` 序列化。
+    """
+    before = request.args.get('before')
+    after = request.args.get('after') or request.args.get('cursor')
+    forward = not before
+    if forward == descending:
+        order = (model.timestamp.desc(), model.id.desc())
+    else:
+        order = (model.timestamp.asc(), model.id.asc())
+    keyset = query
+    if before or after:
+        timestamp, id = decode_cursor(before or after)
+        if forward == descending:
+            keyset = keyset.filter(or_(
+                model.timestamp < timestamp,
+                and_(model.timestamp == timestamp, model.id < id)))
+        else:
+            keyset = keyset.filter(or_(
+                model.timestamp > timestamp,
+                and_(model.timestamp == timestamp, model.id > id)))
+    items = keyset.order_by(*order).limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if not forward:
+        items.reverse()
+    count = request.args.get('count', 0, type=int)
+    total = query.order_by(None).count() if count else None
+    serializer.prefetch(items)
+    conditional(has_more, total, [(item.id, item.updated_at)
+                                  for item in items], serializer.versions(),
+                personal=False)
+    values.update(serializer.args)
+    if count:
+        values['count'] = count
+    prev = None
+    next = None
+    if items:
+        if (forward and after) or (not forward and has_more):
+            prev = url_for(endpoint, before=encode_cursor(items[0]),
+                           _external=True, **values)
+        if (forward and has_more) or not forward:
+            next = url_for(endpoint, after=encode_cursor(items[-1]),
+                           _external=True, **values)
+    result = {
+        key: [serializer.dump(item) for item in items],
+        'prev': prev,
+        'next': next
+    }
+    if count:
+        result['count'] = total
+    return result
@@ -4,33 +4,67 @@ from ..models import Post, Permission
 from . import api
 from .decorators import permission_required
 from .errors import forbidden
+from .pagination import is_keyset_request, paginate_keyset
+from .batch import requested_ids, batch_items, create_many
+from ..conditional import conditional
+from ..serializers import PostSerializer
 
 
 @api.route('/posts/')
 def get_posts():
+    serializer = PostSerializer.from_request()
+    if 'ids' in request.args:
+        return get_posts_by_id(serializer)
+    if is_keyset_request():
+        return jsonify(paginate_keyset(
+            Post.query, Post, 'posts', 'api.get_posts',
+            current_app.config['FLASKY_POSTS_PER_PAGE'], serializer))
     page = request.args.get('page', 1, type=int)
-    pagination = Post.query.paginate(
+    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     posts = pagination.items
+    serializer.prefetch(posts)
+    conditional(pagination.total, [(p.id, p.updated_at) for p in posts],
+                serializer.versions(), personal=False)
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1, _external=True)
+        prev = url_for('api.get_posts', page=page-1, _external=True,
+                       **serializer.args)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1, _external=True)
+        next = url_for('api.get_posts', page=page+1, _external=True,
+                       **serializer.args)
     return jsonify({
-        'posts': [post.to_json() for post in posts],
+        'posts': [serializer.dump(post) for post in posts],
         'prev': prev,
         'next': next,
         'count': pagination.total
     })
 
 
+def get_posts_by_id(serializer):
+    # 按请求的顺序返回，不存在的 id 列在 missing 中
+    ids = requested_ids()
+    found = dict((post.id, post) for post in
+                 Post.query.filter(Post.id.in_(ids))) if ids else {}
+    posts = [found[id] for id in ids if id in found]
+    serializer.prefetch(posts)
+    conditional([(p.id, p.updated_at) for p in posts], serializer.versions(),
+                personal=False)
+    return jsonify({
+        'posts': [serializer.dump(post) for post in posts],
+        'missing': [id for id in ids if id not in found]
+    })
+
+
 @api.route('/posts/<int:id>')
 def get_post(id):
+    serializer = PostSerializer.from_request()
     post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    serializer.prefetch([post])
+    conditional(post.updated_at, serializer.versions(), personal=False)
+    return jsonify(serializer.dump(post))
 
 
 @api.route('/posts/', methods=['POST'])
@@ -44,6 +78,17 @@ def new_post():
         {'Location': url_for('api.get_post', id=post.id, _external=True)}
 
 
+@api.route('/posts/batch', methods=['POST'])
+@permission_required(Permission.WRITE_ARTICLES)
+def new_posts():
+    def create(item):
+        post = Post.from_json(item)
+        post.author = g.current_user
+        return post
+    return jsonify({'results': create_many(batch_items('posts'), create,
+                                           'post')})
+
+
 @api.route('/posts/<int:id>', methods=['PUT'])
 @permission_required(Permission.WRITE_ARTICLES)
 def edit_post(id):
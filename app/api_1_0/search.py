@@ -0,0 +1,35 @@
+from flask import jsonify, request, url_for, current_app
+from . import api
+from ..exceptions import ValidationError
+from ..serializers import PostSerializer, CommentSerializer
+from ..search import search
+
+SERIALIZERS = {'posts': PostSerializer, 'comments': CommentSerializer}
+
+
+@api.route('/search')
+def search_content():
+    q = request.args.get('q', '').strip()
+    type = request.args.get('type', 'posts')
+    if type not in SERIALIZERS:
+        raise ValidationError('unknown search type: %s' % type)
+    serializer = SERIALIZERS[type].from_request()
+    # 页码直接来自查询参数，小于 1 时按第一页处理，否则 OFFSET 为负
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['FLASKY_SEARCH_RESULTS_PER_PAGE']
+    items, total = search(type, q, page, per_page)
+    serializer.prefetch(items)
+    prev = None
+    if page > 1:
+        prev = url_for('api.search_content', q=q, type=type, page=page-1,
+                       _external=True, **serializer.args)
+    next = None
+    if page * per_page < total:
+        next = url_for('api.search_content', q=q, type=type, page=page+1,
+                       _external=True, **serializer.args)
+    return jsonify({
+        type: [serializer.dump(item) for item in items],
+        'prev': prev,
+        'next': next,
+        'count': total
+    })
@@ -1,30 +1,45 @@
 from flask import jsonify, request, current_app, url_for
 from . import api
 from ..models import User, Post
+from .pagination import is_keyset_request, paginate_keyset
+from ..conditional import conditional
+from ..serializers import UserSerializer, PostSerializer
 
 
 @api.route('/users/<int:id>')
 def get_user(id):
+    serializer = UserSerializer.from_request()
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    conditional(user.updated_at, user.last_seen, personal=False)
+    return jsonify(serializer.dump(user))
 
 
 @api.route('/users/<int:id>/posts/')
 def get_user_posts(id):
+    serializer = PostSerializer.from_request()
     user = User.query.get_or_404(id)
+    if is_keyset_request():
+        return jsonify(paginate_keyset(
+            user.posts, Post, 'posts', 'api.get_user_posts',
+            current_app.config['FLASKY_POSTS_PER_PAGE'], serializer, id=id))
     page = request.args.get('page', 1, type=int)
     pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     posts = pagination.items
+    serializer.prefetch(posts)
+    conditional(pagination.total, [(p.id, p.updated_at) for p in posts],
+                serializer.versions(), personal=False)
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_user_posts', page=page-1, _external=True)
+        prev = url_for('api.get_user_posts', id=id, page=page-1,
+                       _external=True, **serializer.args)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_user_posts', page=page+1, _external=True)
+        next = url_for('api.get_user_posts', id=id, page=page+1,
+                       _external=True, **serializer.args)
     return jsonify({
-        'posts': [post.to_json() for post in posts],
+        'posts': [serializer.dump(post) for post in posts],
         'prev': prev,
         'next': next,
         'count': pagination.total
@@ -33,22 +48,30 @@ def get_user_posts(id):
 
 @api.route('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
+    serializer = PostSerializer.from_request()
     user = User.query.get_or_404(id)
+    if is_keyset_request():
+        return jsonify(paginate_keyset(
+            user.followed_posts, Post, 'posts', 'api.get_user_followed_posts',
+            current_app.config['FLASKY_POSTS_PER_PAGE'], serializer, id=id))
     page = request.args.get('page', 1, type=int)
     pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     posts = pagination.items
+    serializer.prefetch(posts)
+    conditional(pagination.total, [(p.id, p.updated_at) for p in posts],
+                serializer.versions(), personal=False)
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_user_followed_posts', page=page-1,
-                       _external=True)
+        prev = url_for('api.get_user_followed_posts', id=id, page=page-1,
+                       _external=True, **serializer.args)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_user_followed_posts', page=page+1,
-                       _external=True)
+        next = url_for('api.get_user_followed_posts', id=id, page=page+1,
+                       _external=True, **serializer.args)
     return jsonify({
-        'posts': [post.to_json() for post in posts],
+        'posts': [serializer.dump(post) for post in posts],
         'prev': prev,
         'next': next,
         'count': pagination.total
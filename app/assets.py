@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import current_app, request, send_from_directory
+from .compress import CompressMiddleware
+
+# 文件名带内容摘要，内容变了 URL 就变，可以让浏览器缓存一年不再验证
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _fingerprint(filename, digest):
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def build(static_folder, output='build', levels=None):
+    """给 ``static_folder`` 中的文件生成带摘要的副本和 gzip 预压缩版本，
+    写入 ``output`` 子目录并生成 manifest.json，返回 {原文件名: 新文件名}。
+
+    可压缩的类型沿用响应压缩的 ``levels`` 设置，以最高级别预先压缩。
+    旧版本的文件保留，已经缓存的页面仍能引用到它们。
+    """
+    target = os.path.join(static_folder, output)
+    compressor = CompressMiddleware(None, levels or {})
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        # 跳过输出目录本身
+        dirs[:] = [d for d in dirs if os.path.abspath(
+            os.path.join(root, d)) != os.path.abspath(target)]
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(
+                os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()[:12]
+            hashed = output + '/' + _fingerprint(filename, digest)
+            destination = os.path.join(static_folder, hashed)
+            if not os.path.exists(destination):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copyfile(path, destination)
+            content_type = mimetypes.guess_type(filename)[0] or ''
+            if compressor.level(content_type) and \
+                    not os.path.exists(destination + '.gz'):
+                compressed = gzip.compress(data, 9)
+                # 压缩后没有变小的文件（已压缩格式）不生成 .gz
+                if len(compressed) < len(data):
+                    with open(destination + '.gz', 'wb') as f:
+                        f.write(compressed)
+            manifest[filename] = hashed
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return manifest
+
+
+class Assets(object):
+    """让 url_for('static', ...) 生成带摘要的 URL，并以长期缓存返回这些文件。
+
+    manifest 由 ``manage.py assets`` 生成，不存在时保持原来的行为。
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_ASSETS_DIR', 'build')
+        self.load(app)
+        app.url_defaults(self._hashed_url)
+        app.view_functions['static'] = self.send_static_file
+
+    @staticmethod
+    def load(app):
+        """读取 manifest，重新生成后调用即可生效"""
+        manifest = {}
+        path = os.path.join(app.static_folder,
+                            app.config['FLASKY_ASSETS_DIR'], 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        app.extensions['assets'] = {
+            'manifest': manifest,
+            'files': set(manifest.values())
+        }
+
+    @staticmethod
+    def _hashed_url(endpoint, values):
+        if endpoint != 'static':
+            return
+        manifest = current_app.extensions['assets']['manifest']
+        filename = values.get('filename')
+        if filename in manifest:
+            values['filename'] = manifest[filename]
+
+    @staticmethod
+    def send_static_file(filename):
+        if filename not in current_app.extensions['assets']['files']:
+            return current_app.send_static_file(filename)
+        static_folder = current_app.static_folder
+        accept = request.accept_encodings
+        if accept['gzip'] and \
+                os.path.exists(os.path.join(static_folder, filename + '.gz')):
+            response = send_from_directory(
+                static_folder, filename + '.gz',
+                mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = send_from_directory(static_folder, filename)
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.headers.pop('Expires', None)
+        return response
@@ -0,0 +1,147 @@
+import re
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+from werkzeug.wsgi import ClosingIterator
+
+# HTTP 的 deflate 指 zlib 格式，gzip 需要 16 + MAX_WBITS
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# 请求的 If-None-Match 中去掉压缩后缀，应用仍能按原始 ETag 比较
+_etag_suffix = re.compile(r'-(gzip|deflate)"')
+
+
+def _suffix_etag(etag, coding):
+    # 压缩后的表示与原始表示字节不同，强 ETag 也要区分
+    if etag and etag.endswith('"'):
+        return etag[:-1] + '-' + coding + '"'
+    return etag
+
+
+class Compress(object):
+    """按 Accept-Encoding 压缩响应的 WSGI 中间件。
+
+    只压缩 ``FLASKY_COMPRESS_LEVELS`` 中列出的类型，已经压缩过的图片、
+    归档等不在其中。小于 ``FLASKY_COMPRESS_MIN_SIZE`` 的响应原样返回；
+    没有 Content-Length 的流式响应先缓冲到阈值，之后边生成边压缩。
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('FLASKY_COMPRESS_LEVELS', {
+            'text/*': 6, 'application/json': 6})
+        app.wsgi_app = CompressMiddleware(
+            app.wsgi_app, app.config['FLASKY_COMPRESS_LEVELS'],
+            app.config['FLASKY_COMPRESS_MIN_SIZE'])
+
+
+class CompressMiddleware(object):
+    def __init__(self, app, levels, min_size=500):
+        self.app = app
+        self.levels = levels
+        self.min_size = min_size
+
+    def level(self, content_type):
+        """内容类型对应的压缩级别，0 表示不压缩"""
+        mimetype = parse_options_header(content_type)[0].lower()
+        if mimetype in self.levels:
+            return self.levels[mimetype]
+        return self.levels.get(mimetype.split('/')[0] + '/*', 0)
+
+    @staticmethod
+    def coding(environ):
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        best = None
+        for coding in ('gzip', 'deflate'):
+            quality = accept.quality(coding)
+            if quality and (best is None or quality > best[1]):
+                best = (coding, quality)
+        return best and best[0]
+
+    def __call__(self, environ, start_response):
+        coding = self.coding(environ)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = _etag_suffix.sub('"', if_none_match)
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return body.append
+
+        body = []
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+        code = int(status.split(None, 1)[0])
+        level = self.level(headers.get('Content-Type', ''))
+        if level:
+            vary = headers.get('Vary')
+            if not vary:
+                headers['Vary'] = 'Accept-Encoding'
+            elif 'accept-encoding' not in vary.lower():
+                headers['Vary'] = vary + ', Accept-Encoding'
+
+        if code == 304 and coding and if_none_match and \
+                _etag_suffix.search(if_none_match):
+            headers['ETag'] = _suffix_etag(headers.get('ETag'), coding)
+        if not coding or not level or code in (204, 206, 304) or \
+                code < 200 or environ['REQUEST_METHOD'] == 'HEAD' or \
+                'Content-Encoding' in headers:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return self._chain(body, app_iter)
+        length = headers.get('Content-Length', type=int)
+        if length is not None and length < self.min_size:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return self._chain(body, app_iter)
+
+        # 长度未知时先缓冲到阈值，响应很小就不压缩
+        iterator = iter(app_iter)
+        size = sum(len(chunk) for chunk in body)
+        for chunk in iterator:
+            body.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            if size < self.min_size:
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return ClosingIterator(body, getattr(app_iter, 'close', None))
+
+        headers['Content-Encoding'] = coding
+        headers.remove('Content-Length')
+        headers.remove('Content-MD5')
+        if 'ETag' in headers:
+            headers['ETag'] = _suffix_etag(headers['ETag'], coding)
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        # 流式响应每块都刷新，客户端能及时收到已生成的部分
+        streaming = length is None
+        return ClosingIterator(
+            self._compress(body, iterator, coding, level, streaming),
+            getattr(app_iter, 'close', None))
+
+    @staticmethod
+    def _chain(body, app_iter):
+        if not body:
+            return app_iter
+        return ClosingIterator(_concat(body, app_iter),
+                               getattr(app_iter, 'close', None))
+
+    @staticmethod
+    def _compress(body, iterator, coding, level, streaming):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+        for chunks in (body, iterator):
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if streaming:
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+        yield compressor.flush()
+
+
+def _concat(body, app_iter):
+    for chunk in body:
+        yield chunk
+    for chunk in app_iter:
+        yield chunk
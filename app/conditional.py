@@ -0,0 +1,89 @@
+import hashlib
+import json
+import time
+from datetime import datetime
+from flask import abort, current_app, g, request, session
+from flask_login import current_user
+from sqlalchemy import func
+from . import db
+
+
+def table_version(model):
+    """整张表最近的修改时间，updated_at 上有索引，代价很小"""
+    return db.session.query(func.max(model.updated_at)).scalar()
+
+
+def _latest(values):
+    latest = None
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            value = _latest(value)
+        if isinstance(value, datetime) and (latest is None or value > latest):
+            latest = value
+    return latest
+
+
+def _viewer():
+    # HTML 页面随登录用户、CSRF 令牌和首页的关注过滤而不同
+    parts = [request.cookies.get('show_followed')]
+    if current_user.is_authenticated:
+        parts.extend([current_user.id, current_user.username,
+                      current_user.avatar_hash, current_user.permissions])
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        # 在令牌有效期的一半内复用页面，304 返回的旧令牌至少还有一半有效期
+        bucket = int(time.time() // (time_limit // 2)) if time_limit else 0
+        parts.extend([session.get('csrf_token'), bucket])
+    return parts
+
+
+def conditional(*version, **kwargs):
+    """根据数据版本计算强 ETag 和 Last-Modified，请求的验证器仍然有效时
+    直接以 304 中止请求，视图不必再渲染模板或调用 to_json。
+
+    ``personal`` 为真（默认）时 ETag 还包含浏览者身份，适用于 HTML 页面；
+    有待显示的闪现消息时不做判断。验证器记在 g 上，由 :func:`add_validators`
+    写入最终的响应。
+    """
+    personal = kwargs.get('personal', True)
+    if request.method not in ('GET', 'HEAD'):
+        return
+    if personal and session.get('_flashes'):
+        return
+    parts = [request.full_path, list(version)]
+    if personal:
+        parts.append(_viewer())
+    etag = hashlib.sha1(json.dumps(parts, default=str, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+    last_modified = _latest(version)
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    g.validators = (etag, last_modified, personal)
+
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+    else:
+        # 个人页面只凭时间判断不够，必须比较 ETag
+        matched = not personal and last_modified is not None and \
+            request.if_modified_since is not None and \
+            last_modified <= request.if_modified_since
+    if matched:
+        abort(add_validators(current_app.response_class(status=304)))
+
+
+def add_validators(response):
+    validators = g.pop('validators', None)
+    if validators is None or response.status_code not in (200, 304):
+        return response
+    etag, last_modified, personal = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # 允许缓存但每次都要验证
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    if personal:
+        response.vary.add('Cookie')
+    else:
+        response.vary.add('Authorization')
+    return response
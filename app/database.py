@@ -0,0 +1,278 @@
+import atexit
+import logging
+import random
+import time
+import weakref
+from contextlib import contextmanager
+from flask import g, has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# 只有 QueuePool 接受的参数，SQLite 不使用连接池时去掉
+_QUEUE_POOL_OPTIONS = ('pool_timeout', 'max_overflow')
+# 可以分配到只读副本的请求方法
+_READ_METHODS = ('GET', 'HEAD')
+# 标记请求可以读副本的 environ 键
+_USE_REPLICA = 'flasky.use_replica'
+# 浏览器会话中记录读主库截止时间的键
+_PRIMARY_UNTIL = '_db_primary_until'
+# 保存在数据库文件中、只需设置一次的 PRAGMA，其余的每个连接都要设置
+_PERSISTENT_PRAGMAS = ('journal_mode',)
+
+
+def _is_sqlite_file(info):
+    return info.drivername.startswith('sqlite') and \
+        info.database not in (None, '', ':memory:')
+
+
+def _execute_pragmas(dbapi_connection, items):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in items:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    finally:
+        cursor.close()
+
+
+def tune_sqlite(engine, pragmas, optimize=False):
+    """在 ``engine`` 的每个新连接上执行 ``pragmas``。
+
+    journal_mode 等保存在数据库文件中的设置只在第一个连接上执行（先设置
+    busy_timeout，切换日志模式时遇到锁可以等待）；``optimize`` 为真时关闭
+    连接前执行 ``PRAGMA optimize``，按本连接执行过的查询更新统计信息。
+    """
+    per_connection = sorted((name, value) for name, value in pragmas.items()
+                            if name not in _PERSISTENT_PRAGMAS)
+    persistent = sorted((name, value) for name, value in pragmas.items()
+                        if name in _PERSISTENT_PRAGMAS)
+    if persistent:
+        first = [item for item in per_connection
+                 if item[0] == 'busy_timeout'] + persistent
+        event.listen(engine, 'first_connect',
+                     lambda dbapi_connection, record:
+                     _execute_pragmas(dbapi_connection, first))
+    if per_connection:
+        event.listen(engine, 'connect',
+                     lambda dbapi_connection, record:
+                     _execute_pragmas(dbapi_connection, per_connection))
+    if optimize:
+        event.listen(engine, 'close', _optimize)
+
+
+def _optimize(dbapi_connection, record):
+    try:
+        dbapi_connection.execute('PRAGMA optimize')
+    except Exception as e:
+        logger.warning('PRAGMA optimize failed: %s', e)
+
+
+def _reader_id():
+    """当前请求的用户 id：网页从会话中取，API 取已验证的 g.current_user；
+    不能借助 current_user，加载用户本身就要查询。提交之后对象已过期，
+    从标识中取 id，同样不发出查询"""
+    user_id = flask_session.get('user_id')
+    if user_id is None:
+        user = g.get('current_user')
+        if user is not None and user.is_authenticated:
+            identity = inspect(user).identity
+            user_id = identity[0] if identity else None
+    return user_id
+
+
+def use_primary():
+    """当前请求余下的查询都读主库"""
+    if has_request_context():
+        request.environ.pop(_USE_REPLICA, None)
+
+
+class RoutingSession(SignallingSession):
+    """读写分离的会话。
+
+    GET/HEAD 请求中的读查询分配到随机选定的一个只读副本，同一会话始终
+    使用这个副本；flush、DML 语句以及之后同一会话中的查询都使用主库。
+    用户提交写入后的 ``FLASKY_DATABASE_STICKY_SECONDS`` 秒内，其请求只读
+    主库，保证读到自己刚写入的数据：浏览器记在会话 cookie 中，API 客户端
+    记在进程内。
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is None or getattr(mapper.mapped_table, 'info', {})\
+                .get('bind_key') is None:
+            if self._writes(clause):
+                self.info['primary'] = self.info['wrote'] = True
+            elif self._can_use_replica():
+                replica = self._replica()
+                if replica is not None:
+                    return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _replica(self):
+        # 副本的同步进度各不相同，一个会话内只读一个副本
+        if 'replica' not in self.info:
+            replicas = self.db.get_replicas(self.app)
+            self.info['replica'] = random.choice(replicas) \
+                if replicas else None
+        return self.info['replica']
+
+    def _writes(self, clause):
+        if self._flushing or isinstance(clause, UpdateBase):
+            return True
+        return isinstance(clause, TextClause) and \
+            not clause.text.lstrip().upper().startswith('SELECT')
+
+    def _can_use_replica(self):
+        if self.info.get('primary') or self.info.get('force_primary') or \
+                not has_request_context() or \
+                not request.environ.get(_USE_REPLICA):
+            return False
+        if flask_session.get(_PRIMARY_UNTIL, 0) > time.time():
+            return False
+        user_id = _reader_id()
+        return user_id is None or \
+            not self.db.sticky(self.app).get(user_id, False)
+
+    @staticmethod
+    def on_flush(session, flush_context, instances):
+        session.info['primary'] = session.info['wrote'] = True
+
+    @staticmethod
+    def on_commit(session):
+        if not session.info.pop('wrote', False) or not has_request_context():
+            return
+        seconds = session.app.config['FLASKY_DATABASE_STICKY_SECONDS']
+        if 'user_id' in flask_session:
+            flask_session[_PRIMARY_UNTIL] = time.time() + seconds
+        user_id = _reader_id()
+        if user_id is not None:
+            session.db.sticky(session.app).set(user_id, True, ttl=seconds)
+
+
+def _allow_replica():
+    # 只在实际分派的请求中读副本；manage.py 的命令运行在测试请求上下文中，
+    # 不会经过 before_request
+    if request.method in _READ_METHODS:
+        request.environ[_USE_REPLICA] = True
+
+
+event.listen(RoutingSession, 'before_flush', RoutingSession.on_flush)
+event.listen(RoutingSession, 'after_commit', RoutingSession.on_commit)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """按配置调优数据库连接的 Flask-SQLAlchemy。
+
+    - ``SQLALCHEMY_POOL_SIZE`` 等连接池参数对 PostgreSQL 等数据库原样生效；
+      文件型 SQLite 设置了 ``SQLALCHEMY_POOL_SIZE`` 时改用 QueuePool 复用连接，
+      否则仍然每次请求新建连接（NullPool）
+    - ``FLASKY_SQLITE_PRAGMAS`` 中的 PRAGMA 在每个 SQLite 连接上执行
+    - ``FLASKY_SQLITE_OPTIMIZE`` 为真时连接关闭前执行 ``PRAGMA optimize``，
+      进程退出时关闭连接池中的连接
+    - ``FLASKY_DATABASE_REPLICAS`` 中的只读副本由 :class:`RoutingSession`
+      分配读查询
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+        self._tuned = weakref.WeakSet()
+        atexit.register(self.dispose)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_SQLITE_PRAGMAS', {})
+        app.config.setdefault('FLASKY_SQLITE_OPTIMIZE', False)
+        app.config.setdefault('FLASKY_DATABASE_REPLICAS', [])
+        app.config.setdefault('FLASKY_DATABASE_STICKY_SECONDS', 10)
+        super(SQLAlchemy, self).init_app(app)
+        app.before_request(_allow_replica)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if not _is_sqlite_file(info):
+            return
+        if options.get('pool_size'):
+            # 连接会在线程间传递，由连接池保证同一时刻只有一个线程使用
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = \
+                False
+        else:
+            for name in _QUEUE_POOL_OPTIONS:
+                options.pop(name, None)
+
+    def _tune(self, app, engine):
+        self._tuned.add(engine)
+        if _is_sqlite_file(engine.url):
+            tune_sqlite(engine, app.config['FLASKY_SQLITE_PRAGMAS'],
+                        app.config['FLASKY_SQLITE_OPTIMIZE'])
+
+    def get_engine(self, app, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if engine not in self._tuned:
+            with self._engine_lock:
+                if engine not in self._tuned:
+                    self._tune(app, engine)
+        return engine
+
+    def _create_engine(self, app, uri):
+        # 与 Flask-SQLAlchemy 创建主库引擎的方式相同
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        engine = create_engine(info, **options)
+        self._tune(app, engine)
+        return engine
+
+    def get_replicas(self, app):
+        """只读副本的引擎列表，配置变化后重新创建"""
+        state = app.extensions['sqlalchemy']
+        uris = tuple(app.config['FLASKY_DATABASE_REPLICAS'])
+        replicas = getattr(state, 'replicas', None)
+        if replicas is None or replicas[0] != uris:
+            with self._engine_lock:
+                replicas = getattr(state, 'replicas', None)
+                if replicas is None or replicas[0] != uris:
+                    replicas = state.replicas = (uris, [
+                        self._create_engine(app, uri) for uri in uris])
+        return replicas[1]
+
+    @contextmanager
+    def primary(self):
+        """块内的查询都读主库。读到的数据要放进进程内的共享缓存时使用，
+        以免把副本上尚未同步的旧数据缓存下来"""
+        info = self.session.info
+        forced = info.get('force_primary')
+        info['force_primary'] = True
+        try:
+            yield
+        finally:
+            info['force_primary'] = forced
+
+    def read_replica(self):
+        """当前会话是否读过只读副本"""
+        return self.session.info.get('replica') is not None
+
+    @staticmethod
+    def sticky(app):
+        """刚写入过数据、暂时只读主库的 API 用户"""
+        state = app.extensions['sqlalchemy']
+        if getattr(state, 'sticky', None) is None:
+            state.sticky = TTLCache(maxsize=10000)
+        return state.sticky
+
+    def dispose(self):
+        """关闭各引擎连接池中的空闲连接"""
+        for engine in list(self._tuned):
+            engine.dispose()
@@ -1,20 +1,76 @@
-from threading import Thread
-from flask import current_app, render_template
+from functools import partial
+from types import SimpleNamespace
+from flask import current_app, has_request_context, request
 from flask_mail import Message
-from . import mail
+from sqlalchemy import inspect
+from werkzeug.local import LocalProxy
+from . import db, mail_queue
 
+# 预编译的邮件模板所在的目录
+EMAIL_TEMPLATE_DIRS = ('auth/email/', 'mail/')
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+
+class EmailTemplates(object):
+    """启动时编译全部邮件模板并保留编译结果，渲染时不再查找和检查模板文件。
+
+    Jinja 把模板中的静态文本编译成常量，渲染只需拼接变量部分；
+    模板自动重载（调试模式）打开时仍按名字从环境中取，以便修改即时生效。
+    """
+
+    def init_app(self, app):
+        app.extensions['email_templates'] = dict(
+            (name, app.jinja_env.get_template(name))
+            for name in app.jinja_env.list_templates(
+                filter_func=self._is_email_template))
+
+    @staticmethod
+    def _is_email_template(name):
+        return name.startswith(EMAIL_TEMPLATE_DIRS) and \
+            name.endswith(('.txt', '.html'))
+
+    @staticmethod
+    def render(app, name, context):
+        template = None
+        if not app.jinja_env.auto_reload:
+            template = app.extensions['email_templates'].get(name)
+        if template is None:
+            template = app.jinja_env.get_template(name)
+        return template.render(context)
+
+
+email_templates = EmailTemplates()
+
+
+def _snapshot(value):
+    """模型对象换成只含列值的快照，发送线程里读取不依赖请求的会话"""
+    if isinstance(value, LocalProxy):
+        value = value._get_current_object()
+    if not isinstance(value, db.Model):
+        return value
+    state = inspect(value)
+    return SimpleNamespace(**dict(
+        (attr.key, getattr(value, attr.key))
+        for attr in state.mapper.column_attrs
+        if not (state.detached and attr.key in state.unloaded)))
+
+
+def _render(app, url_root, template, context, msg):
+    # 在发送线程中调用；url_for(_external=True) 需要入队时的主机名
+    if url_root is None:
+        ctx = app.app_context()
+    else:
+        ctx = app.test_request_context(base_url=url_root)
+    with ctx:
+        msg.body = EmailTemplates.render(app, template + '.txt', context)
+        msg.html = EmailTemplates.render(app, template + '.html', context)
 
 
 def send_email(to, subject, template, **kwargs):
+    """把邮件交给发送队列，模板在发送线程中渲染。队列已满时返回 False"""
     app = current_app._get_current_object()
     msg = Message(app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
                   sender=app.config['FLASKY_MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    context = dict((key, _snapshot(value)) for key, value in kwargs.items())
+    url_root = request.url_root if has_request_context() else None
+    return mail_queue.send(msg, partial(_render, app, url_root, template,
+                                        context))
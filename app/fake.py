@@ -0,0 +1,213 @@
+import bisect
+import codecs
+import hashlib
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import forgery_py
+from forgery_py.dictionaries_loader import DICTIONARIES_PATH
+from werkzeug.security import generate_password_hash
+from sqlalchemy import func
+from . import db
+from .models import Role, User, Follow, Post, Comment, TimelineEntry
+
+# 关注数和发帖数服从幂律分布的形状参数
+PARETO_ALPHA = 1.5
+
+
+class _Popularity(object):
+    """按 Zipf 分布抽取用户 id，排名靠前的用户被关注和发帖的概率更高"""
+
+    def __init__(self, ids, exponent=1.0):
+        self.ids = list(ids)
+        random.shuffle(self.ids)
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(self.ids) + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def choice(self):
+        r = random.random() * self.cumulative[-1]
+        return self.ids[bisect.bisect(self.cumulative, r)]
+
+
+_dictionaries = {}
+
+
+def _words(*names):
+    # forgery_py.name.first_name() 每次调用都把女性名字追加到缓存的男性名字表上，
+    # 名字表越来越长，同一进程中相同的种子也会生成不同的数据，这里直接读词典文件
+    if names not in _dictionaries:
+        words = []
+        for name in names:
+            with codecs.open(os.path.join(DICTIONARIES_PATH, name),
+                             'r', 'utf-8') as f:
+                words.extend(line.strip() for line in f)
+        _dictionaries[names] = words
+    return _dictionaries[names]
+
+
+def _first_name():
+    return random.choice(_words('male_first_names', 'female_first_names'))
+
+
+def _insert(table, rows, batch_size):
+    """按 batch_size 分批插入，``rows`` 可以是生成器，内存中至多保留一批。
+    返回插入的行数"""
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == batch_size:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        total += len(chunk)
+    return total
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _random_timestamp(start, end):
+    return start + timedelta(
+        seconds=random.random() * (end - start).total_seconds())
+
+
+def _sentences():
+    # 帖子长度近似对数正态分布：多数很短，少数很长
+    count = max(1, int(random.lognormvariate(0.7, 0.9)))
+    return forgery_py.lorem_ipsum.sentences(count)
+
+
+def _render(policy, bodies, executor):
+    chunksize = max(1, len(bodies) // 64)
+    return list(executor.map(policy.render, bodies, chunksize=chunksize))
+
+
+def _sync_sequences():
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in (User, Post, Comment):
+        table = model.__tablename__
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "(SELECT MAX(id) FROM %s))" % (table, table))
+    db.session.commit()
+
+
+def _user_rows(ids, role, password_hash, start, now):
+    for id in ids:
+        email = 'user%d@%s' % (id, forgery_py.internet.domain_name())
+        member_since = _random_timestamp(start, now)
+        yield {
+            'id': id,
+            'email': email,
+            'username': '%s%d' % (_first_name().lower(), id),
+            'role_id': role.id if role else None,
+            'password_hash': password_hash,
+            'confirmed': True,
+            'name': '%s %s' % (_first_name(),
+                               random.choice(_words('last_names'))),
+            'location': forgery_py.address.city(),
+            'about_me': forgery_py.lorem_ipsum.sentence(),
+            'member_since': member_since,
+            'last_seen': _random_timestamp(member_since, now),
+            'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest()
+        }
+
+
+def _follow_rows(ids, popularity, follows, now):
+    # 幂律关注图，外加每个用户关注自己
+    for id in ids:
+        followed = {id}
+        wanted = int(random.paretovariate(PARETO_ALPHA) *
+                     follows * (PARETO_ALPHA - 1) / PARETO_ALPHA)
+        wanted = min(wanted, len(ids) - 1)
+        attempts = 0
+        while len(followed) < wanted + 1 and attempts < wanted * 4:
+            followed.add(popularity.choice())
+            attempts += 1
+        for followed_id in followed:
+            yield {'follower_id': id, 'followed_id': followed_id,
+                   'timestamp': now}
+
+
+def seed(users=1000, posts=10000, comments=30000, follows=20, seed=0,
+         batch_size=5000, workers=None):
+    """批量生成可复现的用户、关注、帖子和评论数据，返回各表写入的行数"""
+    random.seed(seed)
+    now = datetime.utcnow()
+    start = now - timedelta(days=365)
+    role = Role.query.filter_by(default=True).first()
+    password_hash = generate_password_hash('password')
+
+    first_user = _next_id(User)
+    user_ids = range(first_user, first_user + users)
+    _insert(User.__table__, _user_rows(user_ids, role, password_hash,
+                                       start, now), batch_size)
+    popularity = _Popularity(user_ids)
+    follow_count = _insert(Follow.__table__,
+                           _follow_rows(user_ids, popularity, follows, now),
+                           batch_size)
+
+    with ProcessPoolExecutor(workers) as executor:
+        first_post = _next_id(Post)
+        post_timestamps = []
+        for offset in range(0, posts, batch_size):
+            count = min(batch_size, posts - offset)
+            bodies = [_sentences() for i in range(count)]
+            htmls = _render(Post.html_policy, bodies, executor)
+            rows = []
+            for body, html in zip(bodies, htmls):
+                timestamp = _random_timestamp(start, now)
+                post_timestamps.append(timestamp)
+                rows.append({
+                    'id': first_post + len(post_timestamps) - 1,
+                    'body': body,
+                    'body_html': html,
+                    'render_policy': Post.html_policy.version,
+                    'timestamp': timestamp,
+                    'author_id': popularity.choice()
+                })
+            _insert(Post.__table__, rows, batch_size)
+
+        first_comment = _next_id(Comment)
+        for offset in range(0, comments if post_timestamps else 0,
+                            batch_size):
+            count = min(batch_size, comments - offset)
+            bodies = [forgery_py.lorem_ipsum.sentences(random.randint(1, 3))
+                      for i in range(count)]
+            htmls = _render(Comment.html_policy, bodies, executor)
+            rows = []
+            for i, (body, html) in enumerate(zip(bodies, htmls)):
+                index = random.randrange(len(post_timestamps))
+                rows.append({
+                    'id': first_comment + offset + i,
+                    'body': body,
+                    'body_html': html,
+                    'render_policy': Comment.html_policy.version,
+                    'timestamp': _random_timestamp(post_timestamps[index],
+                                                   now),
+                    'disabled': False,
+                    'author_id': random.choice(user_ids),
+                    'post_id': first_post + index
+                })
+            _insert(Comment.__table__, rows, batch_size)
+
+    # 批量写入绕过了模型事件，统一回填冗余计数和时间线
+    _sync_sequences()
+    User.reconcile_counts()
+    Post.reconcile_counts()
+    if TimelineEntry.enabled():
+        TimelineEntry.rebuild()
+    return {'users': users, 'follows': follow_count,
+            'posts': len(post_timestamps),
+            'comments': comments if post_timestamps else 0}
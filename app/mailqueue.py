@@ -0,0 +1,292 @@
+import atexit
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+import weakref
+from queue import Queue, Empty, Full
+from flask import current_app
+from flask_mail import Connection
+from .profiler import Histogram
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+# 已启动的发送线程池，进程退出前把队列里的邮件发完
+_pools = weakref.WeakSet()
+
+
+class _Job(object):
+    __slots__ = ('message', 'prepare', 'enqueued', 'attempts')
+
+    def __init__(self, message, prepare):
+        self.message = message
+        self.prepare = prepare
+        self.enqueued = time.time()
+        # 已经失败的发送次数
+        self.attempts = 0
+
+
+def _code(error):
+    code = getattr(error, 'smtp_code', None)
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        code = min(codes) if codes else None
+    return code
+
+
+def _permanent(error):
+    # 服务器明确拒绝（5xx）的邮件直接放弃，暂时错误（4xx）可以重试
+    code = _code(error)
+    return code is not None and code >= 500
+
+
+def _broken(error):
+    # 连接断开、网络错误或服务器要关闭连接（421）时整批邮件都要换连接重试，
+    # 其余错误只和当前这封邮件有关
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        return _code(error) == 421
+    return isinstance(error, socket.error)
+
+
+class DeliveryPool(object):
+    """固定数量的发送线程从有界队列取邮件。
+
+    每个线程保持一个 SMTP 连接，一次取出队列中积压的多封邮件在同一个连接上
+    发送，空闲超过 ``idle_timeout`` 秒后断开。单封邮件的暂时错误只重试这一封，
+    服务器拒收的邮件不重试；连接错误按指数退避重连，多次失败后把还没发出的
+    邮件放回队列。线程在第一次入队时启动，fork 出的子进程重新启动。
+    """
+
+    def __init__(self, app, workers, maxsize, batch_size, retries, backoff,
+                 idle_timeout, enqueue_timeout):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = Queue(maxsize)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pid = None
+        self.latency = Histogram()
+        self.counts = dict.fromkeys(('enqueued', 'sent', 'failed', 'retried',
+                                     'requeued', 'dropped', 'connections'), 0)
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            _pools.add(self)
+            self.threads = [threading.Thread(target=self._run,
+                                             name='mail-worker-%d' % i)
+                            for i in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        """等队列中的邮件发完后停止发送线程"""
+        threads = [t for t in self.threads if t.is_alive()]
+        for _ in threads:
+            self.queue.put(_STOP)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+        self.pid = None
+
+    def put(self, message, prepare=None):
+        """邮件入队，队列满且等待超时后丢弃并返回 False。
+
+        ``prepare(message)`` 在发送线程中、发送之前调用，用于填充正文。
+        """
+        self.start()
+        try:
+            self.queue.put(_Job(message, prepare),
+                           timeout=self.enqueue_timeout)
+        except Full:
+            self._count('dropped')
+            logger.error('mail queue is full, dropped message to %s',
+                         ', '.join(message.send_to))
+            return False
+        self._count('enqueued')
+        return True
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats.update(depth=self.queue.qsize(),
+                         workers=sum(t.is_alive() for t in self.threads),
+                         mean=self.latency.mean,
+                         p50=self.latency.percentile(50),
+                         p95=self.latency.percentile(95),
+                         max=self.latency.max)
+        return stats
+
+    def _take(self):
+        """阻塞取一封邮件，再顺带取出已经排队的至多 batch_size - 1 封"""
+        batch = [self.queue.get(timeout=self.idle_timeout)]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        connection = None
+        with self.app.app_context():
+            while True:
+                try:
+                    batch = self._take()
+                except Empty:
+                    connection = self._close(connection)
+                    continue
+                stop = batch[-1] is _STOP
+                if stop:
+                    batch.pop()
+                connection = self._deliver(connection, batch)
+                if stop:
+                    self._close(connection)
+                    return
+
+    def _open(self):
+        connection = Connection(self.app.extensions['mail'])
+        connection.__enter__()
+        self._count('connections')
+        return connection
+
+    def _close(self, connection):
+        if connection is not None and connection.host is not None:
+            try:
+                connection.host.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        return None
+
+    def _deliver(self, connection, batch):
+        failures = 0
+        while batch:
+            retry = []
+            try:
+                if connection is None:
+                    connection = self._open()
+                while batch:
+                    job = batch[0]
+                    try:
+                        if job.prepare is not None:
+                            job.prepare(job.message)
+                            job.prepare = None
+                        connection.send(job.message)
+                    except (smtplib.SMTPException, socket.error) as e:
+                        if _broken(e):
+                            raise
+                        if _permanent(e) or job.attempts >= self.retries:
+                            logger.error('mail to %s rejected: %s',
+                                         ', '.join(job.message.send_to), e)
+                            self._count('failed')
+                        else:
+                            job.attempts += 1
+                            self._count('retried')
+                            retry.append(job)
+                    except Exception:
+                        logger.exception('cannot send mail to %s',
+                                         ', '.join(job.message.send_to))
+                        self._count('failed')
+                    else:
+                        self._done(job)
+                    batch.pop(0)
+            except (smtplib.SMTPException, socket.error) as e:
+                connection = self._close(connection)
+                batch.extend(retry)
+                failures += 1
+                if failures > self.retries:
+                    self._requeue(batch, e)
+                    return None
+                self._count('retried', len(batch))
+                time.sleep(self.backoff * 2 ** (failures - 1))
+                continue
+            # 同一批的其他邮件发完后，在同一个连接上重试暂时失败的邮件
+            batch = retry
+            if batch:
+                attempts = max(job.attempts for job in batch)
+                time.sleep(self.backoff * 2 ** (attempts - 1))
+        return connection
+
+    def _requeue(self, jobs, error):
+        """放弃连接时把还能重试的邮件放回队列，由发送线程稍后再发。
+
+        这一批的每封邮件都记一次失败，包括还没轮到发送的，服务器一直连不上
+        时超过重试次数的邮件就此放弃，不会无限地放回队列。
+        """
+        for job in jobs:
+            job.attempts += 1
+            if job.attempts > self.retries:
+                logger.error('giving up on mail to %s: %s',
+                             ', '.join(job.message.send_to), error)
+                self._count('failed')
+                continue
+            try:
+                self.queue.put_nowait(job)
+            except Full:
+                self._count('dropped')
+                logger.error('mail queue is full, dropped message to %s',
+                             ', '.join(job.message.send_to))
+            else:
+                self._count('requeued')
+
+    def _done(self, job):
+        with self.lock:
+            self.counts['sent'] += 1
+            self.latency.add(time.time() - job.enqueued)
+
+
+class MailQueue(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_MAIL_WORKERS', 2)
+        app.config.setdefault('FLASKY_MAIL_QUEUE_SIZE', 1000)
+        app.config.setdefault('FLASKY_MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('FLASKY_MAIL_RETRIES', 3)
+        app.config.setdefault('FLASKY_MAIL_RETRY_BACKOFF', 1.0)
+        app.config.setdefault('FLASKY_MAIL_IDLE_TIMEOUT', 30)
+        app.config.setdefault('FLASKY_MAIL_ENQUEUE_TIMEOUT', 1.0)
+        app.extensions['mail_queue'] = DeliveryPool(
+            app,
+            workers=app.config['FLASKY_MAIL_WORKERS'],
+            maxsize=app.config['FLASKY_MAIL_QUEUE_SIZE'],
+            batch_size=app.config['FLASKY_MAIL_BATCH_SIZE'],
+            retries=app.config['FLASKY_MAIL_RETRIES'],
+            backoff=app.config['FLASKY_MAIL_RETRY_BACKOFF'],
+            idle_timeout=app.config['FLASKY_MAIL_IDLE_TIMEOUT'],
+            enqueue_timeout=app.config['FLASKY_MAIL_ENQUEUE_TIMEOUT'])
+
+    def send(self, message, prepare=None):
+        return current_app.extensions['mail_queue'].put(message, prepare)
+
+    def stats(self):
+        return current_app.extensions['mail_queue'].stats()
+
+
+@atexit.register
+def _drain_mail_queues():
+    for pool in list(_pools):
+        try:
+            pool.stop(timeout=10)
+        except Exception:
+            pass
@@ -1,24 +1,23 @@
 from flask import render_template, redirect, url_for, abort, flash, request, \
     current_app, make_response
 from flask_login import login_required, current_user
-from flask_sqlalchemy import get_debug_queries
+from flask_sqlalchemy import Pagination
 from . import main
 from .forms import EditProfileForm, EditProfileAdminForm, PostForm, \
     CommentForm
-from .. import db
+from .. import db, profiler, mail_queue
 from ..models import Permission, Role, User, Post, Comment
 from ..decorators import admin_required, permission_required
+from ..profiler import BUCKETS
+from ..conditional import conditional, table_version
+from ..page_cache import page_cache
+from ..search import KINDS, search as search_index
 
 
-@main.after_app_request
-def after_request(response):
-    for query in get_debug_queries():
-        if query.duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
-            current_app.logger.warning(
-                'Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n'
-                % (query.statement, query.parameters, query.duration,
-                   query.context))
-    return response
+def paginate_with_total(query, page, per_page, total):
+    # 总数取自冗余计数列，省去 paginate() 里的 COUNT(*)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    return Pagination(query, page, per_page, total, items)
 
 
 @main.route('/shutdown')
@@ -49,10 +48,14 @@ def index():
         query = current_user.followed_posts
     else:
         query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
+    pagination = query.options(*Post.loading('listing'))\
+        .order_by(Post.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     posts = pagination.items
+    conditional(pagination.total, [(p.id, p.updated_at, p.author.updated_at)
+                                   for p in posts])
+    page_cache.tag('posts')
     return render_template('index.html', form=form, posts=posts,
                            show_followed=show_followed, pagination=pagination)
 
@@ -61,10 +64,14 @@ def index():
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate_with_total(
+        user.posts.options(*Post.loading('listing'))
+        .order_by(Post.timestamp.desc()), page,
+        current_app.config['FLASKY_POSTS_PER_PAGE'], user.post_count)
     posts = pagination.items
+    conditional(user.updated_at, user.last_seen, user.comment_count,
+                [(p.id, p.updated_at) for p in posts])
+    page_cache.tag('user:%d' % user.id, 'presence:%d' % user.id)
     return render_template('user.html', user=user, posts=posts,
                            pagination=pagination)
 
@@ -115,7 +122,7 @@ def edit_profile_admin(id):
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = Post.query.options(*Post.loading('listing')).get_or_404(id)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data,
@@ -126,12 +133,17 @@ def post(id):
         return redirect(url_for('.post', id=post.id, page=-1))
     page = request.args.get('page', 1, type=int)
     if page == -1:
-        page = (post.comments.count() - 1) // \
+        page = (post.comment_count - 1) // \
                current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate_with_total(
+        post.comments.options(*Comment.loading('listing'))
+        .order_by(Comment.timestamp.asc()), page,
+        current_app.config['FLASKY_COMMENTS_PER_PAGE'], post.comment_count)
     comments = pagination.items
+    conditional(post.updated_at, post.author.updated_at,
+                [(c.id, c.updated_at, c.author.updated_at) for c in comments])
+    page_cache.tag('post:%d' % post.id,
+                   *['user:%d' % c.author_id for c in comments])
     return render_template('post.html', posts=[post], form=form,
                            comments=comments, pagination=pagination)
 
@@ -192,9 +204,12 @@ def followers(username):
         flash('无此用户！')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate_with_total(
+        user.followers, page, current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
+        user.follower_count)
+    conditional(user.updated_at, table_version(User),
+                [(item.follower_id, item.timestamp)
+                 for item in pagination.items])
     follows = [{'user': item.follower, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, title="关注列表",
@@ -209,9 +224,12 @@ def followed_by(username):
         flash('无此用户！')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate_with_total(
+        user.followed, page, current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
+        user.followed_count)
+    conditional(user.updated_at, table_version(User),
+                [(item.followed_id, item.timestamp)
+                 for item in pagination.items])
     follows = [{'user': item.followed, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, title="被关注列表",
@@ -235,14 +253,30 @@ def show_followed():
     return resp
 
 
+@main.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    type = request.args.get('type', 'posts')
+    if type not in KINDS:
+        abort(404)
+    # 页码直接来自查询参数，小于 1 时按第一页处理，否则 OFFSET 为负
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['FLASKY_SEARCH_RESULTS_PER_PAGE']
+    items, total = search_index(type, q, page, per_page)
+    pagination = Pagination(None, page, per_page, total, items)
+    return render_template('search.html', q=q, type=type, results=items,
+                           pagination=pagination)
+
+
 @main.route('/moderate')
 @login_required
 @permission_required(Permission.MODERATE_COMMENTS)
 def moderate():
     page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    pagination = Comment.query.options(*Comment.loading('listing'))\
+        .order_by(Comment.timestamp.desc()).paginate(
+            page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
+            error_out=False)
     comments = pagination.items
     return render_template('moderate.html', comments=comments,
                            pagination=pagination, page=page)
@@ -268,3 +302,23 @@ def moderate_disable(id):
     db.session.add(comment)
     return redirect(url_for('.moderate',
                             page=request.args.get('page', 1, type=int)))
+
+
+@main.route('/query-profile')
+@login_required
+@admin_required
+def query_profile():
+    return render_template('query_profile.html',
+                           statements=profiler.statements(),
+                           endpoints=profiler.endpoints(),
+                           mail=mail_queue.stats(),
+                           buckets=BUCKETS)
+
+
+@main.route('/query-profile/reset')
+@login_required
+@admin_required
+def reset_query_profile():
+    profiler.reset()
+    flash('查询统计已清空')
+    return redirect(url_for('.query_profile'))
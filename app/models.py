@@ -1,13 +1,31 @@
 from datetime import datetime
+import atexit
 import hashlib
+import threading
+import time
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from markdown import markdown
-import bleach
-from flask import current_app, request, url_for
+from flask import current_app, request
+from flask.signals import Namespace
 from flask_login import UserMixin, AnonymousUserMixin
+from sqlalchemy import and_, bindparam, exists, func, literal, or_, \
+    select
+from sqlalchemy.orm import Session, make_transient_to_detached, \
+    object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from app.exceptions import ValidationError
 from . import db, login_manager
+from .cache import TTLCache
+from .render import RenderPolicy, render_cache
+from .serializers import user_to_json, post_to_json, comment_to_json
+
+# 进程内缓存：角色 id -> 权限位，用户 id -> 身份快照
+role_cache = TTLCache(maxsize=1)
+identity_cache = TTLCache(maxsize=4096)
+
+signals = Namespace()
+# last_seen 写回数据库后发出，参数 ids 为写回的用户 id
+last_seen_flushed = signals.signal('last-seen-flushed')
 
 
 class Permission:
@@ -46,22 +64,308 @@ class Role(db.Model):
             role.default = roles[r][1]
             db.session.add(role)
         db.session.commit()
+        role_cache.clear()
+
+    @staticmethod
+    def permissions_of(role_id):
+        """角色几乎不变，整张表读一次后缓存在进程内"""
+        permissions = role_cache.get('permissions')
+        if permissions is None:
+            with db.primary():
+                permissions = dict(db.session.query(Role.id,
+                                                    Role.permissions))
+            role_cache.set('permissions', permissions,
+                           current_app.config['FLASKY_ROLE_CACHE_TTL'])
+        return permissions.get(role_id) or 0
+
+    @staticmethod
+    def on_changed(mapper, connection, target):
+        role_cache.clear()
 
     def __repr__(self):
         return '<Role %r>' % self.name
 
+db.event.listen(Role, 'after_insert', Role.on_changed)
+db.event.listen(Role, 'after_update', Role.on_changed)
+db.event.listen(Role, 'after_delete', Role.on_changed)
+
+
+def _update_counter(connection, model, id, counter, delta, instance=None):
+    """在 flush 过程中原子地修改冗余计数列，并同步已加载实例上的值"""
+    table = model.__table__
+    column = table.c[counter]
+    connection.execute(table.update().where(table.c.id == id).values(
+        {counter: func.coalesce(column, 0) + delta}))
+    if instance is not None and counter in instance.__dict__:
+        set_committed_value(instance, counter,
+                            (instance.__dict__[counter] or 0) + delta)
+
+
+def _move_counter(connection, target, foreign_key, model, counter):
+    """外键改为指向另一行时，把计数从原来的行移到新的行"""
+    state = db.inspect(target)
+    history = state.attrs[foreign_key].history
+    if not history.has_changes():
+        return
+    old = history.deleted[0] if history.deleted else None
+    new = getattr(target, foreign_key)
+    if old == new:
+        return
+    session = state.session
+    for id, delta in ((old, -1), (new, 1)):
+        if id is None:
+            continue
+        key = model.__mapper__.identity_key_from_primary_key([id])
+        instance = session.identity_map.get(key) \
+            if session is not None else None
+        _update_counter(connection, model, id, counter, delta, instance)
+
+
+def _reconcile_counter(model, counter, foreign_key):
+    """把与实际行数不一致的冗余计数改正，返回改正的行数"""
+    actual = dict(db.session.query(foreign_key, func.count())
+                  .group_by(foreign_key).all())
+    fixes = [{'_id': id, '_count': actual.get(id, 0)}
+             for id, current in db.session.query(model.id,
+                                                 getattr(model, counter))
+             if current != actual.get(id, 0)]
+    if fixes:
+        table = model.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('_id'))
+            .values({counter: bindparam('_count')}), fixes)
+    return len(fixes)
+
+
+class LoadingStrategyMixin(object):
+    # 命名加载策略：策略名 -> 需要 joinedload 的关系路径，如 'author.role'
+    loading_strategies = {}
+
+    @classmethod
+    def loading(cls, strategy):
+        options = []
+        for path in cls.loading_strategies[strategy]:
+            option = None
+            for attr in path.split('.'):
+                if option is None:
+                    option = db.joinedload(attr)
+                else:
+                    option = option.joinedload(attr)
+            options.append(option)
+        return options
+
 
 class Follow(db.Model):
     __tablename__ = 'follows'
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
+    # 主键以 follower_id 开头，按被关注者查粉丝需要单独的索引
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),
-                            primary_key=True)
+                            primary_key=True, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_created(mapper, connection, target):
+        _update_counter(connection, User, target.follower_id,
+                        'followed_count', 1, target.__dict__.get('follower'))
+        _update_counter(connection, User, target.followed_id,
+                        'follower_count', 1, target.__dict__.get('followed'))
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        _update_counter(connection, User, target.follower_id,
+                        'followed_count', -1, target.__dict__.get('follower'))
+        _update_counter(connection, User, target.followed_id,
+                        'follower_count', -1, target.__dict__.get('followed'))
+
+
+db.event.listen(Follow, 'after_insert', Follow.on_created)
+db.event.listen(Follow, 'after_delete', Follow.on_deleted)
+
+
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entries'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
+                        primary_key=True, index=True)
+
+    @staticmethod
+    def enabled():
+        return current_app.config['FLASKY_TIMELINE_STORE']
+
+    @staticmethod
+    def _follower_count(connection, author_id):
+        users = User.__table__
+        return connection.execute(
+            select([users.c.follower_count])
+            .where(users.c.id == author_id)).scalar() or 0
+
+    @staticmethod
+    def fans_out(connection, author_id):
+        # 粉丝数超过阈值的作者不做写扩散，而是在读取时合并
+        return TimelineEntry._follower_count(connection, author_id) <= \
+            current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def on_post_created(mapper, connection, target):
+        if not TimelineEntry.enabled() or \
+                not TimelineEntry.fans_out(connection, target.author_id):
+            return
+        follows = Follow.__table__
+        connection.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id'],
+            select([follows.c.follower_id, literal(target.id)])
+            .where(follows.c.followed_id == target.author_id)))
+
+    @staticmethod
+    def on_post_deleted(mapper, connection, target):
+        if TimelineEntry.enabled():
+            entries = TimelineEntry.__table__
+            connection.execute(
+                entries.delete().where(entries.c.post_id == target.id))
+
+    # 关注和取消关注的监听器在 Follow 的计数监听器之后执行，
+    # 读到的粉丝数已经包含这次修改
+
+    @staticmethod
+    def on_follow_created(mapper, connection, target):
+        if not TimelineEntry.enabled():
+            return
+        entries = TimelineEntry.__table__
+        posts = Post.__table__
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+        count = TimelineEntry._follower_count(connection, target.followed_id)
+        if count > limit:
+            if count == limit + 1:
+                # 刚超过阈值，作者的帖子改为读取时合并，删除已经扩散的条目
+                connection.execute(entries.delete().where(
+                    entries.c.post_id.in_(
+                        select([posts.c.id])
+                        .where(posts.c.author_id == target.followed_id))))
+            return
+        connection.execute(entries.insert().from_select(
+            ['user_id', 'post_id'],
+            select([literal(target.follower_id), posts.c.id])
+            .where(posts.c.author_id == target.followed_id)))
+
+    @staticmethod
+    def on_follow_deleted(mapper, connection, target):
+        if not TimelineEntry.enabled():
+            return
+        entries = TimelineEntry.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        connection.execute(entries.delete().where(
+            (entries.c.user_id == target.follower_id) &
+            entries.c.post_id.in_(
+                select([posts.c.id])
+                .where(posts.c.author_id == target.followed_id))))
+        if TimelineEntry._follower_count(connection, target.followed_id) == \
+                current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']:
+            # 刚回到阈值以内，不再在读取时合并，把作者的帖子扩散给现有的粉丝
+            connection.execute(entries.insert().from_select(
+                ['user_id', 'post_id'],
+                select([follows.c.follower_id, posts.c.id])
+                .select_from(follows.join(
+                    posts, posts.c.author_id == follows.c.followed_id))
+                .where(follows.c.followed_id == target.followed_id)))
+
+    @staticmethod
+    def timeline(user):
+        stored = Post.query.join(TimelineEntry,
+                                 TimelineEntry.post_id == Post.id)\
+            .filter(TimelineEntry.user_id == user.id)
+        merged = Post.query.join(Follow, Follow.followed_id == Post.author_id)\
+            .join(User, User.id == Follow.followed_id)\
+            .filter(Follow.follower_id == user.id)\
+            .filter(User.follower_count >
+                    current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT'])
+        return stored.union(merged)
 
-class User(UserMixin, db.Model):
+    @staticmethod
+    def rebuild():
+        entries = TimelineEntry.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        users = User.__table__
+        db.session.execute(entries.delete())
+        db.session.execute(entries.insert().from_select(
+            ['user_id', 'post_id'],
+            select([follows.c.follower_id, posts.c.id])
+            .select_from(follows
+                         .join(posts, posts.c.author_id == follows.c.followed_id)
+                         .join(users, users.c.id == follows.c.followed_id))
+            .where(func.coalesce(users.c.follower_count, 0) <=
+                   current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT'])))
+        db.session.commit()
+        return TimelineEntry.query.count()
+
+
+db.event.listen(Follow, 'after_insert', TimelineEntry.on_follow_created)
+db.event.listen(Follow, 'after_delete', TimelineEntry.on_follow_deleted)
+
+
+class LastSeenBuffer(object):
+    """暂存待写入的 last_seen，每隔一个周期或攒满一批后用一条批量 UPDATE 写回。
+
+    写回使用独立的连接和事务，只读请求的会话不会因此变成写事务。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+
+    def add(self, engine, id, timestamp, interval, batch_size):
+        with self.lock:
+            self.pending.setdefault(engine, {})[id] = timestamp
+            due = time.time() - self.last_flush >= interval or \
+                len(self.pending[engine]) >= batch_size
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        users = User.__table__
+        # 只往后推进，晚到的旧时间戳不会覆盖新值；
+        # 访问时间不算资料修改，保持 updated_at 不变
+        statement = users.update()\
+            .where(users.c.id == bindparam('_id'))\
+            .where(or_(users.c.last_seen.is_(None),
+                       users.c.last_seen < bindparam('_last_seen')))\
+            .values(last_seen=bindparam('_last_seen'),
+                    updated_at=users.c.updated_at)
+        total = 0
+        for engine, timestamps in pending.items():
+            with engine.begin() as connection:
+                connection.execute(statement, [
+                    {'_id': id, '_last_seen': timestamp}
+                    for id, timestamp in timestamps.items()])
+            total += len(timestamps)
+            last_seen_flushed.send(self, ids=list(timestamps))
+        return total
+
+
+last_seen_buffer = LastSeenBuffer()
+
+
+@atexit.register
+def _flush_last_seen():
+    try:
+        last_seen_buffer.flush()
+    except Exception:
+        pass
+
+
+class User(UserMixin, LoadingStrategyMixin, db.Model):
     __tablename__ = 'users'
+    # 身份验证和权限判断用到的列，缓存的用户快照只保存这些
+    identity_columns = ('id', 'email', 'username', 'role_id',
+                        'password_hash', 'confirmed', 'avatar_hash',
+                        'last_seen')
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(64), unique=True, index=True)
     username = db.Column(db.String(64), unique=True, index=True)
@@ -73,7 +377,14 @@ class User(UserMixin, db.Model):
     about_me = db.Column(db.Text())
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
+    # 条件请求据此计算 ETag，Core 的 UPDATE 同样会刷新它
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
+    post_count = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0)
+    follower_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     followed = db.relationship('Follow',
                                foreign_keys=[Follow.follower_id],
@@ -117,6 +428,21 @@ class User(UserMixin, db.Model):
                 db.session.add(user)
                 db.session.commit()
 
+    @staticmethod
+    def reconcile_counts():
+        fixed = {
+            'post_count': _reconcile_counter(User, 'post_count',
+                                             Post.author_id),
+            'comment_count': _reconcile_counter(User, 'comment_count',
+                                                Comment.author_id),
+            'follower_count': _reconcile_counter(User, 'follower_count',
+                                                 Follow.followed_id),
+            'followed_count': _reconcile_counter(User, 'followed_count',
+                                                 Follow.follower_id)
+        }
+        db.session.commit()
+        return fixed
+
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
         if self.role is None:
@@ -195,16 +521,39 @@ class User(UserMixin, db.Model):
         db.session.add(self)
         return True
 
+    @property
+    def permissions(self):
+        # 已加载的 role 可能尚未写入 role_id，优先使用
+        role = self.__dict__.get('role')
+        if role is not None:
+            return role.permissions or 0
+        if self.role_id is None:
+            return 0
+        return Role.permissions_of(self.role_id)
+
     def can(self, permissions):
-        return self.role is not None and \
-            (self.role.permissions & permissions) == permissions
+        return (self.permissions & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
+        now = datetime.utcnow()
+        if self.id is None:
+            self.last_seen = now
+            db.session.add(self)
+            return
+        resolution = current_app.config['FLASKY_LAST_SEEN_RESOLUTION']
+        if self.last_seen is not None and \
+                (now - self.last_seen).total_seconds() < resolution:
+            return
+        # 不标记为脏数据，由 last_seen_buffer 批量写回
+        set_committed_value(self, 'last_seen', now)
+        # 身份快照中只有最近在线时间变了，就地更新，不必重新加载
+        identity_cache.update(self.id, {'last_seen': now})
+        last_seen_buffer.add(db.get_engine(current_app), self.id, now,
+                             resolution,
+                             current_app.config['FLASKY_LAST_SEEN_BATCH'])
 
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
@@ -236,21 +585,16 @@ class User(UserMixin, db.Model):
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id)\
-            .filter(Follow.follower_id == self.id)
+        if TimelineEntry.enabled():
+            return TimelineEntry.timeline(self)
+        # 用 EXISTS 而不是联结 follows：按 posts.timestamp 的索引倒序扫描，
+        # 凑够一页即停，不必取出所有关注对象的帖子再排序
+        return Post.query.filter(exists().where(and_(
+            Follow.follower_id == self.id,
+            Follow.followed_id == Post.author_id)))
 
     def to_json(self):
-        json_user = {
-            'url': url_for('api.get_user', id=self.id, _external=True),
-            'username': self.username,
-            'member_since': self.member_since,
-            'last_seen': self.last_seen,
-            'posts': url_for('api.get_user_posts', id=self.id, _external=True),
-            'followed_posts': url_for('api.get_user_followed_posts',
-                                      id=self.id, _external=True),
-            'post_count': self.posts.count()
-        }
-        return json_user
+        return user_to_json(self)
 
     def generate_auth_token(self, expiration):
         s = Serializer(current_app.config['SECRET_KEY'],
@@ -266,10 +610,74 @@ class User(UserMixin, db.Model):
             return None
         return User.query.get(data['id'])
 
+    @staticmethod
+    def auth_token_expiration(token):
+        s = Serializer(current_app.config['SECRET_KEY'])
+        try:
+            data, header = s.loads(token, return_header=True)
+        except:
+            return None
+        return header.get('exp')
+
+    def snapshot(self):
+        return dict((key, getattr(self, key)) for key in self.identity_columns)
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        """把缓存的快照合并进当前会话而不发出查询，其余的列在首次访问时加载"""
+        user = User.__mapper__.class_manager.new_instance()
+        for key, value in snapshot.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def load_cached(id):
+        """按 id 加载用户，优先使用进程内的身份快照。
+
+        快照合并进会话后，同一请求内再按 id 取用户会直接命中会话的标识映射。
+        """
+        snapshot = identity_cache.get(id)
+        if snapshot is not None:
+            return User.from_snapshot(snapshot)
+        # 快照供之后的请求使用，从主库读取
+        with db.primary():
+            user = User.query.get(id)
+        if user is not None:
+            identity_cache.set(id, user.snapshot(),
+                               current_app.config['FLASKY_IDENTITY_CACHE_TTL'])
+        return user
+
+    @staticmethod
+    def on_changed_identity(mapper, connection, target):
+        # 先记在会话上，提交成功后再删除快照，以免其他请求在提交之前
+        # 又把旧数据读进缓存；回滚的修改不影响缓存
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('identity_ids', set()).add(target.id)
+
     def __repr__(self):
         return '<User %r>' % self.username
 
 
+db.event.listen(User, 'after_insert', User.on_changed_identity)
+db.event.listen(User, 'after_update', User.on_changed_identity)
+
+
+def _discard_identities(session):
+    for id in session.info.pop('identity_ids', ()):
+        identity_cache.delete(id)
+
+
+def _keep_identities(session):
+    session.info.pop('identity_ids', None)
+
+
+db.event.listen(Session, 'after_commit', _discard_identities)
+db.event.listen(Session, 'after_rollback', _keep_identities)
+db.event.listen(User, 'after_delete', User.on_changed_identity)
+
+
 class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
         return False
@@ -282,17 +690,40 @@ login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return User.load_cached(int(user_id))
 
 
-class Post(db.Model):
+class Post(LoadingStrategyMixin, db.Model):
     __tablename__ = 'posts'
+    # 用户主页按作者筛选、按时间排序
+    __table_args__ = (
+        db.Index('ix_posts_author_id_timestamp', 'author_id', 'timestamp'),
+    )
+    # 帖子页和列表用同一个条目模板，不需要单独的策略
+    loading_strategies = {
+        'listing': ('author',)
+    }
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # 条件请求据此计算 ETag，Core 的 UPDATE 同样会刷新它
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    # 修改时先加载旧值，after_update 据此把计数移到新作者
+    author_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('users.id')), active_history=True)
+    render_policy = db.Column(db.String(16))
+    comment_count = db.Column(db.Integer, default=0)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
+    html_policy = RenderPolicy(
+        tags=['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+              'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+              'h1', 'h2', 'h3', 'p', 'img', 'button', 'table', 'time',
+              'font'],
+        attributes=['src', 'style', 'color', 'href'],
+        styles=['color', 'font-weight'],
+        protocols=['http', 'https', 'mailto', 'ed2k', 'thunder'])
 
     @staticmethod
     def generate_fake(count=100):
@@ -310,95 +741,80 @@ class Post(db.Model):
             db.session.commit()
 
     @staticmethod
-    def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p','img','button','table','time','font']
-        allowed_attributes = ['src','style','color','href']
-        allowed_styles = ['color','font-weight']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags,attributes=allowed_attributes,styles=allowed_styles, strip=True,
-            protocols = ['http', 'https', 'mailto','ed2k','thunder']))
-
-    def to_json(self):
-        json_post = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id,
-                              _external=True),
-            'comments': url_for('api.get_post_comments', id=self.id,
-                                _external=True),
-            'comment_count': self.comments.count()
+    def reconcile_counts():
+        fixed = {
+            'comment_count': _reconcile_counter(Post, 'comment_count',
+                                                Comment.post_id)
         }
-        return json_post
+        db.session.commit()
+        return fixed
 
     @staticmethod
-    def from_json(json_post):
-        body = json_post.get('body')
-        if body is None or body == '':
-            raise ValidationError('post does not have a body')
-        return Post(body=body)
+    def on_created(mapper, connection, target):
+        _update_counter(connection, User, target.author_id, 'post_count', 1,
+                        target.__dict__.get('author'))
 
-
-    def to_json(self):
-        json_post = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id,
-                              _external=True),
-            'comments': url_for('api.get_post_comments', id=self.id,
-                                _external=True),
-            'comment_count': self.comments.count()
-        }
-        return json_post
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        _update_counter(connection, User, target.author_id, 'post_count', -1,
+                        target.__dict__.get('author'))
 
     @staticmethod
-    def from_json(json_post):
-        body = json_post.get('body')
-        if body is None or body == '':
-            raise ValidationError('post does not have a body')
-        return Post(body=body)
+    def on_updated(mapper, connection, target):
+        _move_counter(connection, target, 'author_id', User, 'post_count')
 
+    @staticmethod
+    def on_changed_body(target, value, oldvalue, initiator):
+        target.body_html = render_cache.render(value, Post.html_policy)
+        target.render_policy = Post.html_policy.version
 
     def to_json(self):
-        json_post = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id,
-                              _external=True),
-            'comments': url_for('api.get_post_comments', id=self.id,
-                                _external=True),
-            'comment_count': self.comments.count()
-        }
-        return json_post
+        return post_to_json(self)
 
     @staticmethod
     def from_json(json_post):
         body = json_post.get('body')
         if body is None or body == '':
             raise ValidationError('post does not have a body')
+        if not isinstance(body, str):
+            raise ValidationError('post body must be a string')
         return Post(body=body)
 
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post, 'after_insert', Post.on_created)
+db.event.listen(Post, 'after_delete', Post.on_deleted)
+db.event.listen(Post, 'after_update', Post.on_updated)
+db.event.listen(Post, 'after_insert', TimelineEntry.on_post_created)
+db.event.listen(Post, 'after_delete', TimelineEntry.on_post_deleted)
 
 
-class Comment(db.Model):
+class Comment(LoadingStrategyMixin, db.Model):
     __tablename__ = 'comments'
+    # 帖子页按帖子筛选、按时间排序
+    __table_args__ = (
+        db.Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp'),
+    )
+    loading_strategies = {
+        'listing': ('author',)
+    }
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # 条件请求据此计算 ETag，Core 的 UPDATE 同样会刷新它
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     disabled = db.Column(db.Boolean)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    # 修改时先加载旧值，after_update 据此把计数移到新的作者和帖子
+    author_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('users.id'), index=True),
+        active_history=True)
+    post_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('posts.id')), active_history=True)
+    render_policy = db.Column(db.String(16))
+    html_policy = RenderPolicy(
+        tags=['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong'])
 
     @staticmethod
     def generate_fake(count:'生成数量'=100,post_id:'要添加评论的帖子id，该值默认-1表示所有帖子随机添加'=-1) -> '无返回值':
@@ -423,30 +839,42 @@ class Comment(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                        'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = render_cache.render(value, Comment.html_policy)
+        target.render_policy = Comment.html_policy.version
+
+    @staticmethod
+    def on_created(mapper, connection, target):
+        _update_counter(connection, Post, target.post_id, 'comment_count', 1,
+                        target.__dict__.get('post'))
+        _update_counter(connection, User, target.author_id, 'comment_count',
+                        1, target.__dict__.get('author'))
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        _update_counter(connection, Post, target.post_id, 'comment_count', -1,
+                        target.__dict__.get('post'))
+        _update_counter(connection, User, target.author_id, 'comment_count',
+                        -1, target.__dict__.get('author'))
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        _move_counter(connection, target, 'post_id', Post, 'comment_count')
+        _move_counter(connection, target, 'author_id', User, 'comment_count')
 
     def to_json(self):
-        json_comment = {
-            'url': url_for('api.get_comment', id=self.id, _external=True),
-            'post': url_for('api.get_post', id=self.post_id, _external=True),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id,
-                              _external=True),
-        }
-        return json_comment
+        return comment_to_json(self)
 
     @staticmethod
     def from_json(json_comment):
         body = json_comment.get('body')
         if body is None or body == '':
             raise ValidationError('comment does not have a body')
+        if not isinstance(body, str):
+            raise ValidationError('comment body must be a string')
         return Comment(body=body)
 
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_created)
+db.event.listen(Comment, 'after_delete', Comment.on_deleted)
+db.event.listen(Comment, 'after_update', Comment.on_updated)
@@ -0,0 +1,168 @@
+from flask import Markup, current_app, g, has_app_context, \
+    render_template, request, session
+from flask_login import current_user
+from sqlalchemy.orm import Session, object_session
+from . import db
+from .cache import TaggedCache
+from .database import use_primary
+from .models import User, Post, Comment, Follow, last_seen_flushed
+
+
+class PageCache(object):
+    """匿名用户的整页缓存和帖子条目的片段缓存。
+
+    条目不设过期时间，只在相关数据提交后按标签失效：视图和片段渲染时
+    用 :meth:`tag` 记下页面依赖的数据，模型的写事件在会话提交后失效
+    带有对应标签的页面和片段。缓存在进程内，多进程部署时各自失效。
+    要写入缓存的页面读主库，读过只读副本的片段不写入缓存。
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_PAGE_CACHE_SIZE', 512)
+        app.config.setdefault('FLASKY_FRAGMENT_CACHE_SIZE', 4096)
+        app.config.setdefault('FLASKY_PAGE_CACHE_ENDPOINTS',
+                              ('main.index', 'main.user', 'main.post'))
+        app.extensions['page_cache'] = TaggedCache(
+            app.config['FLASKY_PAGE_CACHE_SIZE'])
+        app.extensions['fragment_cache'] = TaggedCache(
+            app.config['FLASKY_FRAGMENT_CACHE_SIZE'])
+        app.before_request(self._serve)
+        app.after_request(self._store)
+        app.add_template_global(post_fragment)
+
+    @staticmethod
+    def tag(*tags):
+        """给正在渲染的页面加上失效标签"""
+        g.setdefault('cache_tags', set()).update(tags)
+
+    @staticmethod
+    def _cacheable():
+        # 只缓存匿名用户的 GET 页面，有闪现消息的页面只显示一次，不能缓存
+        return request.method == 'GET' and \
+            request.endpoint in \
+            current_app.config['FLASKY_PAGE_CACHE_ENDPOINTS'] and \
+            not current_user.is_authenticated and \
+            not session.get('_flashes')
+
+    def _serve(self):
+        if not self._cacheable():
+            return
+        cache = current_app.extensions['page_cache']
+        entry = cache.get(request.url)
+        if entry is None:
+            g.page_cache = (request.url, cache.generation)
+            # 缓存的页面没有过期时间，不能用副本上的旧数据渲染
+            use_primary()
+            return
+        body, status, headers = entry
+        response = current_app.response_class(body, status, headers)
+        return response.make_conditional(request)
+
+    @staticmethod
+    def _store(response):
+        key, generation = g.pop('page_cache', (None, None))
+        tags = g.pop('cache_tags', ())
+        # 会话被修改的响应会带上 Set-Cookie，不能给其他用户
+        if key is None or response.status_code != 200 or \
+                response.direct_passthrough or session.modified:
+            return response
+        current_app.extensions['page_cache'].set(
+            key, (response.get_data(), response.status_code,
+                  list(response.headers)), tags, generation)
+        return response
+
+
+page_cache = PageCache()
+
+
+def post_fragment(post):
+    """渲染帖子列表中的一个条目，按浏览者能看到的编辑链接分别缓存"""
+    if current_user == post.author:
+        viewer = 'author'
+    elif current_user.is_administrator():
+        viewer = 'admin'
+    else:
+        viewer = 'other'
+    tags = ('post:%d' % post.id, 'user:%d' % post.author_id)
+    PageCache.tag(*tags)
+    # 条目中的链接与蓝本和协议有关
+    key = (post.id, viewer, request.blueprint, request.is_secure)
+    cache = current_app.extensions['fragment_cache']
+    html = cache.get(key)
+    if html is None:
+        generation = cache.generation
+        html = Markup(render_template('_post.html', post=post))
+        # 帖子读自只读副本时可能是旧数据，不缓存
+        if not db.read_replica():
+            cache.set(key, html, tags, generation)
+    return html
+
+
+def invalidate(*tags):
+    """失效当前应用中带有任一标签的页面和片段"""
+    if not has_app_context():
+        return
+    for name in ('page_cache', 'fragment_cache'):
+        cache = current_app.extensions.get(name)
+        if cache is not None:
+            cache.invalidate(*tags)
+
+
+def _collect(target, *tags):
+    # 先记在会话上，提交成功后再失效，回滚的修改不影响缓存
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def _related(target, foreign_key, prefix):
+    # 外键修改时，原来和现在指向的对象都受影响
+    history = db.inspect(target).attrs[foreign_key].history
+    ids = set(history.deleted)
+    ids.add(getattr(target, foreign_key))
+    return ['%s:%d' % (prefix, id) for id in ids if id is not None]
+
+
+def _post_changed(mapper, connection, target):
+    _collect(target, 'posts', 'post:%d' % target.id,
+             *_related(target, 'author_id', 'user'))
+
+
+def _comment_changed(mapper, connection, target):
+    # 包括评论的屏蔽和恢复；用户页显示作者的评论数
+    _collect(target, *(_related(target, 'post_id', 'post') +
+                       _related(target, 'author_id', 'user')))
+
+
+def _user_changed(mapper, connection, target):
+    _collect(target, 'user:%d' % target.id)
+
+
+def _follow_changed(mapper, connection, target):
+    _collect(target, 'user:%d' % target.follower_id,
+             'user:%d' % target.followed_id)
+
+
+for model, listener in ((Post, _post_changed), (Comment, _comment_changed),
+                        (User, _user_changed), (Follow, _follow_changed)):
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        db.event.listen(model, name, listener)
+
+
+def _after_commit(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        invalidate(*tags)
+
+
+def _after_rollback(session):
+    session.info.pop('cache_tags', None)
+
+
+db.event.listen(Session, 'after_commit', _after_commit)
+db.event.listen(Session, 'after_rollback', _after_rollback)
+
+
+@last_seen_flushed.connect
+def _last_seen_flushed(sender, ids):
+    invalidate(*['presence:%d' % id for id in ids])
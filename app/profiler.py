@@ -0,0 +1,223 @@
+import bisect
+import random
+import re
+import threading
+import time
+from flask import current_app, g, has_app_context, has_request_context, \
+    request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 直方图各桶的上界，单位毫秒，最后一个桶收集更慢的语句
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+')
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """把 SQL 中的字面量和参数占位符统一替换成 ``?``，IN 列表折叠成一项"""
+    statement = _STRING.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _IN_LIST.sub('IN (?)', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.buckets[bisect.bisect_left(BUCKETS, duration * 1000)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """返回百分位所在桶的上界（秒），落在最后一个桶时返回最大值"""
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(bound / 1000.0, self.max)
+        return self.max
+
+
+class _Statement(object):
+    def __init__(self):
+        self.histogram = Histogram()
+        self.example = None
+        self.plan = None
+
+
+class _Endpoint(object):
+    def __init__(self):
+        self.requests = Histogram()
+        self.queries = 0
+        self.statements = {}
+
+
+class _ProfilerState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.endpoints = {}
+
+
+class QueryProfiler(object):
+    """抽样统计请求中的 SQL 语句。
+
+    按 ``FLASKY_PROFILER_SAMPLE_RATE`` 的比例抽取请求，把语句归一化成指纹，
+    分别按指纹和端点累计次数、总耗时和延迟直方图。慢查询无论是否抽中
+    都会写入日志。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_PROFILER_SAMPLE_RATE', 0.0)
+        app.config.setdefault('FLASKY_PROFILER_EXPLAIN_LIMIT', 10)
+        app.extensions['query_profiler'] = _ProfilerState()
+        app.before_request(self._start_request)
+        app.teardown_request(self._finish_request)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+
+    @staticmethod
+    def _start_request():
+        rate = current_app.config['FLASKY_PROFILER_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            g._profiled_queries = []
+
+    @staticmethod
+    def _finish_request(exc=None):
+        queries = g.pop('_profiled_queries', None)
+        if queries is None:
+            return
+        state = current_app.extensions['query_profiler']
+        samples = [(fingerprint(statement), statement, parameters, engine,
+                    duration)
+                   for statement, parameters, engine, duration in queries]
+        with state.lock:
+            endpoint = state.endpoints.setdefault(
+                request.endpoint or '<unmatched>', _Endpoint())
+            endpoint.requests.add(sum(sample[-1] for sample in samples))
+            endpoint.queries += len(samples)
+            for key, statement, parameters, engine, duration in samples:
+                stats = state.statements.setdefault(key, _Statement())
+                if duration >= stats.histogram.max and \
+                        statement.lstrip()[:6].upper() == 'SELECT':
+                    # 只为查询语句保留参数，写操作的参数可能含有敏感数据
+                    stats.example = (statement, parameters, engine)
+                stats.histogram.add(duration)
+                endpoint.statements.setdefault(key, Histogram()).add(duration)
+
+    def reset(self, app=None):
+        app = app or current_app._get_current_object()
+        app.extensions['query_profiler'] = _ProfilerState()
+
+    def statements(self, limit=None, explain=True):
+        """按总耗时从高到低返回语句指纹的统计，并为最耗时的几条生成执行计划"""
+        state = current_app.extensions['query_profiler']
+        if limit is None:
+            limit = current_app.config['FLASKY_PROFILER_EXPLAIN_LIMIT']
+        with state.lock:
+            ranked = sorted(state.statements.items(),
+                            key=lambda item: item[1].histogram.total,
+                            reverse=True)
+        result = []
+        for i, (key, stats) in enumerate(ranked):
+            if explain and i < limit and stats.plan is None and \
+                    stats.example is not None:
+                stats.plan = _explain(*stats.example)
+            histogram = stats.histogram
+            result.append({
+                'fingerprint': key,
+                'count': histogram.count,
+                'total': histogram.total,
+                'mean': histogram.mean,
+                'p50': histogram.percentile(50),
+                'p95': histogram.percentile(95),
+                'max': histogram.max,
+                'buckets': list(histogram.buckets),
+                'plan': stats.plan
+            })
+        return result
+
+    def endpoints(self, top=3):
+        """按数据库总耗时从高到低返回各端点的统计"""
+        state = current_app.extensions['query_profiler']
+        result = []
+        with state.lock:
+            for name, stats in state.endpoints.items():
+                statements = sorted(stats.statements.items(),
+                                    key=lambda item: item[1].total,
+                                    reverse=True)[:top]
+                result.append({
+                    'endpoint': name,
+                    'requests': stats.requests.count,
+                    'queries': stats.queries / float(stats.requests.count),
+                    'total': stats.requests.total,
+                    'mean': stats.requests.mean,
+                    'p95': stats.requests.percentile(95),
+                    'statements': [(key, h.count, h.total)
+                                   for key, h in statements]
+                })
+        result.sort(key=lambda item: item['total'], reverse=True)
+        return result
+
+
+def _explain(statement, parameters, engine):
+    if engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    try:
+        with engine.connect() as conn:
+            rows = conn.execution_options(profiler_skip=True).execute(
+                prefix + statement, parameters).fetchall()
+    except Exception as e:
+        return 'EXPLAIN failed: %s' % e
+    return '\n'.join(' | '.join(str(value) for value in row) for row in rows)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    if not has_app_context() or \
+            'query_profiler' not in current_app.extensions or \
+            (context is not None and
+             context.execution_options.get('profiler_skip')):
+        return
+    if duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
+        current_app.logger.warning(
+            'Slow query: %s\nParameters: %s\nDuration: %fs\nEndpoint: %s\n'
+            % (statement, parameters, duration,
+               request.endpoint if has_request_context() else None))
+    if has_request_context():
+        queries = g.get('_profiled_queries')
+        if queries is not None:
+            queries.append((statement, parameters, conn.engine, duration))
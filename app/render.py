@@ -0,0 +1,104 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from markdown import markdown
+import bleach
+from sqlalchemy import or_
+from . import db
+
+
+class RenderPolicy(object):
+    """markdown 渲染后用 bleach 清理的规则，未给出的项沿用 bleach 的默认值。
+
+    ``version`` 是规则内容的摘要，写入每行的 render_policy 列，
+    规则修改后据此找出需要重新渲染的旧数据。
+    """
+
+    def __init__(self, tags, attributes=None, styles=None, protocols=None):
+        self.tags = tags
+        self.attributes = attributes
+        self.styles = styles
+        self.protocols = protocols
+        spec = json.dumps([tags, attributes, styles, protocols],
+                          sort_keys=True)
+        self.version = hashlib.sha1(spec.encode('utf-8')).hexdigest()[:12]
+
+    def render(self, body):
+        options = {'tags': self.tags, 'strip': True}
+        if self.attributes is not None:
+            options['attributes'] = self.attributes
+        if self.styles is not None:
+            options['styles'] = self.styles
+        if self.protocols is not None:
+            options['protocols'] = self.protocols
+        return bleach.linkify(bleach.clean(
+            markdown(body, output_format='html'), **options))
+
+
+class RenderCache(object):
+    """以 (规则版本, 正文摘要) 为键的 LRU 缓存，相同正文只渲染一次"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(body, policy):
+        digest = hashlib.sha1(body.encode('utf-8')).hexdigest()
+        return policy.version + ':' + digest
+
+    def render(self, body, policy):
+        key = self.key(body, policy)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = policy.render(body)
+        with self._lock:
+            self._entries[key] = html
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+render_cache = RenderCache()
+
+
+def rerender(model, batch_size=500, workers=None):
+    """用多进程分批重新渲染 render_policy 不是当前版本的行，返回处理的行数"""
+    policy = model.html_policy
+    stale = or_(model.render_policy.is_(None),
+                model.render_policy != policy.version)
+    last_id = 0
+    total = 0
+    with ProcessPoolExecutor(workers) as executor:
+        while True:
+            rows = db.session.query(model.id, model.body)\
+                .filter(stale, model.id > last_id)\
+                .order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            bodies = [row.body or '' for row in rows]
+            htmls = executor.map(policy.render, bodies,
+                                 chunksize=max(1, len(rows) // 32))
+            db.session.bulk_update_mappings(model, [
+                {'id': row.id, 'body_html': html,
+                 'render_policy': policy.version}
+                for row, html in zip(rows, htmls)])
+            db.session.commit()
+            last_id = rows[-1].id
+            total += len(rows)
+    return total
@@ -0,0 +1,270 @@
+import math
+import re
+from collections import Counter, OrderedDict
+from html import unescape
+from flask import current_app, has_app_context
+from sqlalchemy import and_, case, func, select, text
+from . import db
+from .models import Post, Comment
+
+# 文档编号 = 对象 id * 2 + 类型，帖子和评论共用一个索引，按编号删除很快
+KINDS = {'posts': (0, Post), 'comments': (1, Comment)}
+
+# 中日韩文字没有空格分词，按单字和相邻两字（bigram）建索引
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+_TOKEN = re.compile('([%s]+)|([^\\W_%s]+)' % (_CJK, _CJK))
+_TAG = re.compile(r'<[^>]+>')
+MAX_TERM_LENGTH = 64
+
+
+def plain_text(html):
+    return unescape(_TAG.sub(' ', html or ''))
+
+
+def index_tokens(text):
+    """建索引用的词：拉丁文字按词，中日韩文字取每个字和每两个相邻的字"""
+    for cjk, word in _TOKEN.findall(text.lower()):
+        if cjk:
+            for i, char in enumerate(cjk):
+                yield char
+                if i + 1 < len(cjk):
+                    yield cjk[i:i + 2]
+        else:
+            yield word[:MAX_TERM_LENGTH]
+
+
+def query_tokens(text):
+    """查询用的词：连续的中日韩文字只取相邻两字，单独一个字才用单字"""
+    tokens = []
+    for cjk, word in _TOKEN.findall(text.lower()):
+        if len(cjk) == 1:
+            tokens.append(cjk)
+        elif cjk:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append(word[:MAX_TERM_LENGTH])
+    # 去重并保持顺序，Python 3.5 的 dict 不保证顺序
+    return list(OrderedDict.fromkeys(tokens))
+
+
+class SearchTerm(db.Model):
+    """不支持 FTS5 时使用的倒排索引，每行是一个词在一篇文档中的词频"""
+    __tablename__ = 'search_terms'
+    term = db.Column(db.String(MAX_TERM_LENGTH), primary_key=True)
+    doc = db.Column(db.Integer, primary_key=True, index=True)
+    tf = db.Column(db.Integer, nullable=False)
+
+
+class SearchCount(db.Model):
+    """倒排索引中每类文档的篇数，计算 IDF 时不必每次查询都计数"""
+    __tablename__ = 'search_counts'
+    kind = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    documents = db.Column(db.Integer, nullable=False, default=0)
+
+
+def _create_counts(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'kind': number, 'documents': 0} for number, _ in KINDS.values()])
+
+
+db.event.listen(SearchCount.__table__, 'after_create', _create_counts)
+
+
+_backends = {}
+
+
+def backend(connection):
+    """'fts5' 或 'inverted'。FLASKY_SEARCH_BACKEND 为 auto 时，
+    SQLite 编译了 FTS5 就用它，其他数据库用倒排索引表"""
+    setting = current_app.config.get('FLASKY_SEARCH_BACKEND', 'auto') \
+        if has_app_context() else 'auto'
+    if setting != 'auto':
+        return setting
+    engine = connection.engine
+    if engine not in _backends:
+        fts5 = False
+        if engine.dialect.name == 'sqlite':
+            options = [row[0] for row in
+                       connection.execute('PRAGMA compile_options')]
+            fts5 = 'ENABLE_FTS5' in options
+        _backends[engine] = 'fts5' if fts5 else 'inverted'
+    return _backends[engine]
+
+
+def create_fts(connection):
+    if backend(connection) == 'fts5':
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS search_fts '
+                           'USING fts5(tokens)')
+
+
+def _create_fts(target, connection, **kw):
+    create_fts(connection)
+
+
+def _drop_fts(target, connection, **kw):
+    if connection.engine.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS search_fts')
+
+
+db.event.listen(db.metadata, 'after_create', _create_fts)
+db.event.listen(db.metadata, 'before_drop', _drop_fts)
+
+
+def _document(kind, id):
+    return id * 2 + KINDS[kind][0]
+
+
+def _write(connection, doc, tokens):
+    if backend(connection) == 'fts5':
+        connection.execute(text('DELETE FROM search_fts WHERE rowid = :doc'),
+                           doc=doc)
+        if tokens:
+            connection.execute(
+                text('INSERT INTO search_fts (rowid, tokens) '
+                     'VALUES (:doc, :tokens)'),
+                doc=doc, tokens=' '.join(tokens))
+        return
+    terms = SearchTerm.__table__
+    indexed = connection.execute(
+        terms.delete().where(terms.c.doc == doc)).rowcount > 0
+    counts = Counter(tokens)
+    if counts:
+        connection.execute(terms.insert(), [
+            {'term': term, 'doc': doc, 'tf': tf}
+            for term, tf in counts.items()])
+    # 文档加入或移出索引时更新篇数
+    delta = bool(counts) - indexed
+    if delta:
+        table = SearchCount.__table__
+        connection.execute(table.update()
+                           .where(table.c.kind == doc % 2)
+                           .values(documents=table.c.documents + delta))
+
+
+def index(connection, kind, target):
+    """重建一篇文档的索引，被屏蔽的评论从索引中删除"""
+    tokens = []
+    if not getattr(target, 'disabled', False):
+        tokens = list(index_tokens(plain_text(target.body_html) or
+                                   target.body or ''))
+    _write(connection, _document(kind, target.id), tokens)
+
+
+def reindex(kind, batch_size=1000):
+    """按 id 分批重建某类文档的全部索引，返回处理的文档数。
+    批量生成数据和重新渲染绕过了 ORM 事件，之后需要调用它"""
+    number, model = KINDS[kind]
+    table = model.__table__
+    columns = [table.c.id, table.c.body, table.c.body_html]
+    if model is Comment:
+        columns.append(table.c.disabled)
+    total = 0
+    last_id = 0
+    with db.engine.begin() as connection:
+        create_fts(connection)
+        if backend(connection) == 'fts5':
+            connection.execute(
+                text('DELETE FROM search_fts WHERE rowid % 2 = :kind'),
+                kind=number)
+        else:
+            terms = SearchTerm.__table__
+            connection.execute(terms.delete().where(
+                terms.c.doc % 2 == number))
+            counts = SearchCount.__table__
+            connection.execute(counts.update()
+                               .where(counts.c.kind == number)
+                               .values(documents=0))
+        while True:
+            rows = connection.execute(
+                select(columns).where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                index(connection, kind, row)
+            last_id = rows[-1].id
+            total += len(rows)
+    return total
+
+
+def _ranked_fts(kind, tokens, offset, limit):
+    match = ' '.join('"%s"' % token for token in tokens)
+    where = 'FROM search_fts WHERE search_fts MATCH :match ' \
+            'AND rowid % 2 = :kind'
+    params = {'match': match, 'kind': KINDS[kind][0]}
+    total = db.session.execute(text('SELECT count(*) ' + where),
+                               params).scalar()
+    rows = db.session.execute(
+        text('SELECT rowid ' + where + ' ORDER BY rank LIMIT :limit '
+             'OFFSET :offset'),
+        dict(params, limit=limit, offset=offset))
+    return [row[0] // 2 for row in rows], total
+
+
+def _ranked_inverted(kind, tokens, offset, limit):
+    number = KINDS[kind][0]
+    terms = SearchTerm.__table__
+    matches = and_(terms.c.term.in_(tokens), terms.c.doc % 2 == number)
+    frequencies = dict(db.session.execute(
+        select([terms.c.term, func.count()]).where(matches)
+        .group_by(terms.c.term)).fetchall())
+    if len(frequencies) < len(tokens):
+        return [], 0
+    documents = db.session.query(SearchCount.documents)\
+        .filter(SearchCount.kind == number).scalar() or 1
+    # 所有查询词都出现的文档按 TF-IDF 排序，各词的 IDF 先算好代入 SQL
+    idf = case(dict((term, math.log(1.0 + documents / frequency))
+                    for term, frequency in frequencies.items()),
+               value=terms.c.term)
+    matched = select([terms.c.doc]).where(matches).group_by(terms.c.doc)\
+        .having(func.count() == len(tokens))
+    total = db.session.execute(
+        select([func.count()]).select_from(matched.alias())).scalar()
+    score = func.sum(terms.c.tf * idf).label('score')
+    # 得分相同时新的在前
+    rows = db.session.execute(
+        matched.column(score).order_by(score.desc(), terms.c.doc.desc())
+        .limit(limit).offset(offset))
+    return [row.doc // 2 for row in rows], total
+
+
+def search(kind, query, page=1, per_page=20):
+    """按相关度返回第 ``page`` 页的帖子或评论，以及匹配的总数"""
+    if kind not in KINDS:
+        raise ValueError('unknown search kind: %s' % kind)
+    tokens = query_tokens(query)
+    if not tokens:
+        return [], 0
+    offset = (page - 1) * per_page
+    if backend(db.session.connection()) == 'fts5':
+        ids, total = _ranked_fts(kind, tokens, offset, per_page)
+    else:
+        ids, total = _ranked_inverted(kind, tokens, offset, per_page)
+    model = KINDS[kind][1]
+    found = dict((item.id, item) for item in model.query.options(
+        *model.loading('listing')).filter(model.id.in_(ids))) if ids else {}
+    return [found[id] for id in ids if id in found], total
+
+
+def _mark(target, value, oldvalue, initiator):
+    # 修改正文或屏蔽状态时标记，写入数据库后再更新索引（这时才有 id）
+    target._search_dirty = True
+
+
+def _listener(kind):
+    def changed(mapper, connection, target):
+        if target.__dict__.pop('_search_dirty', False):
+            index(connection, kind, target)
+
+    def deleted(mapper, connection, target):
+        _write(connection, _document(kind, target.id), [])
+    return changed, deleted
+
+
+for kind, (number, model) in KINDS.items():
+    changed, deleted = _listener(kind)
+    db.event.listen(model.body, 'set', _mark)
+    db.event.listen(model, 'after_insert', changed)
+    db.event.listen(model, 'after_update', changed)
+    db.event.listen(model, 'after_delete', deleted)
+db.event.listen(Comment.disabled, 'set', _mark)
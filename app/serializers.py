@@ -0,0 +1,216 @@
+from flask import current_app, g, has_request_context, request, url_for
+from sqlalchemy import select, union_all
+from .exceptions import ValidationError
+
+# 生成 URL 模板时代入的占位 id，不会和真实 URL 的其他部分重复
+_PLACEHOLDER = 918273645546372819
+
+
+class URLTemplate(object):
+    """把 url_for 生成的外部 URL 在 id 处拆成前后两段，之后只需拼接 id"""
+
+    def __init__(self, endpoint, **values):
+        url = url_for(endpoint, id=_PLACEHOLDER, _external=True, **values)
+        self.prefix, _, self.suffix = url.rpartition(str(_PLACEHOLDER))
+
+    def __call__(self, id):
+        return '%s%d%s' % (self.prefix, id, self.suffix)
+
+
+def url_template(endpoint):
+    """当前请求中 ``endpoint`` 的 URL 模板，每个请求只调用一次 url_for"""
+    templates = g.setdefault('url_templates', {})
+    # 测试中多个请求共用一个应用上下文，按主机区分
+    key = (endpoint, request.url_root if has_request_context() else None)
+    template = templates.get(key)
+    if template is None:
+        template = templates[key] = URLTemplate(endpoint)
+    return template
+
+
+def user_to_json(user):
+    return {
+        'url': url_template('api.get_user')(user.id),
+        'username': user.username,
+        'member_since': user.member_since,
+        'last_seen': user.last_seen,
+        'posts': url_template('api.get_user_posts')(user.id),
+        'followed_posts': url_template('api.get_user_followed_posts')(user.id),
+        'post_count': user.post_count
+    }
+
+
+def post_to_json(post):
+    return {
+        'url': url_template('api.get_post')(post.id),
+        'body': post.body,
+        'body_html': post.body_html,
+        'timestamp': post.timestamp,
+        'author': url_template('api.get_user')(post.author_id),
+        'comments': url_template('api.get_post_comments')(post.id),
+        'comment_count': post.comment_count
+    }
+
+
+def comment_to_json(comment):
+    return {
+        'url': url_template('api.get_comment')(comment.id),
+        'post': url_template('api.get_post')(comment.post_id),
+        'body': comment.body,
+        'body_html': comment.body_html,
+        'timestamp': comment.timestamp,
+        'author': url_template('api.get_user')(comment.author_id)
+    }
+
+
+def _split_arg(name):
+    value = request.args.get(name, '')
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def _by_id(query):
+    return dict((item.id, item) for item in query)
+
+
+class Serializer(object):
+    """按 ``?fields=`` 裁剪输出、按 ``?embed=`` 内嵌关联对象的序列化器。
+
+    关联对象由 :meth:`prefetch` 对整页数据批量加载，查询数与条目数无关；
+    :meth:`versions` 返回内嵌对象的版本，供条件请求计算 ETag。
+    """
+
+    fields = ()
+    embeddable = ()
+
+    def __init__(self, fields=None, embed=()):
+        self.only = set(fields) if fields else None
+        self.embed = set(embed)
+        self.related = {}
+        # 分页链接沿用相同的参数
+        self.args = {}
+        if fields:
+            self.args['fields'] = ','.join(fields)
+        if embed:
+            self.args['embed'] = ','.join(embed)
+
+    @classmethod
+    def from_request(cls):
+        fields = _split_arg('fields')
+        embed = _split_arg('embed')
+        for name in fields:
+            if name not in cls.fields:
+                raise ValidationError('unknown field: %s' % name)
+        for name in embed:
+            if name not in cls.embeddable:
+                raise ValidationError('cannot embed: %s' % name)
+        return cls(fields, embed)
+
+    def prefetch(self, items):
+        """批量加载 ``items`` 需要内嵌的关联对象，在 :meth:`dump` 之前调用"""
+
+    def versions(self):
+        return sorted((type(item).__name__, item.id, item.updated_at,
+                       getattr(item, 'last_seen', None))
+                      for objects in self.related.values()
+                      for item in objects.values())
+
+    def to_json(self, item):
+        raise NotImplementedError
+
+    def dump(self, item):
+        data = self.to_json(item)
+        if self.only is not None:
+            data = dict((key, value) for key, value in data.items()
+                        if key in self.only or key in self.embed)
+        return data
+
+    def _load_users(self, ids):
+        # models 导入了本模块，只能在用到时导入
+        from .models import User
+        missing = set(ids) - set(self.related.setdefault('users', {}))
+        if missing:
+            self.related['users'].update(_by_id(
+                User.query.filter(User.id.in_(missing))))
+
+    def _user(self, id):
+        user = self.related['users'].get(id)
+        return user_to_json(user) if user is not None else None
+
+
+class UserSerializer(Serializer):
+    fields = ('url', 'username', 'member_since', 'last_seen', 'posts',
+              'followed_posts', 'post_count')
+
+    def to_json(self, user):
+        return user_to_json(user)
+
+
+class CommentSerializer(Serializer):
+    fields = ('url', 'post', 'body', 'body_html', 'timestamp', 'author')
+    embeddable = ('author', 'post')
+
+    def prefetch(self, comments):
+        from .models import Post
+        if 'author' in self.embed:
+            self._load_users(c.author_id for c in comments)
+        if 'post' in self.embed:
+            ids = set(c.post_id for c in comments)
+            self.related['posts'] = _by_id(
+                Post.query.filter(Post.id.in_(ids)))
+
+    def to_json(self, comment):
+        data = comment_to_json(comment)
+        if 'author' in self.embed:
+            data['author'] = self._user(comment.author_id)
+        if 'post' in self.embed:
+            post = self.related['posts'].get(comment.post_id)
+            data['post'] = post_to_json(post) if post is not None else None
+        return data
+
+
+class PostSerializer(Serializer):
+    fields = ('url', 'body', 'body_html', 'timestamp', 'author', 'comments',
+              'comment_count')
+    embeddable = ('author', 'latest_comments')
+
+    def __init__(self, fields=None, embed=()):
+        super(PostSerializer, self).__init__(fields, embed)
+        self.latest = {}
+
+    def prefetch(self, posts):
+        from .models import Comment
+        if 'latest_comments' in self.embed and posts:
+            # 每个帖子一个带 LIMIT 的子查询，合并成一条语句，
+            # 各自走 post_id 索引，只读取需要的几行
+            table = Comment.__table__
+            limit = current_app.config['FLASKY_EMBED_COMMENTS']
+            ids = union_all(*[
+                select([table.c.id]).where(table.c.post_id == post.id)
+                .order_by(table.c.timestamp.desc(), table.c.id.desc())
+                .limit(limit).alias().select()
+                for post in posts])
+            comments = Comment.query.filter(Comment.id.in_(ids))\
+                .order_by(Comment.timestamp.desc(), Comment.id.desc()).all()
+            for comment in comments:
+                self.latest.setdefault(comment.post_id, []).append(comment)
+            self.related['comments'] = _by_id(comments)
+        if 'author' in self.embed:
+            ids = set(p.author_id for p in posts)
+            # 内嵌评论的作者一并加载
+            ids.update(c.author_id for c in self.related.get(
+                'comments', {}).values())
+            self._load_users(ids)
+
+    def to_json(self, post):
+        data = post_to_json(post)
+        if 'author' in self.embed:
+            data['author'] = self._user(post.author_id)
+        if 'latest_comments' in self.embed:
+            comments = []
+            for comment in self.latest.get(post.id, ()):
+                json_comment = comment_to_json(comment)
+                if 'author' in self.embed:
+                    json_comment['author'] = self._user(comment.author_id)
+                comments.append(json_comment)
+            data['latest_comments'] = comments
+        return data
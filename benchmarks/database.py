@@ -0,0 +1,166 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import Role, User, Post, Comment
+from config import ProductionConfig
+from .endpoints import percentile
+
+# 每个配置档在空数据库中写入的数据规模
+DATASET = {'users': 200, 'posts': 2000, 'comments': 4000, 'seed': 0}
+
+# 配置档名 -> 覆盖的配置项；SQLite 配置档各自使用一个临时数据库文件
+PROFILES = {
+    'sqlite-default': {
+        'FLASKY_SQLITE_PRAGMAS': {},
+        'FLASKY_SQLITE_OPTIMIZE': False,
+        'SQLALCHEMY_POOL_SIZE': None
+    },
+    'sqlite-tuned': {
+        'FLASKY_SQLITE_PRAGMAS': ProductionConfig.FLASKY_SQLITE_PRAGMAS,
+        'FLASKY_SQLITE_OPTIMIZE': True,
+        'SQLALCHEMY_POOL_SIZE': ProductionConfig.SQLALCHEMY_POOL_SIZE
+    },
+    'postgres': {
+        'SQLALCHEMY_POOL_SIZE': ProductionConfig.SQLALCHEMY_POOL_SIZE,
+        'SQLALCHEMY_POOL_RECYCLE': ProductionConfig.SQLALCHEMY_POOL_RECYCLE
+    }
+}
+
+
+def _read(connection, ids):
+    # 首页一页帖子连同作者，再取其中一篇的评论数，和请求中的查询相当
+    posts = Post.__table__
+    users = User.__table__
+    rows = connection.execute(
+        select([posts.c.id, posts.c.body_html, users.c.username])
+        .select_from(posts.join(users, posts.c.author_id == users.c.id))
+        .order_by(posts.c.timestamp.desc()).limit(20)
+        .offset(random.randint(0, 50) * 20)).fetchall()
+    connection.execute(select([func.count()]).select_from(Comment.__table__)
+                       .where(Comment.__table__.c.post_id ==
+                              random.choice(ids['posts']))).scalar()
+    return rows
+
+
+def _write(connection, ids):
+    # 更新 last_seen 并发表一条评论，各自一个短事务
+    now = datetime.utcnow()
+    users = User.__table__
+    with connection.begin():
+        connection.execute(users.update()
+                           .where(users.c.id == random.choice(ids['users']))
+                           .values(last_seen=now))
+    with connection.begin():
+        connection.execute(Comment.__table__.insert().values(
+            body='benchmark', body_html='<p>benchmark</p>', timestamp=now,
+            updated_at=now, disabled=False,
+            author_id=random.choice(ids['users']),
+            post_id=random.choice(ids['posts'])))
+
+
+def _worker(engine, operation, ids, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            # 每次操作取一个连接，和每个请求使用一个会话一样
+            with engine.connect() as connection:
+                operation(connection, ids)
+        except OperationalError:
+            # database is locked 等错误
+            errors.append(1)
+        else:
+            latencies.append(time.perf_counter() - start)
+
+
+def prepare(app):
+    from app.fake import seed
+    with app.app_context():
+        db.create_all()
+        if User.query.count() == 0:
+            Role.insert_roles()
+            seed(users=DATASET['users'], posts=DATASET['posts'],
+                 comments=DATASET['comments'], seed=DATASET['seed'])
+        ids = {
+            'users': [id for id, in db.session.query(User.id)],
+            'posts': [id for id, in db.session.query(Post.id)]
+        }
+        engine = db.engine
+        db.session.remove()
+    return engine, ids
+
+
+def run_profile(uri, overrides, readers=4, writers=2, duration=5.0):
+    """并发读写 ``duration`` 秒，返回每秒读写次数、延迟百分位（毫秒）和
+    因锁冲突失败的次数"""
+    app = create_app('benchmark')
+    app.config.update(overrides)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    engine, ids = prepare(app)
+    results = {}
+    threads = []
+    deadline = time.perf_counter() + duration
+    for kind, operation, count in (('read', _read, readers),
+                                   ('write', _write, writers)):
+        latencies = []
+        errors = []
+        results[kind] = (latencies, errors)
+        threads.extend(threading.Thread(
+            target=_worker,
+            args=(engine, operation, ids, deadline, latencies, errors))
+            for i in range(count))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with engine.connect() as connection:
+        journal_mode = connection.execute('PRAGMA journal_mode').scalar() \
+            if engine.dialect.name == 'sqlite' else None
+    engine.dispose()
+    report = {'database': engine.dialect.name, 'journal_mode': journal_mode}
+    for kind, (latencies, errors) in results.items():
+        report[kind] = {
+            'ops': len(latencies) / duration,
+            'p50': percentile(latencies, 50) * 1000 if latencies else 0.0,
+            'p95': percentile(latencies, 95) * 1000 if latencies else 0.0,
+            'errors': len(errors)
+        }
+    return report
+
+
+def run(profiles=('sqlite-default', 'sqlite-tuned'), uri=None, **kwargs):
+    """依次测量各配置档。SQLite 配置档使用临时数据库文件；
+    postgres 配置档需要 ``uri`` 指向一个可写入测试数据的空数据库"""
+    reports = {}
+    for name in profiles:
+        if name.startswith('sqlite'):
+            directory = tempfile.mkdtemp()
+            try:
+                reports[name] = run_profile(
+                    'sqlite:///' + os.path.join(directory, 'bench.sqlite'),
+                    PROFILES[name], **kwargs)
+            finally:
+                shutil.rmtree(directory)
+        elif uri is not None:
+            reports[name] = run_profile(uri, PROFILES[name], **kwargs)
+    return reports
+
+
+def report(reports):
+    lines = ['%-16s %-8s %9s %8s %8s %7s %9s %8s %8s %7s' % (
+        'profile', 'journal', 'reads/s', 'p50', 'p95', 'errors',
+        'writes/s', 'p50', 'p95', 'errors')]
+    for name, r in sorted(reports.items()):
+        lines.append('%-16s %-8s %9.1f %8.2f %8.2f %7d %9.1f %8.2f %8.2f %7d'
+                     % (name, r['journal_mode'] or '-',
+                        r['read']['ops'], r['read']['p50'], r['read']['p95'],
+                        r['read']['errors'], r['write']['ops'],
+                        r['write']['p50'], r['write']['p95'],
+                        r['write']['errors']))
+    return '\n'.join(lines)
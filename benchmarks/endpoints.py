@@ -0,0 +1,260 @@
+import json
+import math
+import os
+import platform
+import time
+from base64 import b64encode
+from datetime import datetime
+from flask import url_for
+from sqlalchemy import event
+from app import db
+from app.models import Role, User, Post, Comment
+
+# 种子数据库为空时写入的数据规模，改动后需要重新保存基线
+DATASET = {'users': 500, 'posts': 5000, 'comments': 15000, 'seed': 0}
+PASSWORD = 'password'
+
+# (名称, 是否 API, 根据目标对象生成 URL 的函数)
+ENDPOINTS = (
+    ('main.index', False,
+     lambda t: url_for('main.index')),
+    ('main.user', False,
+     lambda t: url_for('main.user', username=t['author'].username)),
+    ('main.post', False,
+     lambda t: url_for('main.post', id=t['post'].id)),
+    ('main.followers', False,
+     lambda t: url_for('main.followers', username=t['author'].username)),
+    ('api.get_posts', True,
+     lambda t: url_for('api.get_posts')),
+    ('api.get_post', True,
+     lambda t: url_for('api.get_post', id=t['post'].id)),
+    ('api.get_post_comments', True,
+     lambda t: url_for('api.get_post_comments', id=t['post'].id)),
+    ('api.get_user', True,
+     lambda t: url_for('api.get_user', id=t['author'].id)),
+    ('api.get_user_posts', True,
+     lambda t: url_for('api.get_user_posts', id=t['author'].id)),
+    ('api.get_user_followed_posts', True,
+     lambda t: url_for('api.get_user_followed_posts', id=t['viewer'].id))
+)
+
+
+def percentile(samples, pct):
+    """最近秩法求百分位数"""
+    ordered = sorted(samples)
+    index = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, index)]
+
+
+def prepare(app):
+    """建表并在数据库为空时写入种子数据，返回各表的行数"""
+    from app.fake import seed
+    with app.app_context():
+        db.create_all()
+        if User.query.count() == 0:
+            Role.insert_roles()
+            seed(users=DATASET['users'], posts=DATASET['posts'],
+                 comments=DATASET['comments'], seed=DATASET['seed'])
+        counts = {
+            'users': User.query.count(),
+            'posts': Post.query.count(),
+            'comments': Comment.query.count()
+        }
+        db.session.remove()
+    return counts
+
+
+def _targets(app):
+    # 固定挑选数据最多的对象，结果才可以和基线比较
+    with app.test_request_context():
+        targets = {
+            'author': User.query.order_by(User.post_count.desc(),
+                                          User.id).first(),
+            'viewer': User.query.order_by(User.followed_count.desc(),
+                                          User.id).first(),
+            'post': Post.query.order_by(Post.comment_count.desc(),
+                                        Post.id).first()
+        }
+        urls = [(name, api, url(targets)) for name, api, url in ENDPOINTS]
+        viewer = targets['viewer'].email
+        db.session.remove()
+    return urls, viewer
+
+
+def _api_headers(email, password):
+    credentials = (email + ':' + password).encode('utf-8')
+    return {
+        'Authorization': 'Basic ' + b64encode(credentials).decode('ascii'),
+        'Accept': 'application/json'
+    }
+
+
+def measure(client, url, requests, headers=None, warmup=5, queries=None,
+            revalidate=False):
+    """请求同一个 URL 多次，统计吞吐量、延迟百分位、平均查询数和响应字节数。
+
+    ``revalidate`` 为真时带上首次响应的 ETag，测量条件请求的开销。
+    ``cpu`` 是每个请求占用的进程 CPU 时间（毫秒），用来衡量压缩等开销。
+    """
+    headers = dict(headers or {})
+    for i in range(warmup):
+        response = client.get(url, headers=headers)
+    if revalidate and warmup:
+        etag = response.headers.get('ETag')
+        if etag:
+            headers['If-None-Match'] = etag
+    latencies = []
+    sizes = []
+    errors = 0
+    before = len(queries) if queries is not None else 0
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for i in range(requests):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        sizes.append(len(response.get_data()))
+        if response.status_code >= 400 or \
+                (revalidate and response.status_code != 304):
+            errors += 1
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    result = {
+        'url': url,
+        'requests': requests,
+        'errors': errors,
+        'throughput': requests / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'bytes': sum(sizes) / float(requests),
+        'cpu': cpu * 1000 / requests
+    }
+    if queries is not None:
+        result['queries'] = (len(queries) - before) / float(requests)
+    return result
+
+
+def run(app, requests=200, warmup=5):
+    """分别以匿名用户和已登录用户压测各端点，延迟单位为毫秒"""
+    dataset = prepare(app)
+    urls, viewer = _targets(app)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    scenarios = {}
+    try:
+        # 不保留外层应用上下文，每个请求各自创建并清理数据库会话
+        anonymous = app.test_client()
+        logged_in = app.test_client(use_cookies=True)
+        response = logged_in.post('/auth/login', data={
+            'email': viewer, 'password': PASSWORD})
+        if response.status_code != 302:
+            raise RuntimeError('could not log in as %s' % viewer)
+        # 登录用户的首页显示关注的帖子
+        logged_in.set_cookie('localhost', 'show_followed', '1')
+        # revalidate: 匿名用户带上 If-None-Match 重新验证
+        # compressed: 匿名用户接受 gzip，与 anonymous 对比压缩的收益和开销
+        gzip = {'Accept-Encoding': 'gzip'}
+        clients = {
+            'anonymous': (anonymous, _api_headers('', ''), None, False),
+            'user': (logged_in, _api_headers(viewer, PASSWORD), None, False),
+            'revalidate': (anonymous, _api_headers('', ''), None, True),
+            'compressed': (anonymous, _api_headers('', ''), gzip, False)
+        }
+        for scenario, (client, api_headers, extra, revalidate) in \
+                clients.items():
+            results = scenarios[scenario] = {}
+            for name, api, url in urls:
+                headers = dict(api_headers if api else {}, **(extra or {}))
+                results[name] = measure(
+                    client, url, requests, headers=headers,
+                    warmup=warmup, queries=statements,
+                    revalidate=revalidate)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return {
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'database': engine.dialect.name,
+        'dataset': dataset,
+        'scenarios': scenarios
+    }
+
+
+def compare(current, baseline, threshold=0.2):
+    """返回相对基线的退化列表。
+
+    p50/p95 延迟和响应字节数超过基线的 ``1 + threshold`` 倍算退化，
+    查询数是确定的，只要比基线多就算退化。
+    """
+    regressions = []
+    for scenario, results in sorted(current['scenarios'].items()):
+        base_results = baseline.get('scenarios', {}).get(scenario, {})
+        for name, result in sorted(results.items()):
+            base = base_results.get(name)
+            if base is None:
+                continue
+            label = '%s %s' % (scenario, name)
+            for metric in ('p50', 'p95', 'bytes'):
+                if result[metric] > base[metric] * (1 + threshold):
+                    regressions.append('%s: %s %.2f -> %.2f' % (
+                        label, metric, base[metric], result[metric]))
+            if 'queries' in base and result.get('queries', 0) > \
+                    base['queries']:
+                regressions.append('%s: queries %.2f -> %.2f' % (
+                    label, base['queries'], result['queries']))
+    return regressions
+
+
+def load(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compression(results, plain='anonymous', compressed='compressed'):
+    """对比两个场景同一端点的字节数和 CPU 时间，返回
+    (端点, 原始字节, 压缩后字节, 节省比例, 每请求增加的 CPU 毫秒)"""
+    scenarios = results['scenarios']
+    rows = []
+    for name, r in sorted(scenarios.get(compressed, {}).items()):
+        base = scenarios.get(plain, {}).get(name)
+        if base is None:
+            continue
+        saved = 1 - r['bytes'] / base['bytes'] if base['bytes'] else 0.0
+        rows.append((name, base['bytes'], r['bytes'], saved,
+                     r.get('cpu', 0) - base.get('cpu', 0)))
+    return rows
+
+
+def report(results):
+    lines = ['%-10s %-30s %8s %8s %8s %8s %7s %9s %7s' % (
+        'scenario', 'endpoint', 'req/s', 'p50', 'p95', 'p99', 'queries',
+        'bytes', 'cpu')]
+    for scenario, endpoints in sorted(results['scenarios'].items()):
+        for name, r in sorted(endpoints.items()):
+            lines.append(
+                '%-10s %-30s %8.1f %8.2f %8.2f %8.2f %7.1f %9d %7.2f' % (
+                    scenario, name, r['throughput'], r['p50'], r['p95'],
+                    r['p99'], r.get('queries', 0), r['bytes'],
+                    r.get('cpu', 0)))
+    rows = compression(results)
+    if rows:
+        lines.append('')
+        lines.append('%-30s %9s %9s %7s %9s' % (
+            'compression', 'bytes', 'gzip', 'saved', '+cpu ms'))
+        for name, plain, compressed, saved, cpu in rows:
+            lines.append('%-30s %9d %9d %6.1f%% %9.2f' % (
+                name, plain, compressed, saved * 100, cpu))
+    return '\n'.join(lines)
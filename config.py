@@ -13,11 +13,80 @@ class Config:
     FLASKY_MAIL_SUBJECT_PREFIX = '[LIHOU网站]'
     FLASKY_MAIL_SENDER = 'LIHOU网站系统 <lihou_tk@126.com>'
     FLASKY_ADMIN = os.environ.get('FLASKY_ADMIN')
+    # 邮件由固定数量的线程经有界队列发送，每个线程复用一个 SMTP 连接；
+    # 连接错误最多重试 FLASKY_MAIL_RETRIES 次，间隔从 BACKOFF 秒起逐次翻倍
+    FLASKY_MAIL_WORKERS = 2
+    FLASKY_MAIL_QUEUE_SIZE = 1000
+    FLASKY_MAIL_BATCH_SIZE = 20
+    FLASKY_MAIL_RETRIES = 3
+    FLASKY_MAIL_RETRY_BACKOFF = 1.0
+    FLASKY_MAIL_IDLE_TIMEOUT = 30
+    FLASKY_MAIL_ENQUEUE_TIMEOUT = 1.0
     FLASKY_POSTS_PER_PAGE = 20
     FLASKY_FOLLOWERS_PER_PAGE = 50
     FLASKY_COMMENTS_PER_PAGE = 30
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
-    SQLALCHEMY_RECORD_QUERIES = True
+    # 关注的帖子改为读取预先写扩散的时间线表
+    FLASKY_TIMELINE_STORE = bool(os.environ.get('FLASKY_TIMELINE_STORE'))
+    FLASKY_TIMELINE_FANOUT_LIMIT = 1000
+    # last_seen 的精度（秒），同一用户在此期间内的访问不再写库
+    FLASKY_LAST_SEEN_RESOLUTION = 60
+    FLASKY_LAST_SEEN_BATCH = 1000
+    # API 凭据验证结果的缓存时间（秒），令牌的缓存不超过其有效期。
+    # 缓存在进程内，修改密码后其他工作进程中的旧凭据最多还能用这么久
+    FLASKY_API_AUTH_CACHE_TTL = 60
+    # 进程内缓存的用户身份快照和角色权限的有效期（秒）
+    FLASKY_IDENTITY_CACHE_TTL = 60
+    FLASKY_ROLE_CACHE_TTL = 300
+    # 按比例抽样请求统计 SQL，为 0 时只记录慢查询
+    FLASKY_PROFILER_SAMPLE_RATE = float(
+        os.environ.get('FLASKY_PROFILER_SAMPLE_RATE') or 0.01)
+    FLASKY_PROFILER_EXPLAIN_LIMIT = 10
+    # 匿名用户整页缓存和帖子条目片段缓存的条目数，由数据修改触发失效
+    FLASKY_PAGE_CACHE_SIZE = 512
+    FLASKY_FRAGMENT_CACHE_SIZE = 4096
+    # 响应压缩：小于该字节数的响应不压缩；按内容类型设置压缩级别，
+    # 未列出的类型（图片、归档等已压缩格式）不压缩，API 用较低级别省 CPU
+    FLASKY_COMPRESS_MIN_SIZE = 500
+    FLASKY_COMPRESS_LEVELS = {
+        'text/*': 6,
+        'application/javascript': 6,
+        'image/svg+xml': 6,
+        'application/json': 4,
+        'application/x-ndjson': 1
+    }
+    # manage.py assets 生成的带摘要静态文件所在的子目录（相对于 static）
+    FLASKY_ASSETS_DIR = 'build'
+    # API 批量读写一次请求最多处理的条目数
+    FLASKY_API_BATCH_LIMIT = 100
+    # 导出数据时每次从数据库读取的行数
+    FLASKY_EXPORT_CHUNK_SIZE = 1000
+    # API 的 ?embed=latest_comments 为每个帖子内嵌的评论数
+    FLASKY_EMBED_COMMENTS = 3
+    # 全文搜索：auto 在 SQLite 支持 FTS5 时使用它，否则用倒排索引表；
+    # 也可以指定 fts5 或 inverted
+    FLASKY_SEARCH_BACKEND = os.environ.get('FLASKY_SEARCH_BACKEND') or 'auto'
+    FLASKY_SEARCH_RESULTS_PER_PAGE = 20
+    # API 输出紧凑的 JSON，不缩进
+    JSONIFY_PRETTYPRINT_REGULAR = False
+    # 连接池大小、溢出数和回收时间（秒），PostgreSQL 等数据库使用；
+    # 文件型 SQLite 设置了连接池大小后也改用连接池，否则每次请求新建连接
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 0) \
+        or None
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or
+                                  0) or None
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or
+                                  0) or None
+    # 每个 SQLite 连接上执行的 PRAGMA，为空时使用 SQLite 的默认设置
+    FLASKY_SQLITE_PRAGMAS = {}
+    FLASKY_SQLITE_OPTIMIZE = False
+    # 只读副本的数据库 URI（DATABASE_REPLICA_URLS 用逗号分隔），GET 请求的
+    # 读查询分配到副本；用户写入后若干秒内的请求仍读主库
+    FLASKY_DATABASE_REPLICAS = [
+        uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if uri]
+    FLASKY_DATABASE_STICKY_SECONDS = 10
+    SQLALCHEMY_RECORD_QUERIES = False
     SQLALCHEMY_TRACK_MODIFICATIONS = True
     # SQLALCHEMY_COMMIT_ON_TEARDOWN = True  # 该配置在 Flask-SQLAlchemy 2.0后被移除
 
@@ -39,9 +108,30 @@ class TestingConfig(Config):
     WTF_CSRF_ENABLED = False
 
 
+class BenchmarkConfig(Config):
+    # 基准测试使用单独的种子数据库，关闭 CSRF 以便测试客户端登录
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(basedir, 'data-bench.sqlite')
+    WTF_CSRF_ENABLED = False
+
+
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 5)
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or
+                                  1800)
+    # WAL 模式下读不阻塞写；synchronous=NORMAL 在 WAL 下只在检查点时 fsync，
+    # 掉电可能丢失最近的事务但不会损坏数据库；缓存单位为 KiB（负数）
+    FLASKY_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -20000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY'
+    }
+    FLASKY_SQLITE_OPTIMIZE = True
 
     @classmethod
     def init_app(cls, app):
@@ -89,6 +179,7 @@ class HerokuConfig(ProductionConfig):
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
+    'benchmark': BenchmarkConfig,
     'production': ProductionConfig,
     'heroku': HerokuConfig,
 
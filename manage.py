@@ -7,7 +7,8 @@ if os.environ.get('FLASK_COVERAGE'):
     COV.start()
 
 from app import create_app, db
-from app.models import User, Follow, Role, Permission, Post, Comment
+from app.models import User, Follow, Role, Permission, Post, Comment, \
+    TimelineEntry
 from flask_script import Manager, Shell
 from flask_migrate import Migrate, MigrateCommand
 
@@ -18,7 +19,8 @@ migrate = Migrate(app, db)
 
 def make_shell_context():
     return dict(app=app, db=db, User=User, Follow=Follow, Role=Role,
-                Permission=Permission, Post=Post, Comment=Comment)
+                Permission=Permission, Post=Post, Comment=Comment,
+                TimelineEntry=TimelineEntry)
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
@@ -54,6 +56,148 @@ def profile(length=25, profile_dir=None):
     app.run()
 
 
+@manager.command
+def reconcile_counts():
+    """校正帖子、评论和关注的冗余计数"""
+    fixed = User.reconcile_counts()
+    fixed.update(Post.reconcile_counts())
+    for counter in sorted(fixed):
+        print('%s: %d rows fixed' % (counter, fixed[counter]))
+
+
+@manager.command
+def rebuild_timelines():
+    """根据 follows 表重建写扩散的时间线"""
+    print('%d timeline entries written' % TimelineEntry.rebuild())
+
+
+@manager.command
+def reindex():
+    """重建帖子和评论的全文索引"""
+    from app.search import KINDS, reindex
+    for kind in sorted(KINDS):
+        print('%s: %d documents indexed' % (kind, reindex(kind)))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=500)
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+def rerender(batch_size, workers):
+    """重新渲染按旧版清理规则生成的 body_html"""
+    from app.render import rerender
+    for model in (Post, Comment):
+        print('%s: %d rows rerendered' % (
+            model.__tablename__, rerender(model, batch_size, workers)))
+
+
+@manager.command
+def assets():
+    """生成带摘要的静态文件、gzip 预压缩版本和 manifest"""
+    from app.assets import build
+    manifest = build(app.static_folder, app.config['FLASKY_ASSETS_DIR'],
+                     app.config['FLASKY_COMPRESS_LEVELS'])
+    for filename in sorted(manifest):
+        print('%s -> %s' % (filename, manifest[filename]))
+
+
+@manager.option('-u', '--users', dest='users', type=int, default=1000)
+@manager.option('-p', '--posts', dest='posts', type=int, default=10000)
+@manager.option('-c', '--comments', dest='comments', type=int, default=30000)
+@manager.option('-f', '--follows', dest='follows', type=int, default=20,
+                help='average number of users each user follows')
+@manager.option('-s', '--seed', dest='random_seed', type=int, default=0)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=5000)
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+def seed(users, posts, comments, follows, random_seed, batch_size, workers):
+    """批量生成可复现的大规模测试数据"""
+    from app.fake import seed
+    counts = seed(users=users, posts=posts, comments=comments,
+                  follows=follows, seed=random_seed, batch_size=batch_size,
+                  workers=workers)
+    for table in sorted(counts):
+        print('%s: %d rows' % (table, counts[table]))
+    # 批量插入绕过了 ORM 事件，全文索引要整体重建
+    reindex()
+
+
+@manager.option('kind', choices=('users', 'posts', 'comments'))
+@manager.option('-s', '--since', dest='since', default=None,
+                help='only rows updated at or after this UTC timestamp')
+@manager.option('-o', '--output', dest='output', default=None,
+                help='output file, defaults to stdout')
+@manager.option('-z', '--gzip', dest='compress', action='store_true',
+                default=False)
+def export(kind, since, output, compress):
+    """以 NDJSON 流式导出用户、帖子或评论"""
+    import sys
+    from app.export import export_rows, gzip_stream, parse_since
+    chunks = export_rows(db.engine, kind, parse_since(since),
+                         app.config['FLASKY_EXPORT_CHUNK_SIZE'])
+    if compress:
+        chunks = gzip_stream(chunks)
+    f = open(output, 'wb') if output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+    finally:
+        if output:
+            f.close()
+
+
+@manager.option('-n', '--requests', dest='requests', type=int, default=200,
+                help='requests per endpoint')
+@manager.option('-o', '--output', dest='output',
+                default='benchmarks/results.json')
+@manager.option('-b', '--baseline', dest='baseline',
+                default='benchmarks/baseline.json')
+@manager.option('-t', '--threshold', dest='threshold', type=float,
+                default=0.2, help='allowed slowdown relative to baseline')
+@manager.option('--save-baseline', dest='save_baseline', action='store_true',
+                default=False)
+def benchmark(requests, output, baseline, threshold, save_baseline):
+    """在种子数据库上压测主要端点，并与基线比较"""
+    import sys
+    from benchmarks import endpoints
+    results = endpoints.run(create_app('benchmark'), requests=requests)
+    print(endpoints.report(results))
+    endpoints.save(results, output)
+    if save_baseline:
+        endpoints.save(results, baseline)
+        print('Baseline saved to %s' % baseline)
+        return
+    base = endpoints.load(baseline)
+    if base is None:
+        print('No baseline at %s, run with --save-baseline first' % baseline)
+        return
+    if base.get('dataset') != results['dataset']:
+        print('Warning: dataset differs from baseline')
+    regressions = endpoints.compare(results, base, threshold)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    if regressions:
+        sys.exit(1)
+
+
+@manager.option('-p', '--profile', dest='profiles', action='append',
+                default=None, help='sqlite-default, sqlite-tuned or postgres')
+@manager.option('-u', '--uri', dest='uri', default=None,
+                help='empty scratch database for the postgres profile')
+@manager.option('-r', '--readers', dest='readers', type=int, default=4)
+@manager.option('-w', '--writers', dest='writers', type=int, default=2)
+@manager.option('-d', '--duration', dest='duration', type=float,
+                default=5.0, help='seconds per profile')
+def benchmark_db(profiles, uri, readers, writers, duration):
+    """比较各数据库配置档的并发读写吞吐量"""
+    from benchmarks import database
+    if not profiles:
+        profiles = ['sqlite-default', 'sqlite-tuned']
+        if uri:
+            profiles.append('postgres')
+    print(database.report(database.run(
+        profiles, uri, readers=readers, writers=writers, duration=duration)))
+
+
 @manager.command
 def deploy():
     """Run deployment tasks."""
@@ -69,6 +213,12 @@ def deploy():
     # create self-follows for all users
     User.add_self_follows()
 
+    # fingerprint static files
+    assets()
+
+    # rebuild full-text search index
+    reindex()
+
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,38 @@
+"""denormalized counters
+
+Revision ID: 3f2a1c9d8e47
+Revises: 51f5ccfba190
+Create Date: 2026-10-18 09:12:31.104752
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2a1c9d8e47'
+down_revision = '51f5ccfba190'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('followed_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('follower_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('post_count', sa.Integer(), nullable=True, server_default='0'))
+
+    # 回填已有数据
+    op.execute('UPDATE posts SET comment_count = '
+               '(SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id)')
+    op.execute('UPDATE users SET post_count = '
+               '(SELECT COUNT(*) FROM posts WHERE posts.author_id = users.id)')
+    op.execute('UPDATE users SET follower_count = '
+               '(SELECT COUNT(*) FROM follows WHERE follows.followed_id = users.id)')
+    op.execute('UPDATE users SET followed_count = '
+               '(SELECT COUNT(*) FROM follows WHERE follows.follower_id = users.id)')
+
+
+def downgrade():
+    op.drop_column('users', 'post_count')
+    op.drop_column('users', 'follower_count')
+    op.drop_column('users', 'followed_count')
+    op.drop_column('posts', 'comment_count')
@@ -0,0 +1,26 @@
+"""user comment count
+
+Revision ID: 9d4a2b6c8e31
+Revises: 8c5f1e3b7d26
+Create Date: 2026-10-19 10:05:22.417093
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4a2b6c8e31'
+down_revision = '8c5f1e3b7d26'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('users', sa.Column('comment_count', sa.Integer(), nullable=True, server_default='0'))
+
+    # 回填已有数据
+    op.execute('UPDATE users SET comment_count = '
+               '(SELECT COUNT(*) FROM comments WHERE comments.author_id = users.id)')
+
+
+def downgrade():
+    op.drop_column('users', 'comment_count')
@@ -1,10 +1,13 @@
 import unittest
 import json
 import re
+import time
 from base64 import b64encode
+from datetime import datetime, timedelta
 from flask import url_for
 from app import create_app, db
 from app.models import User, Role, Post, Comment
+from app.api_1_0.authentication import credential_cache
 
 
 class APITestCase(unittest.TestCase):
@@ -14,6 +17,7 @@ class APITestCase(unittest.TestCase):
         self.app_context.push()
         db.create_all()
         Role.insert_roles()
+        credential_cache.clear()
         self.client = self.app.test_client()
 
     def tearDown(self):
@@ -87,6 +91,64 @@ class APITestCase(unittest.TestCase):
             headers=self.get_api_headers(token, ''))
         self.assertTrue(response.status_code == 200)
 
+    def test_credential_cache(self):
+        r = Role.query.filter_by(name='普通用户').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        url = url_for('api.get_user', id=u.id)
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # 第一次请求验证密码并写入缓存，之后直接命中
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        self.assertEqual(len(credential_cache), 1)
+        db.session.remove()
+        response = self.client.get(url_for('api.get_posts'), headers=headers)
+        self.assertTrue(response.status_code == 200)
+        self.assertEqual(credential_cache.hits, 1)
+
+        # 回滚的修改不影响缓存
+        u = User.query.get(u.id)
+        u.password = 'dog'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(len(credential_cache), 1)
+
+        # 修改密码提交后旧凭据失效
+        u.password = 'dog'
+        db.session.add(u)
+        db.session.flush()
+        self.assertEqual(len(credential_cache), 1)
+        db.session.commit()
+        self.assertEqual(len(credential_cache), 0)
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 401)
+
+        # 取消验证后缓存同样失效
+        headers = self.get_api_headers('john@example.com', 'dog')
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        u.confirmed = False
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 403)
+
+        # 令牌的缓存时间不超过它的有效期
+        u.confirmed = True
+        db.session.add(u)
+        db.session.commit()
+        token = u.generate_auth_token(expiration=1)
+        response = self.client.get(url, headers=self.get_api_headers(
+            token, ''))
+        self.assertTrue(response.status_code == 200)
+        time.sleep(2)
+        response = self.client.get(url, headers=self.get_api_headers(
+            token, ''))
+        self.assertTrue(response.status_code == 401)
+
     def test_anonymous(self):
         response = self.client.get(
             url_for('api.get_posts'),
@@ -263,3 +325,311 @@ class APITestCase(unittest.TestCase):
         json_response = json.loads(response.data.decode('utf-8'))
         self.assertIsNotNone(json_response.get('comments'))
         self.assertTrue(json_response.get('count', 0) == 2)
+
+    def test_cursor_pagination(self):
+        # 添加一个用户和 5 个帖子，其中两个时间戳相同
+        r = Role.query.filter_by(name='普通用户').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        now = datetime.utcnow()
+        timestamps = [now, now - timedelta(minutes=1),
+                      now - timedelta(minutes=1), now - timedelta(minutes=2),
+                      now - timedelta(minutes=3)]
+        posts = [Post(body='post %d' % i, author=u, timestamp=t)
+                 for i, t in enumerate(timestamps)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 2
+        expected = [url_for('api.get_post', id=p.id, _external=True)
+                    for p in sorted(posts, key=lambda p: (p.timestamp, p.id),
+                                    reverse=True)]
+
+        # 顺着 next 链接遍历所有页
+        headers = self.get_api_headers('john@example.com', 'cat')
+        url = url_for('api.get_posts', cursor='')
+        urls = []
+        pages = []
+        while url:
+            response = self.client.get(url, headers=headers)
+            self.assertTrue(response.status_code == 200)
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertFalse('count' in json_response)
+            urls += [post['url'] for post in json_response['posts']]
+            pages.append(json_response)
+            url = json_response['next']
+        self.assertEqual(urls, expected)
+        self.assertIsNone(pages[0]['prev'])
+
+        # 从最后一页顺着 prev 链接返回
+        response = self.client.get(pages[-1]['prev'], headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([post['url'] for post in json_response['posts']],
+                         expected[2:4])
+
+        # 只有请求时才返回总数
+        response = self.client.get(url_for('api.get_posts', cursor='',
+                                           count=1), headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['count'] == 5)
+        self.assertTrue('count=1' in json_response['next'])
+
+        # 无效游标
+        response = self.client.get(url_for('api.get_posts', after='bad'),
+                                   headers=headers)
+        self.assertTrue(response.status_code == 400)
+
+    def test_serializers(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        p = Post(body='body', author=u)
+        c = Comment(body='comment', author=u, post=p)
+        db.session.add_all([u, p, c])
+        db.session.commit()
+
+        # URL 模板生成的地址与 url_for 一致
+        with self.app.test_request_context(base_url='https://example.com'):
+            json_post = p.to_json()
+            self.assertEqual(json_post['url'], url_for(
+                'api.get_post', id=p.id, _external=True))
+            self.assertEqual(json_post['author'], url_for(
+                'api.get_user', id=u.id, _external=True))
+            self.assertEqual(json_post['comments'], url_for(
+                'api.get_post_comments', id=p.id, _external=True))
+            self.assertEqual(c.to_json()['post'], json_post['url'])
+            self.assertTrue(u.to_json()['url'].startswith('https://'))
+
+        # 整页输出紧凑的 JSON
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertNotIn('\n  ', data)
+        self.assertNotIn('", "', data)
+        json_response = json.loads(data)
+        self.assertEqual(json_response['posts'][0]['url'],
+                         'http://localhost' + url_for('api.get_post', id=p.id))
+
+    def test_fields_and_embed(self):
+        from sqlalchemy import event
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 3
+        self.app.config['FLASKY_EMBED_COMMENTS'] = 2
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat', confirmed=True) for i in range(4)]
+        db.session.add_all(users)
+        now = datetime.utcnow()
+        for i in range(4):
+            p = Post(body='post %d' % i, author=users[i],
+                     timestamp=now - timedelta(minutes=i))
+            for j in range(i + 1):
+                db.session.add(Comment(
+                    body='comment %d.%d' % (i, j), post=p,
+                    author=users[(i + j) % 4],
+                    timestamp=now - timedelta(minutes=i, seconds=j)))
+            db.session.add(p)
+        db.session.commit()
+        headers = self.get_api_headers('user0@example.com', 'cat')
+
+        # 未知的字段或关联返回 400
+        for query in ('fields=password', 'embed=followers'):
+            response = self.client.get(
+                url_for('api.get_posts') + '?' + query, headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        url = url_for('api.get_posts', fields='url,body',
+                      embed='author,latest_comments')
+        db.session.remove()
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url, headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(response.status_code, 200)
+        # 分页两条、最新评论一条、作者一条，与条目数无关
+        self.assertEqual(len(statements), 4)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertIn('fields=url%2Cbody', json_response['next'])
+        posts = sorted(json_response['posts'], key=lambda p: p['body'])
+        self.assertEqual(len(posts), 3)
+        for i, post in enumerate(posts):
+            self.assertEqual(sorted(post.keys()),
+                             ['author', 'body', 'latest_comments', 'url'])
+            self.assertEqual(post['author']['username'], 'user%d' % i)
+            comments = post['latest_comments']
+            self.assertEqual([c['body'] for c in comments],
+                             ['comment %d.%d' % (i, j)
+                              for j in range(min(i + 1, 2))])
+            for j, comment in enumerate(comments):
+                self.assertEqual(comment['author']['username'],
+                                 'user%d' % ((i + j) % 4))
+
+        # 内嵌对象变化后 ETag 随之改变
+        etag = response.headers['ETag']
+        user = User.query.filter_by(username='user1').first()
+        user.username = 'renamed'
+        db.session.commit()
+        db.session.remove()
+        response = self.client.get(url, headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'renamed', response.data)
+
+        # 评论内嵌所属的帖子
+        response = self.client.get(
+            url_for('api.get_comments', embed='post', fields='body'),
+            headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        comment = json_response['comments'][0]
+        self.assertEqual(sorted(comment.keys()), ['body', 'post'])
+        self.assertTrue(comment['post']['body'].startswith('post '))
+
+    def test_batch(self):
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        self.app.config['FLASKY_API_BATCH_LIMIT'] = 5
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # 批量写帖子，只提交一次，逐条返回结果
+        commits = []
+
+        def after_commit(session):
+            commits.append(session)
+        event.listen(Session, 'after_commit', after_commit)
+        try:
+            response = self.client.post(
+                url_for('api.new_posts'), headers=headers,
+                data=json.dumps({'posts': [
+                    {'body': 'first'}, {'body': ''}, 'bad', {'body': 'third'}]}))
+        finally:
+            event.remove(Session, 'after_commit', after_commit)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(commits), 1)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual([r['status'] for r in results], [201, 400, 400, 201])
+        self.assertEqual(results[0]['post']['body'], 'first')
+        self.assertEqual(results[3]['post']['body_html'], '<p>third</p>')
+        self.assertEqual(Post.query.count(), 2)
+        self.assertEqual(User.query.get(u.id).post_count, 2)
+
+        # 超过批量上限
+        response = self.client.post(
+            url_for('api.new_posts'), headers=headers,
+            data=json.dumps({'posts': [{'body': 'x'}] * 6}))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            url_for('api.new_posts'), headers=headers,
+            data=json.dumps([{'body': 'x'}]))
+        self.assertEqual(response.status_code, 400)
+
+        # 批量评论
+        post_id = Post.query.filter_by(body='first').first().id
+        response = self.client.post(
+            url_for('api.new_post_comments', id=post_id), headers=headers,
+            data=json.dumps({'comments': [{'body': 'a'}, {'body': 'b'}]}))
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual([r['status'] for r in results], [201, 201])
+        self.assertEqual(Post.query.get(post_id).comment_count, 2)
+
+        # 正文类型不对或缺少正文的条目逐条报错，其余照常写入
+        response = self.client.post(
+            url_for('api.new_posts'), headers=headers,
+            data=json.dumps({'posts': [
+                {'body': 'ok'}, {'body': 5}, {'nobody': 1}]}))
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual([r['status'] for r in results], [201, 400, 400])
+        self.assertEqual(results[1]['message'], 'post body must be a string')
+        response = self.client.post(
+            url_for('api.new_post_comments', id=post_id), headers=headers,
+            data=json.dumps({'comments': [{'body': ['a']}, {'body': 'c'}]}))
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual([r['status'] for r in results], [400, 201])
+        self.assertEqual(Post.query.get(post_id).comment_count, 3)
+        Post.query.filter_by(body='ok').delete()
+        db.session.commit()
+
+        # 按 id 批量读取，保持请求的顺序
+        ids = [p.id for p in Post.query.order_by(Post.id.desc())]
+        response = self.client.get(
+            url_for('api.get_posts', ids='%d,999,%d' % tuple(ids)),
+            headers=headers)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([p['body'] for p in json_response['posts']],
+                         ['third', 'first'])
+        self.assertEqual(json_response['missing'], [999])
+        for ids in ('1,x', '1,2,3,4,5,6'):
+            response = self.client.get(url_for('api.get_posts', ids=ids),
+                                       headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_export(self):
+        import gzip
+        admin = User(email='admin@example.com', username='admin',
+                     password='cat', confirmed=True,
+                     role=Role.query.filter_by(permissions=0xff).first())
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        now = datetime.utcnow()
+        posts = [Post(body='post %d' % i, author=u,
+                      timestamp=now - timedelta(days=1))
+                 for i in range(5)]
+        db.session.add_all([admin, u] + posts)
+        db.session.commit()
+
+        # 只有管理员可以导出
+        response = self.client.get(
+            url_for('api.export', kind='posts'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 403)
+
+        headers = self.get_api_headers('admin@example.com', 'cat')
+        self.app.config['FLASKY_EXPORT_CHUNK_SIZE'] = 2
+        response = self.client.get(url_for('api.export', kind='posts'),
+                                   headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        lines = response.get_data(as_text=True).splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([r['body'] for r in rows],
+                         ['post %d' % i for i in range(5)])
+        self.assertEqual(rows[0]['author_id'], u.id)
+
+        # 增量导出只包含之后修改过的行
+        since = datetime.utcnow()
+        time.sleep(0.01)
+        post = Post.query.filter_by(body='post 3').first()
+        post.body = 'edited'
+        db.session.commit()
+        response = self.client.get(
+            url_for('api.export', kind='posts', since=since.isoformat()),
+            headers=headers)
+        rows = [json.loads(line) for line in
+                response.get_data(as_text=True).splitlines()]
+        self.assertEqual([r['body'] for r in rows], ['edited'])
+
+        # gzip 封装，用户不包含密码哈希
+        response = self.client.get(
+            url_for('api.export', kind='users', gzip=1), headers=headers)
+        self.assertEqual(response.mimetype, 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(
+            response.get_data()).decode('utf-8').splitlines()]
+        self.assertEqual(sorted(r['username'] for r in rows),
+                         ['admin', 'john'])
+        self.assertNotIn('password_hash', rows[0])
+
+        for url in (url_for('api.export', kind='roles'),
+                    url_for('api.export', kind='posts', since='yesterday')):
+            response = self.client.get(url, headers=headers)
+            self.assertIn(response.status_code, (400, 404))
@@ -0,0 +1,81 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from flask import url_for
+from app import create_app, assets
+from app.assets import build
+
+
+class AssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.static_folder = tempfile.mkdtemp()
+        with open(os.path.join(self.static_folder, 'styles.css'), 'w') as f:
+            f.write('body { margin: 0; }\n' * 100)
+        with open(os.path.join(self.static_folder, 'logo.png'), 'wb') as f:
+            f.write(os.urandom(1000))
+        self.app.static_folder = self.static_folder
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.static_folder)
+
+    def build(self):
+        manifest = build(self.static_folder, 'build',
+                         self.app.config['FLASKY_COMPRESS_LEVELS'])
+        assets.load(self.app)
+        return manifest
+
+    def test_build(self):
+        manifest = self.build()
+        self.assertEqual(sorted(manifest), ['logo.png', 'styles.css'])
+        css = os.path.join(self.static_folder, manifest['styles.css'])
+        self.assertRegex(manifest['styles.css'],
+                         r'^build/styles\.[0-9a-f]{12}\.css$')
+        with open(css + '.gz', 'rb') as f:
+            with open(css, 'rb') as original:
+                self.assertEqual(gzip.decompress(f.read()), original.read())
+        # 图片不预压缩，重复生成时不会把输出目录当作源文件
+        self.assertFalse(os.path.exists(os.path.join(
+            self.static_folder, manifest['logo.png'] + '.gz')))
+        self.assertEqual(self.build(), manifest)
+
+        # 内容变了摘要也变
+        with open(os.path.join(self.static_folder, 'styles.css'), 'a') as f:
+            f.write('p { color: red; }\n')
+        self.assertNotEqual(self.build()['styles.css'], manifest['styles.css'])
+
+    def test_serve(self):
+        # 没有 manifest 时保持原来的 URL 和缓存首部
+        with self.app.test_request_context():
+            url = url_for('static', filename='styles.css')
+        self.assertEqual(url, '/static/styles.css')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+
+        manifest = self.build()
+        with self.app.test_request_context():
+            url = url_for('static', filename='styles.css')
+        self.assertEqual(url, '/static/' + manifest['styles.css'])
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        self.assertNotIn('Expires', response.headers)
+        body = gzip.decompress(response.get_data())
+        response.close()
+
+        response = self.client.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(), body)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
@@ -0,0 +1,68 @@
+import unittest
+from flask import url_for
+from sqlalchemy import event
+from app import create_app, db
+from app.models import User, Role, Post
+from benchmarks.endpoints import percentile, measure, compare
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 95), 95)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_measure(self):
+        u = User(email='john@example.com', username='john',
+                 password='cat', confirmed=True)
+        db.session.add(Post(body='hello', author=u))
+        db.session.commit()
+        with self.app.test_request_context():
+            # 不在匿名页面缓存范围内，每次请求都会查询
+            url = url_for('main.followers', username='john')
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = measure(self.app.test_client(), url, 3, warmup=1,
+                             queries=queries)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(result['requests'], 3)
+        self.assertEqual(result['errors'], 0)
+        self.assertTrue(result['p50'] <= result['p95'] <= result['p99'])
+        self.assertTrue(result['bytes'] > 0)
+        self.assertTrue(result['queries'] > 0)
+
+    def test_compare(self):
+        baseline = {'scenarios': {'anonymous': {'main.index': {
+            'p50': 10.0, 'p95': 20.0, 'bytes': 1000, 'queries': 2}}}}
+        current = {'scenarios': {'anonymous': {
+            'main.index': {'p50': 11.0, 'p95': 30.0, 'bytes': 1000,
+                           'queries': 3},
+            'main.user': {'p50': 1.0, 'p95': 1.0, 'bytes': 1,
+                          'queries': 1}}}}
+        regressions = compare(current, baseline, threshold=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith(
+            'anonymous main.index: p95'))
+        self.assertTrue(regressions[1].startswith(
+            'anonymous main.index: queries'))
+        self.assertEqual(compare(baseline, baseline), [])
@@ -1,8 +1,10 @@
 import re
 import unittest
-from flask import url_for
+from contextlib import contextmanager
+from flask import url_for, template_rendered
+from sqlalchemy import event
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post, Comment
 
 class FlaskClientTestCase(unittest.TestCase):
     def setUp(self):
@@ -18,6 +20,145 @@ class FlaskClientTestCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+    def add_posts(self, start, stop):
+        for i in range(start, stop):
+            u = User(email='user%d@example.com' % i, username='user%d' % i,
+                     password='cat', confirmed=True)
+            p = Post(body='post %d' % i, author=u)
+            c = Comment(body='comment %d' % i, author=u, post=p)
+            db.session.add_all([u, p, c])
+        db.session.commit()
+
+    def test_listing_query_count(self):
+        # 列表页的查询次数固定，不随每页条目数增长
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 5
+        self.app.config['FLASKY_COMMENTS_PER_PAGE'] = 5
+        expected = {
+            url_for('main.index'): 2,
+            url_for('main.user', username='user0'): 2,
+            url_for('main.post', id=1): 2
+        }
+        for count in (6, 25):
+            self.add_posts(Post.query.count(), count)
+            post = Post.query.get(1)
+            for i in range(count):
+                db.session.add(Comment(body='reply', post=post,
+                                       author=User.query.get(i + 1)))
+            db.session.commit()
+            for url, queries in expected.items():
+                db.session.remove()
+                with self.count_queries() as statements:
+                    response = self.client.get(url)
+                self.assertTrue(response.status_code == 200)
+                self.assertEqual(len(statements), queries)
+
+    def test_listing_query_count_authenticated(self):
+        # 登录用户绕过整页缓存，查询次数同样不随条目数增长
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 5
+        self.app.config['FLASKY_COMMENTS_PER_PAGE'] = 5
+        self.add_posts(0, 1)
+        self.client.post(url_for('auth.login'), data={
+            'email': 'user0@example.com', 'password': 'cat'})
+        urls = [url_for('main.index'),
+                url_for('main.user', username='user0'),
+                url_for('main.post', id=1)]
+        counts = []
+        for count in (6, 25):
+            self.add_posts(Post.query.count(), count)
+            post = Post.query.get(1)
+            for i in range(count):
+                db.session.add(Comment(body='reply', post=post,
+                                       author=User.query.get(i + 1)))
+            db.session.commit()
+            # 写入后身份快照会重新加载，先预热
+            db.session.remove()
+            self.client.get(urls[0])
+            queries = []
+            for url in urls:
+                db.session.remove()
+                with self.count_queries() as statements:
+                    response = self.client.get(url)
+                self.assertTrue(response.status_code == 200)
+                self.assertIn('登出', response.get_data(as_text=True))
+                queries.append(len(statements))
+            counts.append(queries)
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[1], [2, 2, 2])
+
+    def test_conditional_get(self):
+        self.add_posts(0, 3)
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, self.app)
+        try:
+            for url in (url_for('main.index'), url_for('main.post', id=1),
+                        url_for('api.get_post_comments', id=1)):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+                self.assertIsNotNone(response.last_modified)
+
+                # 验证器未变时返回 304，不渲染模板
+                del rendered[:]
+                response = self.client.get(
+                    url, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.data, b'')
+                self.assertEqual(response.headers['ETag'], etag)
+                self.assertEqual(rendered, [])
+
+            # 新评论改变帖子的版本
+            db.session.add(Comment(body='new', post=Post.query.get(1),
+                                   author=User.query.get(2)))
+            db.session.commit()
+            db.session.remove()
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+        finally:
+            template_rendered.disconnect(record, self.app)
+
+        # 登录后首页的 ETag 随浏览者变化
+        url = url_for('main.index')
+        etag = self.client.get(url).headers['ETag']
+        self.client.post(url_for('auth.login'), data={
+            'email': 'user0@example.com', 'password': 'cat'})
+        db.session.remove()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_conditional_user_page(self):
+        self.add_posts(0, 2)
+        url = url_for('main.user', username='user0')
+        etag = self.client.get(url).headers['ETag']
+
+        # 用户页显示评论数，评论的作者不变时也要改变版本
+        db.session.add(Comment(body='new', post=Post.query.get(2),
+                               author=User.query.get(1)))
+        db.session.commit()
+        db.session.remove()
+        self.app.extensions['page_cache'].clear()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(b'2 comments', response.data)
+
     def test_home_page(self):
         response = self.client.get(url_for('main.index'))
         self.assertTrue('欢迎'.encode() in response.data)
@@ -0,0 +1,117 @@
+import gzip
+import unittest
+import zlib
+from flask import url_for
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+from app import create_app, db
+from app.compress import CompressMiddleware
+from app.models import User, Role, Post
+
+
+def make_app(body, content_type='text/html', streaming=False, headers=None):
+    def app(environ, start_response):
+        chunks = [body[i:i + 100] for i in range(0, len(body), 100)]
+        if streaming:
+            response = Response((chunk for chunk in chunks),
+                                content_type=content_type)
+        else:
+            response = Response(body, content_type=content_type)
+        for key, value in (headers or {}).items():
+            response.headers[key] = value
+        return response(environ, start_response)
+    return CompressMiddleware(app, {'text/*': 6, 'application/json': 1},
+                              min_size=500)
+
+
+class CompressMiddlewareTestCase(unittest.TestCase):
+    body = b'hello world ' * 200
+
+    def get(self, app, encoding='gzip', **kwargs):
+        headers = kwargs.pop('headers', {})
+        if encoding:
+            headers['Accept-Encoding'] = encoding
+        return Client(app, BaseResponse).get('/', headers=headers, **kwargs)
+
+    def test_negotiation(self):
+        app = make_app(self.body)
+        response = self.get(app)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(gzip.decompress(response.data), self.body)
+
+        response = self.get(app, 'gzip;q=0.5, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), self.body)
+
+        for encoding in (None, 'gzip;q=0', 'br'):
+            response = self.get(app, encoding)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, self.body)
+
+    def test_skipped(self):
+        # 小响应、未列出的类型和已编码的响应原样返回
+        response = self.get(make_app(b'short'))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, b'short')
+
+        response = self.get(make_app(self.body, content_type='image/png'))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertNotIn('Vary', response.headers)
+        self.assertEqual(response.data, self.body)
+
+        response = self.get(make_app(self.body, headers={
+            'Content-Encoding': 'identity'}))
+        self.assertEqual(response.headers['Content-Encoding'], 'identity')
+        self.assertEqual(response.data, self.body)
+
+    def test_streaming(self):
+        app = make_app(self.body, streaming=True)
+        response = self.get(app)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), self.body)
+        # 流式响应小于阈值时不压缩
+        response = self.get(make_app(b'short', streaming=True))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, b'short')
+
+    def test_etag(self):
+        app = make_app(self.body, headers={'ETag': '"abc"'})
+        response = self.get(app)
+        self.assertEqual(response.headers['ETag'], '"abc-gzip"')
+        self.assertEqual(self.get(app, None).headers['ETag'], '"abc"')
+
+
+class CompressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_conditional_get(self):
+        u = User(email='john@example.com', username='john',
+                 password='cat', confirmed=True)
+        db.session.add_all([u] + [Post(body='post %d' % i, author=u)
+                                  for i in range(10)])
+        db.session.commit()
+        for url in (url_for('main.index'), url_for('api.get_posts')):
+            response = self.client.get(url, headers={
+                'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            etag = response.headers['ETag']
+            self.assertTrue(etag.endswith('-gzip"'))
+
+            # 带压缩后缀的 ETag 仍能命中，304 沿用同一个 ETag
+            response = self.client.get(url, headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
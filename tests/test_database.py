@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy.pool import NullPool, QueuePool
+from app import create_app, db
+from config import ProductionConfig
+
+
+class DatabaseTuningTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+            os.path.join(self.directory, 'tuned.sqlite')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def pragma(self, name):
+        return db.session.execute('PRAGMA %s' % name).scalar()
+
+    def test_defaults(self):
+        self.assertIsInstance(db.engine.pool, NullPool)
+        self.assertEqual(self.pragma('journal_mode'), 'delete')
+
+    def test_production_profile(self):
+        self.app.config.update(
+            FLASKY_SQLITE_PRAGMAS=ProductionConfig.FLASKY_SQLITE_PRAGMAS,
+            FLASKY_SQLITE_OPTIMIZE=True,
+            SQLALCHEMY_POOL_SIZE=2,
+            SQLALCHEMY_POOL_TIMEOUT=5)
+        self.assertIsInstance(db.engine.pool, QueuePool)
+        db.create_all()
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -20000)
+        self.assertEqual(self.pragma('temp_store'), 2)
+        db.session.remove()
+
+        # 连接池中的连接关闭前执行 PRAGMA optimize
+        statements = []
+
+        def trace(statement):
+            statements.append(statement)
+        connection = db.engine.raw_connection()
+        connection.connection.set_trace_callback(trace)
+        connection.close()
+        db.dispose()
+        self.assertIn('PRAGMA optimize', statements)
@@ -0,0 +1,253 @@
+import os
+import socket
+import socketserver
+import threading
+import time
+import unittest
+from email import message_from_bytes
+from email.header import decode_header, make_header
+from unittest import mock
+from flask_mail import Connection, Message
+from app import create_app, db
+from app.email import send_email, EmailTemplates
+from app.models import User
+from app.mailqueue import DeliveryPool
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """只实现发送邮件用到的几条命令"""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            if server.refuse > 0:
+                # 模拟服务器暂时不可用：接受连接后立刻断开
+                server.refuse -= 1
+                return
+        self.reply('220 localhost ESMTP')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode('ascii').strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'RCPT':
+                if 'rejected' in line:
+                    self.reply('550 no such user')
+                    continue
+                if 'busy' in line:
+                    with server.lock:
+                        busy = server.busy > 0
+                        server.busy -= busy
+                    if busy:
+                        self.reply('451 try again later')
+                        continue
+                recipients.append(line)
+                self.reply('250 ok')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk == b'.\r\n':
+                        break
+                    data.append(chunk)
+                with server.lock:
+                    server.messages.append(message_from_bytes(b''.join(data)))
+                recipients = []
+                self.reply('250 queued')
+            else:
+                self.reply('250 ok')
+
+
+class SMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.refuse = 0
+        self.busy = 0
+        self.messages = []
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.app = create_app('testing')
+        state = self.app.extensions['mail']
+        state.server, state.port = self.server.server_address
+        state.use_ssl = False
+        state.username = state.password = None
+        state.suppress = False
+        self.pool = self.app.extensions['mail_queue']
+        self.pool.backoff = 0.01
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.pool.stop(timeout=5)
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def message(self, to):
+        return Message('hello', sender='test@example.com', recipients=[to],
+                       body='body')
+
+    def test_batching(self):
+        # 单个线程在一个连接上发完积压的邮件
+        self.pool.workers = 1
+        for i in range(10):
+            self.assertTrue(self.pool.put(self.message('u%d@example.com' % i)))
+        self.pool.stop(timeout=5)
+        self.assertEqual(len(self.server.messages), 10)
+        self.assertEqual(self.server.connections, 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['enqueued'], 10)
+        self.assertEqual(stats['sent'], 10)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['depth'], 0)
+        self.assertGreater(stats['max'], 0)
+
+    def test_retry(self):
+        self.server.refuse = 2
+        self.pool.put(self.message('john@example.com'))
+        self.pool.stop(timeout=5)
+        self.assertEqual(len(self.server.messages), 1)
+        stats = self.pool.stats()
+        self.assertEqual((stats['sent'], stats['retried'], stats['failed']),
+                         (1, 2, 0))
+
+        # 超过重连次数后邮件放回队列，之后的发送线程再发
+        self.server.refuse = self.pool.retries + 1
+        self.pool.workers = 1
+        self.pool.put(self.message('susan@example.com'))
+        self.pool.stop(timeout=5)
+        stats = self.pool.stats()
+        self.assertEqual((stats['failed'], stats['requeued'], stats['depth']),
+                         (0, 1, 1))
+        self.assertEqual(len(self.server.messages), 1)
+        self.pool.start()
+        self.pool.stop(timeout=5)
+        self.assertEqual(self.pool.stats()['sent'], 2)
+        self.assertEqual(self.server.messages[-1]['To'], 'susan@example.com')
+
+    def test_server_down(self):
+        # 一直连不上服务器时，每次放弃连接整批邮件都记一次失败，
+        # 超过重试次数后放弃，队列不会被反复放回的邮件占满
+        self.pool.workers = 1
+        self.pool.retries = 1
+        with mock.patch.object(Connection, '__enter__',
+                               side_effect=socket.error('unreachable')):
+            for i in range(3):
+                self.pool.put(self.message('u%d@example.com' % i))
+            deadline = time.time() + 5
+            while self.pool.stats()['failed'] < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            self.pool.stop(timeout=5)
+        stats = self.pool.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['depth']),
+                         (0, 3, 0))
+        self.assertEqual(self.server.connections, 0)
+
+    def test_transient(self):
+        # 暂时错误只重试出错的那封邮件，不影响同一批的其他邮件
+        self.server.busy = 100
+        self.pool.workers = 1
+        self.pool.put(self.message('busy@example.com'))
+        for i in range(5):
+            self.pool.put(self.message('u%d@example.com' % i))
+        self.pool.stop(timeout=5)
+        stats = self.pool.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']),
+                         (5, 1, self.pool.retries))
+        self.assertEqual(self.server.connections, 1)
+
+        # 重试成功
+        self.server.busy = 1
+        self.pool.put(self.message('busy@example.com'))
+        self.pool.stop(timeout=5)
+        stats = self.pool.stats()
+        self.assertEqual((stats['sent'], stats['failed']), (6, 1))
+        self.assertEqual(self.server.messages[-1]['To'], 'busy@example.com')
+
+    def test_rejected(self):
+        # 服务器拒收的邮件不重试，也不影响同一批的其他邮件
+        self.pool.workers = 1
+        self.pool.put(self.message('rejected@example.com'))
+        self.pool.put(self.message('john@example.com'))
+        self.pool.stop(timeout=5)
+        stats = self.pool.stats()
+        self.assertEqual((stats['sent'], stats['retried'], stats['failed']),
+                         (1, 0, 1))
+        self.assertEqual(self.server.messages[0]['To'], 'john@example.com')
+
+    def test_queue_full(self):
+        pool = DeliveryPool(self.app, workers=1, maxsize=1, batch_size=1,
+                            retries=0, backoff=0, idle_timeout=1,
+                            enqueue_timeout=0)
+        # 不启动发送线程
+        pool.pid = os.getpid()
+        self.assertTrue(pool.put(self.message('a@example.com')))
+        self.assertFalse(pool.put(self.message('b@example.com')))
+        stats = pool.stats()
+        self.assertEqual((stats['enqueued'], stats['dropped'], stats['depth']),
+                         (1, 1, 1))
+
+    def test_send_email(self):
+        # 模板在发送线程中渲染，链接使用入队时请求的主机名
+        threads = []
+        render = EmailTemplates.render
+
+        def record(*args):
+            threads.append(threading.current_thread().name)
+            return render(*args)
+
+        db.create_all()
+        user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(user)
+        db.session.commit()
+        try:
+            with mock.patch.object(EmailTemplates, 'render', record):
+                with self.app.test_request_context(
+                        base_url='http://example.org'):
+                    token = user.generate_confirmation_token()
+                    self.assertTrue(send_email(
+                        'john@example.com', '验证账户', 'auth/email/confirm',
+                        user=user, token=token))
+                    self.assertEqual(threads, [])
+                # 请求结束，会话中的对象已过期
+                db.session.remove()
+                self.pool.stop(timeout=5)
+        finally:
+            db.session.remove()
+            db.drop_all()
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith('mail-worker')
+                            for name in threads))
+        message = self.server.messages[0]
+        self.assertIn('验证账户', str(make_header(decode_header(
+            message['Subject']))))
+        text = [part for part in message.walk()
+                if part.get_content_type() == 'text/plain'][0]\
+            .get_payload(decode=True).decode('utf-8')
+        self.assertIn('john', text)
+        self.assertIn('http://example.org/auth/confirm/' + token.decode(),
+                      text)
+
+    def test_templates(self):
+        templates = self.app.extensions['email_templates']
+        self.assertIn('auth/email/confirm.txt', templates)
+        self.assertIn('mail/new_user.html', templates)
+        self.assertNotIn('auth/login.html', templates)
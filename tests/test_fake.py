@@ -0,0 +1,60 @@
+import unittest
+from app import create_app, db
+from app.fake import seed
+from app.models import User, Role, Follow, Post, Comment
+
+
+class SeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def generate(self):
+        # 批量大小不整除行数，最后一批不满
+        return seed(users=23, posts=31, comments=47, follows=4, seed=7,
+                    batch_size=5, workers=1)
+
+    def snapshot(self):
+        return (sorted((f.follower_id, f.followed_id)
+                       for f in Follow.query),
+                [(p.id, p.author_id, p.body)
+                 for p in Post.query.order_by(Post.id)],
+                [(c.id, c.author_id, c.post_id)
+                 for c in Comment.query.order_by(Comment.id)])
+
+    def test_seed(self):
+        counts = self.generate()
+        self.assertEqual(counts, {'users': 23,
+                                  'follows': Follow.query.count(),
+                                  'posts': 31, 'comments': 47})
+        self.assertEqual(User.query.count(), 23)
+        self.assertEqual(Post.query.count(), 31)
+        self.assertEqual(Comment.query.count(), 47)
+        # 每个用户都关注自己
+        self.assertEqual(Follow.query.filter(
+            Follow.follower_id == Follow.followed_id).count(), 23)
+
+        # 冗余计数已经回填，再次核对没有需要修正的行
+        self.assertEqual(sum(User.reconcile_counts().values()), 0)
+        self.assertEqual(sum(Post.reconcile_counts().values()), 0)
+        self.assertEqual(sum(u.post_count for u in User.query), 31)
+        self.assertEqual(sum(u.comment_count for u in User.query), 47)
+        self.assertEqual(sum(u.follower_count for u in User.query),
+                         counts['follows'])
+
+        # 同样的种子生成同样的数据
+        data = self.snapshot()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        self.assertEqual(self.generate(), counts)
+        self.assertEqual(self.snapshot(), data)
@@ -0,0 +1,197 @@
+import unittest
+from datetime import datetime
+from flask import url_for
+from sqlalchemy import event
+from app import create_app, db
+from app.cache import TaggedCache
+from app.models import User, Role, Post, Comment, last_seen_buffer
+
+
+class TaggedCacheTestCase(unittest.TestCase):
+    def test_invalidate(self):
+        cache = TaggedCache(maxsize=2)
+        cache.set('a', 1, tags=['x', 'y'])
+        cache.set('b', 2, tags=['y'])
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.invalidate('x'), 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.invalidate('y', 'z'), 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        cache = TaggedCache(maxsize=2)
+        cache.set('a', 1, tags=['x'])
+        cache.set('b', 2, tags=['x'])
+        cache.get('a')
+        cache.set('c', 3, tags=['x'])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.invalidate('x'), 2)
+        self.assertEqual(cache._tags, {})
+
+    def test_generation(self):
+        # 渲染期间发生过失效，渲染结果不写入
+        cache = TaggedCache()
+        generation = cache.generation
+        cache.invalidate('x')
+        cache.set('a', 1, tags=['x'], generation=generation)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1, tags=['x'], generation=cache.generation)
+        self.assertEqual(cache.get('a'), 1)
+
+
+class PageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+        self.pages = self.app.extensions['page_cache']
+        self.fragments = self.app.extensions['fragment_cache']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url):
+        # 返回响应和请求期间执行的查询数
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.session.remove()
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(response.status_code, 200)
+        return response, len(statements)
+
+    def assertCached(self, url):
+        response, queries = self.get(url)
+        self.assertEqual(queries, 0)
+        return response
+
+    def assertMissed(self, url):
+        response, queries = self.get(url)
+        self.assertTrue(queries > 0)
+        return response
+
+    def test_anonymous_pages(self):
+        u = User(email='john@example.com', username='john',
+                 password='cat', confirmed=True)
+        p = Post(body='hello', author=u)
+        c = Comment(body='first', author=u, post=p)
+        db.session.add_all([u, p, c])
+        db.session.commit()
+        user_id, post_id, comment_id = u.id, p.id, c.id
+        urls = (url_for('main.index'), url_for('main.user', username='john'),
+                url_for('main.post', id=post_id))
+        for url in urls:
+            first = self.assertMissed(url)
+            second = self.assertCached(url)
+            self.assertEqual(first.data, second.data)
+            self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+
+        # 修改帖子后，包含它的页面都失效
+        post = Post.query.get(post_id)
+        post.body = 'edited'
+        db.session.commit()
+        for url in urls:
+            self.assertTrue(b'edited' in self.assertMissed(url).data)
+
+        # 屏蔽评论后帖子页面失效
+        self.assertCached(urls[2])
+        comment = Comment.query.get(comment_id)
+        comment.disabled = True
+        db.session.commit()
+        self.assertMissed(urls[2])
+
+        # 用户页显示评论数，作者在别人的帖子下评论或评论换了作者后失效
+        other = User(email='susan@example.com', username='susan',
+                     password='dog', confirmed=True)
+        other_post = Post(body='other', author=other)
+        db.session.add_all([other, other_post])
+        db.session.commit()
+        other_id, other_post_id = other.id, other_post.id
+        other_url = url_for('main.user', username='susan')
+        self.assertMissed(urls[1])
+        self.assertMissed(other_url)
+        # 只设置外键，不经过关系，作者对象不会被标记为已修改
+        db.session.add(Comment(body='second', author_id=user_id,
+                               post_id=other_post_id))
+        db.session.commit()
+        self.assertTrue(b'2 comments' in self.assertMissed(urls[1]).data)
+        self.assertMissed(other_url)
+        comment = Comment.query.get(comment_id)
+        comment.author_id = other_id
+        db.session.commit()
+        self.assertTrue(b'1 comments' in self.assertMissed(urls[1]).data)
+        self.assertTrue(b'1 comments' in self.assertMissed(other_url).data)
+
+        # 修改资料影响所有显示该用户的页面
+        user = User.query.get(user_id)
+        user.location = 'Somewhere'
+        db.session.commit()
+        for url in urls:
+            self.assertMissed(url)
+
+        # 回滚的修改不会使缓存失效
+        post = Post.query.get(post_id)
+        post.body = 'discarded'
+        db.session.flush()
+        db.session.rollback()
+        for url in urls:
+            self.assertCached(url)
+
+        # 写回 last_seen 后用户页面失效
+        last_seen_buffer.add(db.engine, user_id, datetime.utcnow(), 0, 1)
+        self.assertMissed(urls[1])
+        self.assertCached(urls[0])
+
+    def test_new_post(self):
+        u = User(email='john@example.com', username='john',
+                 password='cat', confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        url = url_for('main.index')
+        self.assertMissed(url)
+        self.assertCached(url)
+        db.session.add(Post(body='hello', author=User.query.get(user_id)))
+        db.session.commit()
+        self.assertTrue(b'hello' in self.assertMissed(url).data)
+
+    def test_authenticated_fragments(self):
+        u1 = User(email='john@example.com', username='john',
+                  password='cat', confirmed=True)
+        u2 = User(email='susan@example.com', username='susan',
+                  password='dog', confirmed=True)
+        db.session.add_all([u1, u2, Post(body='hello', author=u1)])
+        db.session.commit()
+        self.client.post(url_for('auth.login'), data={
+            'email': 'john@example.com', 'password': 'cat'})
+        url = url_for('main.index')
+
+        # 登录用户不使用整页缓存，但复用帖子条目
+        response, queries = self.get(url)
+        self.assertTrue(b'label label-default">\xe7\xbc\x96\xe8\xbe\x91' in
+                        response.data)
+        self.assertEqual(len(self.pages), 0)
+        self.assertEqual(len(self.fragments), 1)
+        hits = self.fragments.hits
+        self.get(url)
+        self.assertEqual(self.fragments.hits, hits + 1)
+
+        # 其他用户看不到编辑链接，使用另一个条目
+        self.client.get(url_for('auth.logout'))
+        self.client.post(url_for('auth.login'), data={
+            'email': 'susan@example.com', 'password': 'dog'})
+        response, queries = self.get(url)
+        self.assertFalse('编辑'.encode('utf-8') in response.data)
+        self.assertEqual(len(self.fragments), 2)
@@ -0,0 +1,80 @@
+import unittest
+from flask import url_for
+from app import create_app, db, profiler
+from app.models import User, Role, Post
+from app.profiler import fingerprint, Histogram
+
+
+class QueryProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_PROFILER_SAMPLE_RATE'] = 1.0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, email):
+        with self.app.test_request_context():
+            url = url_for('auth.login')
+        return self.client.post(url, data={'email': email,
+                                           'password': 'cat'})
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT *\n  FROM users WHERE id = 42 AND "
+                        "email = 'o''neil@example.com' LIMIT ? OFFSET ?"),
+            'SELECT * FROM users WHERE id = ? AND email = ? '
+            'LIMIT ? OFFSET ?')
+        self.assertEqual(
+            fingerprint('SELECT users_1.id FROM users AS users_1 '
+                        'WHERE users_1.id IN (?, ?, ?)'),
+            fingerprint('SELECT users_1.id FROM users AS users_1 '
+                        'WHERE users_1.id IN (%(id_1)s, %(id_2)s)'))
+
+    def test_histogram(self):
+        h = Histogram()
+        for ms in (0.5, 0.5, 3, 3, 3, 40, 2000):
+            h.add(ms / 1000.0)
+        self.assertEqual(h.count, 7)
+        self.assertEqual(h.buckets[0], 2)
+        self.assertEqual(h.buckets[-1], 1)
+        self.assertEqual(h.percentile(50), 0.005)
+        self.assertEqual(h.percentile(100), 2.0)
+
+    def test_admin_page(self):
+        admin = Role.query.filter_by(permissions=0xff).first()
+        u1 = User(email='john@example.com', username='john', password='cat',
+                  confirmed=True, role=admin)
+        u2 = User(email='susan@example.com', username='susan',
+                  password='cat', confirmed=True)
+        db.session.add_all([u1, u2, Post(body='hello', author=u2)])
+        db.session.commit()
+        db.session.remove()
+        with self.app.test_request_context():
+            index = url_for('main.index')
+            page = url_for('main.query_profile')
+
+        self.login('susan@example.com')
+        self.client.get(index)
+        self.assertEqual(self.client.get(page).status_code, 403)
+
+        self.login('john@example.com')
+        response = self.client.get(page)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b'main.index' in response.data)
+        statements = profiler.statements()
+        self.assertTrue(statements)
+        self.assertTrue(any(s['plan'] and 'posts' in s['plan']
+                            for s in statements))
+        endpoints = {e['endpoint']: e for e in profiler.endpoints()}
+        self.assertTrue(endpoints['main.index']['queries'] >= 2)
+
+        profiler.reset()
+        self.assertEqual(profiler.statements(), [])
@@ -0,0 +1,131 @@
+import json
+import re
+import unittest
+from base64 import b64encode
+from flask import url_for
+from app import create_app, db, profiler
+from app.models import User, Role, Post, Comment
+
+# 整表读入缓存的小表，全表扫描无妨
+SMALL_TABLES = ('roles',)
+
+
+def plan_problems(plan):
+    """执行计划中的全表扫描和临时 B 树排序"""
+    problems = []
+    for line in plan.splitlines():
+        detail = line.split(' | ')[-1]
+        if 'TEMP B-TREE' in detail:
+            problems.append(detail)
+        elif detail.startswith('SCAN ') and ' USING ' not in detail:
+            # 旧版 SQLite 输出 SCAN TABLE posts，新版输出 SCAN posts
+            words = detail.split()
+            name = words[2] if words[1] == 'TABLE' else words[1]
+            table = re.sub(r'_\d+$', '', name)
+            if table in db.metadata.tables and table not in SMALL_TABLES:
+                problems.append(detail)
+    return problems
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_PROFILER_SAMPLE_RATE'] = 1.0
+        # 每页一条，分页时才会执行 COUNT 和 OFFSET
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 1
+        self.app.config['FLASKY_COMMENTS_PER_PAGE'] = 1
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        admin = Role.query.filter_by(permissions=0xff).first()
+        john = User(email='john@example.com', username='john',
+                    password='cat', confirmed=True, role=admin)
+        susan = User(email='susan@example.com', username='susan',
+                     password='cat', confirmed=True)
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(susan)
+        posts = [Post(body='post %d' % i, author=author)
+                 for i in range(2) for author in (john, susan)]
+        db.session.add_all(posts)
+        db.session.add_all([Comment(body='comment %d' % i, post=posts[0],
+                                    author=susan, disabled=False)
+                            for i in range(2)])
+        db.session.commit()
+        self.ids = {'john': john.id, 'susan': susan.id, 'post': posts[0].id}
+        db.session.remove()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, **kwargs):
+        db.session.remove()
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, 200, url)
+        return response
+
+    def test_plan_problems(self):
+        self.assertEqual(plan_problems(
+            '2 | 0 | 0 | SEARCH posts USING INDEX ix_posts_timestamp\n'
+            '3 | 0 | 0 | SCAN roles'), [])
+        self.assertEqual(plan_problems(
+            '3 | 0 | 0 | SCAN TABLE comments\n'
+            '9 | 0 | 0 | USE TEMP B-TREE FOR ORDER BY'),
+            ['SCAN TABLE comments', 'USE TEMP B-TREE FOR ORDER BY'])
+
+    def test_hot_queries(self):
+        ids = self.ids
+        headers = {
+            'Authorization': 'Basic ' + b64encode(
+                b'john@example.com:cat').decode('utf-8'),
+            'Accept': 'application/json'
+        }
+        with self.app.test_request_context():
+            views = [url_for('main.index', page=2),
+                     url_for('main.user', username='susan', page=2),
+                     url_for('main.post', id=ids['post'], page=2),
+                     url_for('main.followers', username='susan'),
+                     url_for('main.followed_by', username='john'),
+                     url_for('main.moderate', page=2)]
+            api = []
+            for endpoint, values in (
+                    ('api.get_posts', {}),
+                    ('api.get_comments', {}),
+                    ('api.get_post_comments', {'id': ids['post']}),
+                    ('api.get_user_posts', {'id': ids['susan']}),
+                    ('api.get_user_followed_posts', {'id': ids['john']})):
+                api.append(url_for(endpoint, page=2, **values))
+                api.append(url_for(endpoint, cursor='', count=1, **values))
+            login = url_for('auth.login')
+        self.client.post(login, data={'email': 'john@example.com',
+                                      'password': 'cat'})
+        for url in views:
+            self.get(url)
+        # 首页的关注动态即 User.followed_posts
+        self.client.set_cookie('localhost', 'show_followed', '1')
+        self.get(views[0])
+        for url in api:
+            response = self.get(url, headers=headers)
+            next = json.loads(response.get_data(as_text=True))['next']
+            if 'cursor' in url:
+                # 游标分页的第二页带有游标条件
+                self.get(next, headers=headers)
+
+        statements = profiler.statements(limit=1000)
+        self.assertTrue(any('FROM follows' in s['fingerprint']
+                            for s in statements))
+        failures = []
+        for s in statements:
+            if s['plan'] is None:
+                continue
+            problems = ['EXPLAIN failed'] \
+                if s['plan'].startswith('EXPLAIN failed') \
+                else plan_problems(s['plan'])
+            if problems:
+                failures.append('%s\n  %s' % (s['fingerprint'],
+                                              '\n  '.join(problems)))
+        self.assertEqual(failures, [], '\n'.join(failures))
@@ -0,0 +1,66 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.render import RenderPolicy, RenderCache, render_cache, rerender
+
+
+class RenderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        render_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_policy_version(self):
+        p1 = RenderPolicy(tags=['a', 'b'])
+        p2 = RenderPolicy(tags=['a', 'b'])
+        p3 = RenderPolicy(tags=['a'])
+        self.assertEqual(p1.version, p2.version)
+        self.assertNotEqual(p1.version, p3.version)
+        self.assertNotEqual(Post.html_policy.version,
+                            Comment.html_policy.version)
+
+    def test_cache(self):
+        cache = RenderCache(maxsize=2)
+        policy = RenderPolicy(tags=['em'])
+        html = cache.render('*hello*', policy)
+        self.assertEqual(html, '<em>hello</em>')
+        self.assertEqual(cache.render('*hello*', policy), html)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # 同样的正文在不同规则下分别渲染
+        self.assertEqual(cache.render('*hello*', RenderPolicy(tags=[])),
+                         'hello')
+        cache.render('other', policy)
+        cache.render('*hello*', policy)
+        self.assertEqual(cache.misses, 4)
+
+    def test_body_sets_policy(self):
+        u = User(email='john@example.com', password='cat')
+        p = Post(body='*post*', author=u)
+        c = Comment(body='*post*', author=u, post=p)
+        self.assertEqual(p.body_html, '<p><em>post</em></p>')
+        self.assertEqual(p.render_policy, Post.html_policy.version)
+        self.assertEqual(c.render_policy, Comment.html_policy.version)
+        Post(body='*post*', author=u)
+        self.assertEqual(render_cache.hits, 1)
+
+    def test_rerender(self):
+        u = User(email='john@example.com', password='cat')
+        posts = [Post(body='post %d' % i, author=u) for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        for p in posts[:3]:
+            p.body_html = 'stale'
+            p.render_policy = 'old'
+        db.session.commit()
+        self.assertEqual(rerender(Post, batch_size=2, workers=1), 3)
+        self.assertEqual(posts[0].body_html, '<p>post 0</p>')
+        self.assertEqual(rerender(Post), 0)
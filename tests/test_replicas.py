@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from flask import g, request
+from app import create_app, db
+from app.api_1_0.authentication import credential_cache
+from app.database import _USE_REPLICA
+from app.models import User, Role, Post, identity_cache
+
+
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        for name in ('john', 'susan'):
+            db.session.add(User(email=name + '@example.com', username=name,
+                                password='cat', confirmed=True))
+        db.session.commit()
+        john = User.query.filter_by(username='john').first()
+        self.john_id = john.id
+        db.session.add(Post(body='replicated', author=john))
+        db.session.commit()
+        db.session.remove()
+
+        # 复制数据库文件作为副本，之后的写入只在主库中
+        self.directory = tempfile.mkdtemp()
+        replica = os.path.join(self.directory, 'replica.sqlite')
+        shutil.copy(db.engine.url.database, replica)
+        self.app.config['FLASKY_DATABASE_REPLICAS'] = ['sqlite:///' + replica]
+        db.session.add(Post(body='primary only', author_id=self.john_id))
+        db.session.commit()
+        db.session.remove()
+        identity_cache.clear()
+        credential_cache.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def headers(self, username):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                (username + '@example.com:cat').encode('utf-8'))
+            .decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def count_posts(self, username):
+        db.session.remove()
+        response = self.client.get('/api/v1.0/posts/',
+                                   headers=self.headers(username))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.get_data(as_text=True))['count']
+
+    def test_routing(self):
+        # GET 请求读副本，应用上下文之外的查询读主库
+        self.assertEqual(self.count_posts('john'), 1)
+        self.assertEqual(self.count_posts('susan'), 1)
+        db.session.remove()
+        self.assertEqual(Post.query.count(), 2)
+
+        # 写入走主库，写入者随后的请求也读主库，其他用户仍读副本
+        self.app.config['FLASKY_DATABASE_STICKY_SECONDS'] = 0.5
+        db.session.remove()
+        response = self.client.post('/api/v1.0/posts/',
+                                    headers=self.headers('john'),
+                                    data=json.dumps({'body': 'new'}))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.count_posts('john'), 3)
+        self.assertEqual(self.count_posts('susan'), 1)
+        time.sleep(0.6)
+        self.assertEqual(self.count_posts('john'), 1)
+
+    def login(self):
+        client = self.app.test_client(use_cookies=True)
+        client.post('/auth/login', data={'email': 'john@example.com',
+                                         'password': 'cat'})
+        # 登录本身是写入，清掉随后读主库的截止时间
+        with client.session_transaction() as session:
+            session.pop('_db_primary_until', None)
+        return client
+
+    def test_browser_session(self):
+        client = self.login()
+        with client:
+            db.session.remove()
+            response = client.get('/user/john')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('replicated', response.get_data(as_text=True))
+            self.assertNotIn('primary only', response.get_data(as_text=True))
+            # 浏览器会话中记录的截止时间之前读主库
+            with client.session_transaction() as session:
+                session['_db_primary_until'] = time.time() + 60
+            db.session.remove()
+            response = client.get('/user/john')
+            self.assertIn('primary only', response.get_data(as_text=True))
+
+    def test_shared_caches_read_primary(self):
+        # 副本还没有同步 susan 的新密码和 john 的新资料
+        susan = User.query.filter_by(username='susan').first()
+        susan.password = 'dog'
+        john = User.query.get(self.john_id)
+        john.avatar_hash = 'primary'
+        john.location = 'Primary'
+        db.session.commit()
+        db.session.remove()
+        identity_cache.clear()
+
+        # 缓存的验证结果和身份快照来自主库
+        headers = self.headers('susan')
+        headers['Authorization'] = 'Basic ' + b64encode(
+            b'susan@example.com:dog').decode('utf-8')
+        response = self.client.get('/api/v1.0/posts/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        client = self.login()
+        identity_cache.clear()
+        db.session.remove()
+        self.assertEqual(client.get('/user/john').status_code, 200)
+        self.assertEqual(identity_cache.get(self.john_id)['avatar_hash'],
+                         'primary')
+
+        # 匿名用户的整页缓存用主库渲染
+        db.session.remove()
+        response = self.client.get('/user/john')
+        self.assertIn('Primary', response.get_data(as_text=True))
+        self.assertIn('primary only', response.get_data(as_text=True))
+
+    def test_one_replica_per_session(self):
+        # 第二个副本比第一个少一篇帖子
+        second = os.path.join(self.directory, 'second.sqlite')
+        shutil.copy(self.app.config['FLASKY_DATABASE_REPLICAS'][0][10:],
+                    second)
+        connection = sqlite3.connect(second)
+        connection.execute('DELETE FROM posts')
+        connection.commit()
+        connection.close()
+        self.app.config['FLASKY_DATABASE_REPLICAS'].append(
+            'sqlite:///' + second)
+        with self.app.test_request_context():
+            request.environ[_USE_REPLICA] = True
+            for i in range(5):
+                db.session.remove()
+                counts = set(Post.query.count() for j in range(10))
+                self.assertEqual(len(counts), 1)
+                self.assertTrue(db.read_replica())
+        db.session.remove()
+
+    def test_sticky_after_second_commit(self):
+        # 第一次提交后 g.current_user 已过期，记录粘滞时不能再查询
+        with self.app.test_request_context():
+            g.current_user = User.query.get(self.john_id)
+            for body in ('first', 'second'):
+                db.session.add(Post(body=body, author_id=self.john_id))
+                db.session.commit()
+            self.assertTrue(db.sticky(self.app).get(self.john_id, False))
+        db.session.remove()
@@ -0,0 +1,195 @@
+import json
+import unittest
+from base64 import b64encode
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.search import index_tokens, query_tokens, plain_text, search, \
+    reindex, backend, SearchCount
+
+
+class TokenizerTestCase(unittest.TestCase):
+    def test_tokens(self):
+        self.assertEqual(list(index_tokens('Flask 全文搜索')),
+                         ['flask', '全', '全文', '文', '文搜', '搜', '搜索',
+                          '索'])
+        # 查询连续的汉字只用相邻两字，单字才用单字
+        self.assertEqual(query_tokens('全文搜索 flask FLASK'),
+                         ['全文', '文搜', '搜索', 'flask'])
+        self.assertEqual(query_tokens('书'), ['书'])
+        self.assertEqual(query_tokens('!!  '), [])
+        self.assertEqual(plain_text('<p>a &amp; <b>b</b></p>').split(),
+                         ['a', '&', 'b'])
+
+
+class SearchTestCase(unittest.TestCase):
+    backend = 'auto'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_SEARCH_BACKEND'] = self.backend
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.user = User(email='john@example.com', username='john',
+                         password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_post(self, body):
+        post = Post(body=body, author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def ids(self, kind, query, **kwargs):
+        return [item.id for item in search(kind, query, **kwargs)[0]]
+
+    def test_incremental(self):
+        p1 = self.add_post('我们用 *Flask* 写了一个网站')
+        p2 = self.add_post('全文搜索需要中文分词，flask flask')
+        p3 = self.add_post('另一个帖子')
+        self.assertEqual(self.ids('posts', 'flask'), [p2.id, p1.id])
+        self.assertEqual(self.ids('posts', '中文分词'), [p2.id])
+        self.assertEqual(self.ids('posts', '帖'), [p3.id])
+        # 所有词都要出现；标记不会被索引
+        self.assertEqual(self.ids('posts', '网站 flask'), [p1.id])
+        self.assertEqual(self.ids('posts', 'em'), [])
+        self.assertEqual(search('posts', 'flask', page=2, per_page=1),
+                         ([Post.query.get(p1.id)], 2))
+
+        # 修改正文后索引随之更新
+        p2.body = '已经改写'
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(self.ids('posts', 'flask'), [p1.id])
+        self.assertEqual(self.ids('posts', '改写'), [p2.id])
+
+        # 未提交的修改随回滚一起撤销
+        p1.body = '回滚'
+        db.session.add(p1)
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.ids('posts', 'flask'), [p1.id])
+
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(self.ids('posts', 'flask'), [])
+
+    def test_comments(self):
+        post = self.add_post('hello')
+        comment = Comment(body='hello 评论', post=post, author=self.user)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(self.ids('comments', 'hello'), [comment.id])
+        self.assertEqual(self.ids('posts', '评论'), [])
+
+        # 屏蔽的评论不出现在结果中
+        comment.disabled = True
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(self.ids('comments', 'hello'), [])
+        comment.disabled = False
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(self.ids('comments', 'hello'), [comment.id])
+
+    def test_reindex(self):
+        post = self.add_post('flask')
+        # 绕过 ORM 事件的修改需要重建索引
+        db.session.execute(Post.__table__.update().values(
+            body='django', body_html='<p>django</p>'))
+        db.session.commit()
+        self.assertEqual(self.ids('posts', 'django'), [])
+        self.assertEqual(reindex('posts'), 1)
+        self.assertEqual(self.ids('posts', 'django'), [post.id])
+        self.assertEqual(self.ids('posts', 'flask'), [])
+
+    def test_invalid_page(self):
+        # 小于 1 的页码按第一页处理
+        self.app.config['FLASKY_SEARCH_RESULTS_PER_PAGE'] = 1
+        for i in range(3):
+            self.add_post('搜索 %d' % i)
+        for page in (0, -3):
+            response = self.client.get('/search?q=搜索&page=%d' % page)
+            self.assertEqual(response.status_code, 200)
+            data = response.get_data(as_text=True)
+            self.assertNotIn('page=-', data)
+            self.assertRegex(
+                data, r'<li class="active">\s*<a href="/search\?page=1&amp;')
+
+    def test_views(self):
+        post = self.add_post('关于搜索的帖子')
+        comment = Comment(body='关于搜索的评论', post=post, author=self.user)
+        db.session.add(comment)
+        db.session.commit()
+
+        response = self.client.get('/search?q=搜索')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertIn('关于搜索的帖子', data)
+        self.assertNotIn('关于搜索的评论', data)
+        response = self.client.get('/search?q=搜索&type=comments')
+        self.assertIn('关于搜索的评论', response.get_data(as_text=True))
+        self.assertEqual(
+            self.client.get('/search?q=x&type=users').status_code, 404)
+
+        headers = {
+            'Authorization': 'Basic ' + b64encode(
+                b'john@example.com:cat').decode('utf-8'),
+            'Accept': 'application/json'
+        }
+        response = self.client.get(
+            '/api/v1.0/search?q=搜索&type=comments&embed=post',
+            headers=headers)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['count'], 1)
+        self.assertEqual(json_response['comments'][0]['post']['body'],
+                         '关于搜索的帖子')
+        response = self.client.get('/api/v1.0/search?q=搜索&page=-1',
+                                   headers=headers)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(json_response['posts']), 1)
+        self.assertIsNone(json_response['prev'])
+        response = self.client.get('/api/v1.0/search?q=x&type=users',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class InvertedIndexSearchTestCase(SearchTestCase):
+    backend = 'inverted'
+
+    def test_backend(self):
+        self.assertEqual(backend(db.session.connection()), 'inverted')
+
+    def test_document_count(self):
+        def documents():
+            return SearchCount.query.get(0).documents
+
+        # 只统计索引中有词的文档
+        p1 = self.add_post('flask')
+        p2 = self.add_post('flask web')
+        p3 = self.add_post('!!')
+        self.assertEqual(documents(), 2)
+        p2.body = '??'
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(documents(), 1)
+        p3.body = 'web'
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(documents(), 2)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(documents(), 1)
+        self.assertEqual(SearchCount.query.get(1).documents, 0)
+        self.assertEqual(reindex('posts'), 2)
+        self.assertEqual(documents(), 1)
+        self.assertEqual(self.ids('posts', 'web'), [p3.id])
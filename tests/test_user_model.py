@@ -1,8 +1,10 @@
 import unittest
 import time
 from datetime import datetime
+from sqlalchemy import select
 from app import create_app, db
-from app.models import User, AnonymousUser, Role, Permission, Follow
+from app.models import User, AnonymousUser, Role, Permission, Follow, \
+    Post, Comment, TimelineEntry, identity_cache, last_seen_buffer
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -112,6 +114,63 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(u.can(Permission.WRITE_ARTICLES))
         self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
 
+    def test_identity_cache(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        id = u.id
+        db.session.remove()
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        try:
+            # 第二次加载和权限判断都不查询数据库
+            u = User.load_cached(id)
+            self.assertEqual(u.email, 'john@example.com')
+            self.assertTrue(u.can(Permission.FOLLOW))
+            db.session.remove()
+            del statements[:]
+            u = User.load_cached(id)
+            self.assertEqual(u.username, None)
+            self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+            self.assertFalse(u.is_administrator())
+            self.assertEqual(statements, [])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+
+        # 更新最近在线时间时就地修改快照
+        self.app.config['FLASKY_LAST_SEEN_RESOLUTION'] = 0
+        u.ping()
+        self.assertEqual(identity_cache.get(id)['last_seen'], u.last_seen)
+
+        # 修改在提交后才删除快照，回滚的修改不影响快照
+        u.username = 'john'
+        db.session.flush()
+        self.assertIsNotNone(identity_cache.get(id))
+        db.session.rollback()
+        self.assertIsNotNone(identity_cache.get(id))
+        u.username = 'john'
+        db.session.commit()
+        self.assertIsNone(identity_cache.get(id))
+
+        # 修改用户或角色后缓存失效
+        admin = Role.query.filter_by(permissions=0xff).first()
+        u.role = admin
+        db.session.add(u)
+        db.session.commit()
+        db.session.remove()
+        self.assertTrue(User.load_cached(id).is_administrator())
+        admin = Role.query.filter_by(permissions=0xff).first()
+        admin.permissions = Permission.FOLLOW
+        db.session.add(admin)
+        db.session.commit()
+        db.session.remove()
+        self.assertFalse(User.load_cached(id).is_administrator())
+
     def test_anonymous_user(self):
         u = AnonymousUser()
         self.assertFalse(u.can(Permission.FOLLOW))
@@ -126,6 +185,7 @@ class UserModelTestCase(unittest.TestCase):
             (datetime.utcnow() - u.last_seen).total_seconds() < 3)
 
     def test_ping(self):
+        self.app.config['FLASKY_LAST_SEEN_RESOLUTION'] = 1
         u = User(password='cat')
         db.session.add(u)
         db.session.commit()
@@ -134,6 +194,31 @@ class UserModelTestCase(unittest.TestCase):
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
 
+    def test_ping_throttled(self):
+        self.app.config['FLASKY_LAST_SEEN_RESOLUTION'] = 60
+        u = User(password='cat', last_seen=datetime(2000, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+        last_seen_buffer.flush()
+
+        def stored():
+            return db.engine.execute(
+                select([User.__table__.c.last_seen])
+                .where(User.__table__.c.id == u.id)).scalar()
+
+        # 超过精度才更新，且只改内存中的值，不弄脏会话
+        u.ping()
+        self.assertTrue(u.last_seen > datetime(2000, 1, 1))
+        self.assertFalse(db.session.dirty)
+        self.assertEqual(stored(), datetime(2000, 1, 1))
+        seen = u.last_seen
+        u.ping()
+        self.assertEqual(u.last_seen, seen)
+
+        self.assertEqual(last_seen_buffer.flush(), 1)
+        self.assertEqual(stored(), seen)
+        self.assertEqual(last_seen_buffer.flush(), 0)
+
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
         with self.app.test_request_context('/'):
@@ -188,6 +273,136 @@ class UserModelTestCase(unittest.TestCase):
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
 
+    def test_counters(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertTrue(u1.follower_count == 1)
+        self.assertTrue(u1.followed_count == 1)
+        u1.follow(u2)
+        p = Post(body='post', author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(u1.followed_count == 2)
+        self.assertTrue(u2.follower_count == 2)
+        self.assertTrue(u2.post_count == 1)
+        c = Comment(body='comment', author=u1, post=p)
+        db.session.add(c)
+        db.session.commit()
+        self.assertTrue(p.comment_count == 1)
+        self.assertTrue(u1.comment_count == 1)
+        db.session.delete(c)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertTrue(p.comment_count == 0)
+        self.assertTrue(u1.followed_count == 1)
+        self.assertTrue(u2.follower_count == 1)
+
+        # 手动制造偏差后校正
+        u2.post_count = 5
+        db.session.add(u2)
+        db.session.commit()
+        self.assertTrue(User.reconcile_counts()['post_count'] == 1)
+        self.assertTrue(u2.post_count == 1)
+        self.assertTrue(Post.reconcile_counts()['comment_count'] == 0)
+
+    def test_counters_follow_reassignment(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        p1 = Post(body='first', author=u1)
+        p2 = Post(body='second', author=u1)
+        c = Comment(body='comment', author=u1, post=p1)
+        db.session.add_all([u1, u2, p1, p2, c])
+        db.session.commit()
+
+        # 通过关系和直接修改外键改换作者，计数都从旧的一方移到新的一方
+        p1.author = u2
+        db.session.commit()
+        self.assertEqual((u1.post_count, u2.post_count), (1, 1))
+        p1.author_id = u1.id
+        db.session.commit()
+        self.assertEqual((u1.post_count, u2.post_count), (2, 0))
+        c.post = p2
+        c.author = u2
+        db.session.commit()
+        self.assertEqual((p1.comment_count, p2.comment_count), (0, 1))
+        self.assertEqual((u1.comment_count, u2.comment_count), (0, 1))
+
+        # 对象过期后只修改外键
+        db.session.expire(c)
+        c.author_id = u1.id
+        db.session.commit()
+        self.assertEqual((u1.comment_count, u2.comment_count), (1, 0))
+        self.assertEqual(User.reconcile_counts(),
+                         {'post_count': 0, 'comment_count': 0,
+                          'follower_count': 0, 'followed_count': 0})
+        self.assertEqual(Post.reconcile_counts(), {'comment_count': 0})
+
+    def test_timeline_store(self):
+        self.app.config['FLASKY_TIMELINE_STORE'] = True
+        self.app.config['FLASKY_TIMELINE_FANOUT_LIMIT'] = 2
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        u3 = User(email='david@example.net', password='dog')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        p1 = Post(body='before follow', author=u2)
+        db.session.add(p1)
+        db.session.commit()
+
+        # 关注时回填，发帖时写扩散
+        u1.follow(u2)
+        db.session.commit()
+        p2 = Post(body='after follow', author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(set(u1.followed_posts.all()), {p1, p2})
+
+        # 粉丝数超过阈值的作者在读取时合并
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        p3 = Post(body='popular', author=u3)
+        db.session.add(p3)
+        db.session.commit()
+        self.assertTrue(TimelineEntry.query.filter_by(post_id=p3.id).count()
+                        == 0)
+        timeline = u1.followed_posts.order_by(Post.timestamp.desc()).all()
+        self.assertEqual(timeline, [p3, p2, p1])
+
+        # 取消关注时清理
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [p3])
+
+        # 粉丝数回到阈值以内时把之前合并读取的帖子扩散给粉丝
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertTrue(TimelineEntry.query.filter_by(
+            user_id=u1.id, post_id=p3.id).count() == 1)
+        self.assertEqual(u1.followed_posts.all(), [p3])
+        p4 = Post(body='less popular', author=u3)
+        db.session.add(p4)
+        db.session.commit()
+        self.assertEqual(set(u1.followed_posts.all()), {p3, p4})
+
+        # 再次超过阈值时删除已经扩散的条目
+        u2.follow(u3)
+        db.session.commit()
+        self.assertTrue(TimelineEntry.query.filter(
+            TimelineEntry.post_id.in_([p3.id, p4.id])).count() == 0)
+        self.assertEqual(set(u1.followed_posts.all()), {p3, p4})
+        self.assertEqual(set(u2.followed_posts.all()), {p1, p2, p3, p4})
+
+        # 重建结果与直接 join follows 一致
+        TimelineEntry.rebuild()
+        for u in (u1, u2, u3):
+            self.app.config['FLASKY_TIMELINE_STORE'] = True
+            stored = set(u.followed_posts.all())
+            self.app.config['FLASKY_TIMELINE_STORE'] = False
+            self.assertEqual(stored, set(u.followed_posts.all()))
+
     def test_to_json(self):
         u = User(email='john@example.com', password='cat')
         db.session.add(u)